@@ -1,3 +1,10 @@
 __version__ = "1.4.0"
 
-from .qt_main import HNNGUI
+
+def __getattr__(name):
+    # the GUI is imported when first used, so that the modules that run
+    # simulations without it don't need Qt
+    if name == 'HNNGUI':
+        from .qt_main import HNNGUI
+        return HNNGUI
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,282 @@
+"""Run simulations of many parameter files without the GUI
+
+Example: python hnn_batch.py --ncore 32 'param/*.param'
+"""
+
+import os
+import sys
+import shutil
+import argparse
+from glob import glob
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from hnn_core import read_params, Network, JoblibBackend, MPIBackend
+
+from .paramrw import (get_output_dir, hnn_core_compat_params,
+                      read_output_settings)
+from .simdata import SimData
+from .simcache import SimResultCache, get_cache_key
+from .simfn import get_defncore, simulate, postproc_dipoles, write_sim_data
+from .specfn import get_spec_options
+
+
+def expand_param_files(patterns):
+    """Expand a list of param file names or glob patterns
+
+    Parameters
+    ----------
+    patterns : list of str
+        File names or glob patterns of .param files
+
+    Returns
+    -------
+    paramfns : list of str
+        Sorted list of absolute paths to .param files, without duplicates
+    """
+    paramfns = set()
+    for pattern in patterns:
+        matches = glob(os.path.expanduser(pattern))
+        if len(matches) == 0:
+            print("Warning: no parameter files match %s" % pattern)
+        paramfns.update([os.path.abspath(fn) for fn in matches])
+
+    return sorted(paramfns)
+
+
+def _check_sim_prefixes(paramfns):
+    """Make sure that simulations won't overwrite each other's results"""
+    prefixes = dict()
+    for paramfn in paramfns:
+        sim_prefix = read_params(paramfn)['sim_prefix']
+        if sim_prefix in prefixes:
+            raise ValueError("%s and %s both have sim_prefix '%s'" %
+                             (prefixes[sim_prefix], paramfn, sim_prefix))
+        prefixes[sim_prefix] = paramfn
+
+
+def run_param_file(paramfn, ncore=1, use_cache=True, verbose=False,
+                   settings=None):
+    """Simulate a parameter file and save results like the GUI does
+
+    The param file is copied to the output 'param' directory and results are
+    written to the 'data/<sim_prefix>' directory so that the GUI can load
+    them later.
+
+    Parameters
+    ----------
+    paramfn : str
+        Full path to the .param file
+    ncore : int
+        Number of cores to run this simulation over. If more than one, MPI
+        is used.
+    use_cache : bool
+        Whether to reuse the results of an identical earlier simulation
+    verbose : bool
+        Whether to print the simulation output
+    settings : dict | None
+        The settings of saving results from read_output_settings. If None,
+        the settings of the output directory are used.
+
+    Returns
+    -------
+    sim_dir : str
+        Path of simulation data directory
+    """
+    if verbose:
+        out = sys.stdout
+    else:
+        out = open(os.devnull, 'w')
+
+    try:
+        with redirect_stdout(out):
+            sim_dir = _run_param_file(paramfn, ncore, use_cache, settings)
+    finally:
+        if not verbose:
+            out.close()
+
+    return sim_dir
+
+
+def _run_param_file(paramfn, ncore, use_cache, settings):
+    params = read_params(paramfn)
+    if 'N_trials' not in params or params['N_trials'] == 0:
+        print("Warning: invalid configured number of trials."
+              " Setting to 1.")
+        params['N_trials'] = 1
+
+    param_dir = os.path.join(get_output_dir(), 'param')
+    os.makedirs(param_dir, exist_ok=True)
+    out_paramfn = os.path.join(param_dir, params['sim_prefix'] + '.param')
+    if os.path.abspath(paramfn) != os.path.abspath(out_paramfn):
+        shutil.copyfile(paramfn, out_paramfn)
+
+    sim_params = hnn_core_compat_params(params)
+    cache_key = get_cache_key(sim_params)
+    sim_cache = SimResultCache() if use_cache else None
+    sim_data = sim_cache.get(cache_key) if use_cache else None
+
+    if sim_data is None:
+        net = Network(sim_params, add_drives_from_params=True)
+        if ncore > 1:
+            backend = MPIBackend(n_procs=ncore, mpi_cmd='mpiexec')
+        else:
+            # NEURON stays loaded in this worker process between runs
+            backend = JoblibBackend(n_jobs=1)
+        with backend:
+            sim_data = simulate(net)
+
+        if use_cache:
+            sim_cache.put(cache_key, sim_data)
+
+    if settings is None:
+        settings = read_output_settings()
+    spec_freqs, spec_dtype = get_spec_options(settings, params['f_max_spec'])
+    postproc_dipoles(sim_data, params)
+    sim_dir = write_sim_data(sim_data, params, spec_freqs=spec_freqs,
+                             spec_dtype=spec_dtype,
+                             legacy_files=settings['legacy_files'])
+
+    # same as HNNGUI.done() after a simulation
+    save_vsoma = params['record_vsoma'] and settings['legacy_files']
+    if params['save_figs'] or save_vsoma:
+        sim_store = SimData()
+        sim_store.update_sim_data(out_paramfn, params, sim_data['dpls'],
+                                  sim_data['avg_dpl'], sim_data['spikes'],
+                                  sim_data['gid_ranges'], sim_data['spec'],
+                                  sim_data['vsoma'], sim_data['dpl_stats'])
+        if params['save_figs']:
+            sim_store.save_dipole_with_hist(out_paramfn, params)
+            sim_store.save_spec_with_hist(out_paramfn, params)
+        if save_vsoma:
+            sim_store.save_vsoma(out_paramfn, params)
+
+    return sim_dir
+
+
+def run_batch(paramfns, ncore=None, ncore_per_sim=1, use_cache=True,
+              verbose=False, result_callback=None, settings=None):
+    """Run simulations of many parameter files concurrently
+
+    Parameters
+    ----------
+    paramfns : list of str
+        Full paths to the .param files
+    ncore : int | None
+        Total number of cores to use. If None, all available cores are used
+    ncore_per_sim : int
+        Number of cores for each simulation
+    use_cache : bool
+        Whether to reuse the results of identical earlier simulations
+    verbose : bool
+        Whether to print the simulation output
+    result_callback : function | None
+        Called as result_callback(paramfn, sim_dir) as each simulation
+        completes. sim_dir is None if the simulation failed.
+    settings : dict | None
+        Settings of saving results that override those of the output
+        directory (see read_output_settings), for example
+        {'legacy_files': False}
+
+    Returns
+    -------
+    failed : list of str
+        The param files that could not be simulated
+    """
+    if ncore is None:
+        ncore = get_defncore()
+    if ncore_per_sim < 1:
+        raise ValueError("ncore_per_sim must be at least 1")
+
+    _check_sim_prefixes(paramfns)
+    run_settings = read_output_settings()
+    if settings is not None:
+        for key in settings:
+            if key not in run_settings:
+                raise ValueError("Unknown setting: %s" % key)
+        run_settings.update(settings)
+
+    n_workers = max(1, min(ncore // ncore_per_sim, len(paramfns)))
+    print("Running %d simulations over %d processes" % (len(paramfns),
+                                                        n_workers))
+
+    failed = list()
+    # spawn so that each worker has its own NEURON instance
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=get_context('spawn')) as executor:
+        futures = dict()
+        for paramfn in paramfns:
+            future = executor.submit(run_param_file, paramfn, ncore_per_sim,
+                                     use_cache, verbose, run_settings)
+            futures[future] = paramfn
+
+        for future in as_completed(futures):
+            paramfn = futures[future]
+            try:
+                sim_dir = future.result()
+            except Exception as e:
+                print("Error: simulation of %s failed: %s" % (paramfn, e))
+                failed.append(paramfn)
+                sim_dir = None
+            else:
+                print("Finished %s. Saved data in: %s" % (paramfn, sim_dir))
+
+            if result_callback is not None:
+                result_callback(paramfn, sim_dir)
+
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run HNN simulations of parameter files without the GUI.'
+        ' Results are saved in %s' % get_output_dir())
+    parser.add_argument('params', nargs='+',
+                        help='.param files or glob patterns (quoted)')
+    parser.add_argument('--ncore', type=int, default=None,
+                        help='total number of cores to use (default: all)')
+    parser.add_argument('--ncore-per-sim', type=int, default=1,
+                        help='number of cores (MPI processes) for each'
+                        ' simulation (default: 1)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always simulate, even if identical results'
+                        ' are cached')
+    parser.add_argument('--no-legacy-files', action='store_true',
+                        help='only write the results file of each'
+                        ' simulation, without the files of its trials'
+                        ' (default: the setting of the output directory)')
+    parser.add_argument('--spec-scale', choices=['linear', 'log'],
+                        help='frequencies of spectral analysis 1 Hz apart or'
+                        ' logarithmically spaced (default: the setting of'
+                        ' the output directory)')
+    parser.add_argument('--spec-dtype', choices=['float64', 'float32'],
+                        help='precision of spectral analysis (default: the'
+                        ' setting of the output directory)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print simulation output')
+    args = parser.parse_args(argv)
+
+    paramfns = expand_param_files(args.params)
+    if len(paramfns) == 0:
+        print("Error: no parameter files to simulate")
+        return 1
+
+    settings = dict()
+    if args.no_legacy_files:
+        settings['legacy_files'] = False
+    if args.spec_scale is not None:
+        settings['spec_scale'] = args.spec_scale
+    if args.spec_dtype is not None:
+        settings['spec_dtype'] = args.spec_dtype
+
+    try:
+        failed = run_batch(paramfns, ncore=args.ncore,
+                           ncore_per_sim=args.ncore_per_sim,
+                           use_cache=not args.no_cache, verbose=args.verbose,
+                           settings=settings)
+    except ValueError as e:
+        print("Error: %s" % e)
+        return 1
+
+    return 1 if len(failed) > 0 else 0
@@ -0,0 +1,521 @@
+"""Save simulations so that they can be continued to a later tstop"""
+
+import os
+import pickle
+from math import floor
+
+import numpy as np
+from hnn_core.dipole import Dipole
+
+from .savestate import check_save_state
+from .simcache import get_cache_key
+from .simfile import open_sim_file
+
+CHECKPOINT_FNAME = 'checkpoint.pkl'
+
+# parameters that can differ between a checkpoint and its continuation
+_CONTINUATION_PARAMS = ['tstop', 'N_trials', 'tstop_input_prox',
+                        'tstop_input_dist', 'T_pois']
+
+
+def get_continuation_key(sim_params, exclude_params=()):
+    """Hash of the parameters that a continued simulation must share
+
+    Parameters
+    ----------
+    sim_params : dict
+        The parameters of the Network
+    exclude_params : list of str
+        More parameters that are allowed to differ
+
+    Returns
+    -------
+    key : str
+        The hex digest identifying simulations that can be continued from
+        each other's checkpoints
+    """
+    params = {key: val for key, val in sim_params.items()
+              if key not in _CONTINUATION_PARAMS and
+              key not in exclude_params}
+    return get_cache_key(params)
+
+
+def read_checkpoint(sim_dir):
+    """Read the checkpoint saved with a simulation
+
+    Parameters
+    ----------
+    sim_dir : str
+        Path of simulation data directory
+
+    Returns
+    -------
+    checkpoint : dict | None
+        The checkpoint or None if there is none that can be read
+    """
+    fname = os.path.join(sim_dir, CHECKPOINT_FNAME)
+    try:
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        print("Warning: ignoring unreadable checkpoint %s" % fname)
+        return None
+
+
+def read_checkpoint_results(sim_dir):
+    """Read the results that a checkpoint in sim_dir continues
+
+    The checkpoint only has the state at its tstop. The dipoles, spikes and
+    somatic voltages up to then are read from the results file, which
+    write_sim_data writes with the raw dipoles when there is a checkpoint.
+
+    Parameters
+    ----------
+    sim_dir : str
+        Path of simulation data directory
+
+    Returns
+    -------
+    results : dict | None
+        The raw dipoles in 'raw_dpls', the spikes in 'spikes' and the
+        somatic voltages in 'vsoma', or None if they can't be read
+    """
+    # the results are joined with the continuation, so they are read into
+    # memory instead of memory-mapped
+    sim_file = open_sim_file(sim_dir, mmap=False)
+    if sim_file is None or 'raw_dpls' not in sim_file:
+        return None
+
+    vsoma = list()
+    if 'vsoma' in sim_file:
+        vsoma = sim_file.read_vsoma()
+        for vsoma_trial in vsoma:
+            vsoma_trial.pop('vtime')
+    return {'raw_dpls': sim_file.read_dipoles(raw=True),
+            'spikes': sim_file.read_spikes(), 'vsoma': vsoma}
+
+
+def write_checkpoint(sim_dir, checkpoint):
+    """Save a checkpoint with a simulation, replacing any earlier one
+
+    Parameters
+    ----------
+    sim_dir : str
+        Path of simulation data directory
+    checkpoint : dict | None
+        The checkpoint from simulate_checkpoint(). If None, any earlier
+        checkpoint is removed because it no longer matches the results
+    """
+    fname = os.path.join(sim_dir, CHECKPOINT_FNAME)
+    if checkpoint is None:
+        if os.path.exists(fname):
+            os.remove(fname)
+        return
+
+    tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp_fname, 'wb') as f:
+        pickle.dump(checkpoint, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fname, fname)
+
+
+def get_checkpoint_time(t_max, dt):
+    """The latest time up to t_max that a simulation can be saved at
+
+    Parameters
+    ----------
+    t_max : float
+        The time in ms to round down, e.g. the start of optimization
+    dt : float
+        The time step of the simulation in ms
+
+    Returns
+    -------
+    t_checkpoint : float
+        A multiple of dt, rounded down from t_max, or 0 if there is none
+    """
+    # the small tolerance keeps multiples of dt that are not exactly
+    # representable from being rounded down a whole step
+    n_steps = int(floor(t_max / dt + 1e-9))
+    # hnn-core's times must have a sample for each step, which
+    # rounding of np.arange breaks for some tstops
+    while n_steps > 0 and \
+            len(np.arange(0., n_steps * dt + dt, dt)) != n_steps + 1:
+        n_steps -= 1
+    return round(n_steps * dt, 8)
+
+
+def _get_procs_per_trial(backend):
+    """The number of MPI processes that each trial is simulated over"""
+    if hasattr(backend, 'pools'):
+        # TrialGroupBackend
+        return backend.pools[0].n_procs
+    return backend.n_procs
+
+
+def check_continuation(backend):
+    """Check that simulations of a backend can be saved and continued
+
+    Parameters
+    ----------
+    backend : MPIPoolBackend | TrialGroupBackend
+        The backend that will run the simulation
+
+    Returns
+    -------
+    reason : str | None
+        Why the simulations can't be continued, or None if they can
+    """
+    n_procs = _get_procs_per_trial(backend)
+    if n_procs > 1:
+        # restoring states saved over several processes is untested
+        return "continuing over %d processes per trial is not supported" % \
+            n_procs
+    return check_save_state()
+
+
+def _get_drive_events(net, trial_idx):
+    """Sorted event times of every drive gid in a trial"""
+    drive_events = dict()
+    for drive_name, drive in net.external_drives.items():
+        gids = net.gid_ranges[drive_name]
+        for gid, event_times in zip(gids, drive['events'][trial_idx]):
+            drive_events[gid] = np.sort(event_times)
+
+    return drive_events
+
+
+def _describe_drives(net):
+    """Describe the connections and the parameters of each drive
+
+    Only the weights of connections can change when continuing from a saved
+    state. The structure must stay the same for the state to be restored.
+    """
+    drives = dict()
+    for drive_name, drive in net.external_drives.items():
+        structure = list()
+        for target_type, conn in drive['conn'].items():
+            receptors = [receptor for receptor in ('ampa', 'nmda')
+                         if len(conn[receptor]) > 0]
+            structure.append((target_type, conn['location'],
+                              len(conn['src_gids']), len(conn['target_gids']),
+                              receptors))
+        # the stop time is checked through the events of the drive
+        dynamics = {key: val for key, val in drive['dynamics'].items()
+                    if key != 'tstop'}
+        drive_params = {key: val for key, val in drive.items()
+                        if key not in ('events', 'dynamics')}
+        drives[drive_name] = {'structure': repr(structure),
+                              'params': repr((dynamics, drive_params))}
+
+    return drives
+
+
+def _continue_drive_events(old_events, new_events, t_start):
+    """Combine the drive events of a checkpoint with those of a new network
+
+    Returns the events of the continued simulation and whether the events up
+    to t_start are the same as those of the new network.
+    """
+    events = dict()
+    same_prefix = True
+    for gid, new_times in new_events.items():
+        old_times = old_events.get(gid, np.array([]))
+        old_past = old_times[old_times <= t_start]
+        new_past = new_times[new_times <= t_start]
+        if len(old_past) != len(new_past) or \
+                not np.allclose(old_past, new_past, rtol=0., atol=1e-9):
+            same_prefix = False
+
+        # events up to t_start have been delivered already
+        events[gid] = np.r_[old_past, new_times[new_times > t_start]]
+
+    return events, same_prefix
+
+
+def _check_results(checkpoint, results, record_vsoma):
+    """Check that results are those that a checkpoint was saved with"""
+    if results is None:
+        return "its results are missing"
+
+    n_trials = len(checkpoint['states'])
+    if len(results['raw_dpls']) < n_trials or \
+            len(results['spikes']._spike_times) < n_trials or \
+            (record_vsoma and len(results['vsoma']) < n_trials):
+        return "its results have fewer trials"
+    if any([len(dpl.times) != checkpoint['n_samples']
+            for dpl in results['raw_dpls'][:n_trials]]) or \
+            [len(spike_times) for spike_times in
+             results['spikes']._spike_times[:n_trials]] != \
+            checkpoint['n_spikes']:
+        return "its results were changed"
+    return None
+
+
+def plan_continuation(checkpoint, sim_params, net, backend, results=None,
+                      exclude_params=(), exact=False):
+    """Find which trials can be continued from a checkpoint
+
+    Parameters
+    ----------
+    checkpoint : dict | None
+        The checkpoint saved with an earlier simulation
+    sim_params : dict
+        The parameters of the simulation, before simulate_checkpoint()
+        modified them
+    net : Network object
+        The Network of the simulation to run, with the drives of all trials
+        instantiated
+    backend : MPIPoolBackend | TrialGroupBackend
+        The backend that will run the simulation
+    results : dict | None
+        The results that checkpoint was saved with, as returned by
+        read_checkpoint_results
+    exclude_params : list of str
+        Parameters of inputs that may differ from those of checkpoint
+    exact : bool
+        If True, only continue when the results are the same as simulating
+        from 0 ms. Otherwise, drive events before the time of the checkpoint
+        that were not simulated are accepted with a warning.
+
+    Returns
+    -------
+    n_continued : int
+        The number of trials (from the first) continued from the checkpoint.
+        Zero if the simulation has to start over.
+    drive_events : list of dict
+        The event times of each drive gid in each trial of the simulation
+    """
+    n_trials = net.params['N_trials']
+    drive_events = [_get_drive_events(net, trial_idx)
+                    for trial_idx in range(n_trials)]
+    if checkpoint is None:
+        return 0, drive_events
+
+    reason = None
+    unsupported = check_continuation(backend)
+    n_procs = _get_procs_per_trial(backend)
+    t_start = checkpoint['tstop']
+    drives = _describe_drives(net)
+    old_drives = checkpoint.get('drives')
+    if unsupported is not None:
+        reason = unsupported
+    elif old_drives is None or 'n_samples' not in checkpoint:
+        reason = "saved by an older version"
+    elif get_continuation_key(checkpoint['params'], exclude_params) != \
+            get_continuation_key(sim_params, exclude_params):
+        reason = "parameters changed"
+    elif net.params['tstop'] < t_start:
+        reason = "tstop is shorter than %.2f ms" % t_start
+    elif not np.isclose((checkpoint['n_samples'] - 1) * net.params['dt'],
+                        t_start):
+        reason = "its tstop is not a multiple of dt"
+    elif checkpoint['n_procs'] != n_procs:
+        reason = "saved from %d processes per trial, not %d" % \
+            (checkpoint['n_procs'], n_procs)
+    elif set(drives) != set(old_drives) or \
+            any([drives[name]['structure'] != old_drives[name]['structure']
+                 for name in drives]):
+        reason = "connections of inputs changed"
+    else:
+        reason = _check_results(checkpoint, results,
+                                bool(sim_params['record_vsoma']))
+    changed_drives = [name for name in drives if reason is None and
+                      drives[name]['params'] != old_drives[name]['params']]
+
+    n_continued = min(len(checkpoint['states']), n_trials)
+    continued_events = list()
+    same_prefix = True
+    for trial_idx in range(n_continued):
+        if reason is not None:
+            break
+
+        old_events = checkpoint['drive_events'][trial_idx]
+        new_events = drive_events[trial_idx]
+        # changed inputs must not have had any effect before t_start
+        for name in changed_drives:
+            for gid in net.gid_ranges[name]:
+                if np.any(old_events[gid] <= t_start) or \
+                        np.any(new_events[gid] <= t_start):
+                    reason = "%s changed and has events before %.2f ms" % \
+                        (name, t_start)
+                    break
+
+        events, trial_same_prefix = _continue_drive_events(
+            old_events, new_events, t_start)
+        continued_events.append(events)
+        same_prefix = same_prefix and trial_same_prefix
+        if exact and not same_prefix:
+            reason = "inputs have events before %.2f ms that were not" \
+                " simulated" % t_start
+
+    if reason is not None:
+        print("Not continuing from checkpoint (%s)" % reason)
+        return 0, drive_events
+
+    if not same_prefix:
+        print("Warning: with tstop=%.2f ms, inputs have events before"
+              " %.2f ms that were not simulated (e.g. jittered bursts of"
+              " rhythmic inputs). Results will differ from simulating"
+              " from 0 ms" % (net.params['tstop'], t_start))
+
+    return n_continued, continued_events + drive_events[n_continued:]
+
+
+def _concat_dipoles(old_dpl, new_dpl):
+    """Join the dipole of a checkpoint with its continuation"""
+    times = np.r_[old_dpl.times, new_dpl.times[1:]]
+    data = np.column_stack([np.r_[old_dpl.data[layer],
+                                  new_dpl.data[layer][1:]]
+                            for layer in ('agg', 'L2', 'L5')])
+    return Dipole(times, data)
+
+
+def simulate_checkpoint(net, backend, checkpoint=None, results=None,
+                        exclude_params=(), exact=False, save_state=True):
+    """Simulate a network and save its state for continuing later
+
+    Trials of checkpoint are continued from the tstop of the checkpoint
+    instead of simulating them again from t=0. Added trials are simulated
+    from t=0.
+
+    Parameters
+    ----------
+    net : Network object
+        The constructed Network object from hnn-core
+    backend : MPIPoolBackend | TrialGroupBackend
+        The backend to run the simulation
+    checkpoint : dict | None
+        The checkpoint saved with an earlier simulation, or None
+    results : dict | None
+        The results that checkpoint was saved with, as returned by
+        read_checkpoint_results. Trials are only continued with them.
+    exclude_params : list of str
+        Parameters of inputs that may differ from those of checkpoint, as
+        long as the inputs have no events before the time of checkpoint
+    exact : bool
+        If True, only continue from checkpoint when the results are the same
+        as simulating from 0 ms
+    save_state : bool
+        If False, the state at tstop is not saved and the result has no
+        'checkpoint'. States are only saved when each trial is simulated
+        by one process.
+
+    Returns
+    -------
+    sim_data : dict
+        The dictionary returned by simulate(), with the new checkpoint in
+        'checkpoint'. The checkpoint has the state of each trial, the
+        number of dipole samples, the number of spikes of each trial and
+        the drives, but not the results. If trials were continued,
+        'continued_from' has the tstop, the number of trials, the number of
+        dipole samples and the number of spikes of each trial of the old
+        checkpoint.
+    """
+    # the network params are modified below
+    sim_params = dict(net.params)
+
+    record_vsoma = bool(net.params['record_vsoma'])
+    numspikes_params = net.params['numspikes_*']
+    # optimization can feed in floats for numspikes
+    for param_name, spikes in numspikes_params.items():
+        net.params[param_name] = round(spikes)
+    net.params['record_vsoma'] = record_vsoma
+    net.params['record_isoma'] = False
+
+    n_trials = net.params['N_trials']
+    tstop = net.params['tstop']
+    net._instantiate_drives(n_trials=n_trials)
+
+    n_continued, drive_events = plan_continuation(
+        checkpoint, sim_params, net, backend, results, exclude_params, exact)
+    save_state = save_state and check_continuation(backend) is None
+
+    states = [None] * n_trials
+    t_start = 0.
+    if n_continued > 0:
+        t_start = checkpoint['tstop']
+        states[:n_continued] = checkpoint['states'][:n_continued]
+        print("Continuing %d trials from %.2f ms" % (n_continued, t_start))
+
+    # continued trials only need to be simulated if tstop is later
+    if tstop > t_start:
+        trial_indices = list(range(n_trials))
+    else:
+        trial_indices = list(range(n_continued, n_trials))
+    trial_states = [states[idx] for idx in trial_indices]
+    if n_continued == 0 and not save_state:
+        # hnn-core simulates trials that neither resume nor save a state
+        trial_states = None
+    trial_data = list()
+    if len(trial_indices) > 0:
+        trial_data = backend.simulate_trials(
+            net, trial_indices, states=trial_states, save_state=save_state)
+
+    N_pyr_x = net.params['N_pyr_x']
+    N_pyr_y = net.params['N_pyr_y']
+    raw_dpls = list()
+    new_states = list()
+    spikes = net.cell_response
+    for trial_idx in range(n_trials):
+        old_dpl = None
+        if trial_idx < n_continued:
+            old_dpl = results['raw_dpls'][trial_idx]
+            spike_times = results['spikes']._spike_times[trial_idx]
+            spike_gids = results['spikes']._spike_gids[trial_idx]
+            vsoma = dict()
+            if record_vsoma:
+                vsoma = results['vsoma'][trial_idx]
+        else:
+            spike_times, spike_gids, vsoma = list(), list(), dict()
+
+        if trial_idx not in trial_indices:
+            raw_dpls.append(old_dpl)
+            new_states.append(checkpoint['states'][trial_idx])
+        else:
+            trial_result = trial_data[trial_indices.index(trial_idx)]
+            dpl, spikedata = trial_result[:2]
+            dpl._baseline_renormalize(N_pyr_x, N_pyr_y)
+            dpl._convert_fAm_to_nAm()
+            if old_dpl is not None:
+                # the first sample of the continuation repeats the last one
+                dpl = _concat_dipoles(old_dpl, dpl)
+                vsoma = {gid: list(vsoma[gid]) + list(new_vsoma[1:])
+                         for gid, new_vsoma in spikedata[3].items()}
+            else:
+                vsoma = spikedata[3]
+            raw_dpls.append(dpl)
+            new_states.append(trial_result[2] if save_state else None)
+            spike_times = list(spike_times) + list(spikedata[0])
+            spike_gids = list(spike_gids) + list(spikedata[1])
+
+        spikes._spike_times.append(spike_times)
+        spikes._spike_gids.append(spike_gids)
+        spikes._vsoma.append(vsoma)
+        spikes._isoma.append(dict())
+
+    spikes.update_types(net.gid_ranges)
+
+    # hnn-core changes this to bool, change back to int
+    net.params['record_vsoma'] = int(record_vsoma)
+
+    sim_data = {'raw_dpls': raw_dpls, 'gid_ranges': net.gid_ranges,
+                'spikes': spikes, 'vsoma': spikes.vsoma}
+    if save_state:
+        # the results are saved in the simulation data directory
+        sim_data['checkpoint'] = {
+            'params': sim_params, 'tstop': tstop,
+            'n_procs': _get_procs_per_trial(backend),
+            'states': new_states, 'drive_events': drive_events,
+            'drives': _describe_drives(net),
+            'n_samples': len(raw_dpls[0].times),
+            'n_spikes': [len(spike_times) for spike_times in
+                         spikes._spike_times]}
+    if n_continued > 0:
+        sim_data['continued_from'] = {
+            'tstop': t_start, 'n_trials': n_continued,
+            'n_samples': checkpoint['n_samples'],
+            'n_spikes': checkpoint['n_spikes'][:n_continued]}
+
+    return sim_data
@@ -0,0 +1,154 @@
+"""Convert simulation data directories to single results files
+
+Simulations saved by older versions of HNN only have a file per trial for
+each kind of result. The converter writes the results file that readers
+prefer, optionally removing the files of the trials it replaces.
+
+Example: python hnn_convert.py ~/hnn_out/data
+"""
+
+import os
+import argparse
+from glob import glob
+
+from .paramrw import get_output_dir, get_fname, read_gids_param
+from .simdata import (get_dipoles_from_disk, read_spktrials,
+                      read_spectrials, read_vsomatrials)
+from .simfile import write_sim_file, LEGACY_PATTERNS
+
+
+def _get_legacy_fnames(sim_dir, pattern, key):
+    fnames = sorted(glob(os.path.join(sim_dir, pattern)))
+    if len(fnames) == 0 and os.path.exists(get_fname(sim_dir, key)):
+        fnames = [get_fname(sim_dir, key)]
+    return fnames
+
+
+def _read_optional_trials(read_fn, sim_dir, pattern, key):
+    """Read the trials of a kind of result if they were saved"""
+    if len(_get_legacy_fnames(sim_dir, pattern, key)) == 0:
+        return None
+    trials = read_fn(sim_dir)
+    if any([trial is None for trial in trials]):
+        print("Warning: not converting %s of %s, some trials could not be"
+              " read" % (pattern, sim_dir))
+        return None
+    return trials
+
+
+def convert_sim_dir(sim_dir, overwrite=False, remove_legacy=False):
+    """Write the results file of a simulation from the files of its trials
+
+    Parameters
+    ----------
+    sim_dir : str
+        Path of simulation data directory
+    overwrite : bool
+        If True, replace an existing results file
+    remove_legacy : bool
+        If True, remove the files of the trials written to the results file
+
+    Returns
+    ----------
+    converted : bool
+        Whether a results file was written
+    """
+    sim_fname = get_fname(sim_dir, 'simfile')
+    if os.path.exists(sim_fname) and not overwrite:
+        return False
+
+    dpls = get_dipoles_from_disk(sim_dir, 0, use_sim_file=False)
+    if any([dpl is None for dpl in dpls]):
+        print("Warning: not converting %s, some dipoles could not be read" %
+              sim_dir)
+        return False
+
+    paramtxt_fn = get_fname(sim_dir, 'param')
+    try:
+        gid_ranges = read_gids_param(paramtxt_fn)
+    except FileNotFoundError:
+        print('Warning: could not read file:', paramtxt_fn)
+        return False
+    spikes = read_spktrials(sim_dir, gid_ranges, use_sim_file=False)
+
+    raw_dpls = _read_optional_trials(
+        lambda sim_dir: get_dipoles_from_disk(sim_dir, 0, raw=True,
+                                              use_sim_file=False),
+        sim_dir, 'rawdpl_*.txt', 'rawdpl')
+    spec = _read_optional_trials(
+        lambda sim_dir: read_spectrials(sim_dir, use_sim_file=False),
+        sim_dir, 'rawspec_*.npz', 'rawspec')
+    vsoma = _read_optional_trials(
+        lambda sim_dir: read_vsomatrials(sim_dir, use_sim_file=False),
+        sim_dir, 'vsoma_*.pkl', 'vsoma')
+
+    write_sim_file(sim_fname, dpls, spikes, gid_ranges, raw_dpls=raw_dpls,
+                   spec=spec, vsoma=vsoma)
+
+    if remove_legacy:
+        written = {'dpl_*.txt': True, 'rawdpl_*.txt': raw_dpls is not None,
+                   'spk_*.txt': True, 'rawspec_*.npz': spec is not None,
+                   'vsoma_*.pkl': vsoma is not None}
+        for pattern, key in LEGACY_PATTERNS:
+            if written[pattern]:
+                for fname in _get_legacy_fnames(sim_dir, pattern, key):
+                    os.remove(fname)
+
+    return True
+
+
+def convert_output_dir(data_dir=None, overwrite=False, remove_legacy=False):
+    """Write the results files of all simulations in a data directory
+
+    Parameters
+    ----------
+    data_dir : str | None
+        The directory of the simulation data directories. If None, the data
+        directory of the HNN output directory is used.
+    overwrite : bool
+        If True, replace existing results files
+    remove_legacy : bool
+        If True, remove the files of the trials written to the results files
+
+    Returns
+    ----------
+    converted : list of str
+        The simulation data directories that were converted
+    """
+    if data_dir is None:
+        data_dir = os.path.join(get_output_dir(), 'data')
+
+    converted = list()
+    for name in sorted(os.listdir(data_dir)):
+        sim_dir = os.path.join(data_dir, name)
+        if not os.path.isdir(sim_dir) or \
+                len(_get_legacy_fnames(sim_dir, 'dpl_*.txt', 'normdpl')) == 0:
+            continue
+        if convert_sim_dir(sim_dir, overwrite, remove_legacy):
+            converted.append(sim_dir)
+
+    return converted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Write the results files of simulations saved by older'
+        ' versions of HNN.')
+    parser.add_argument('data_dir', nargs='?', default=None,
+                        help='directory of simulation data directories'
+                        ' (default: %s)' %
+                        os.path.join(get_output_dir(), 'data'))
+    parser.add_argument('--overwrite', action='store_true',
+                        help='replace existing results files')
+    parser.add_argument('--remove-legacy', action='store_true',
+                        help='remove the files of the trials written to the'
+                        ' results files')
+    args = parser.parse_args(argv)
+
+    converted = convert_output_dir(args.data_dir, args.overwrite,
+                                   args.remove_legacy)
+    for sim_dir in converted:
+        print("Converted %s" % sim_dir)
+    print("Converted %d simulations" % len(converted))
+
+    return 0
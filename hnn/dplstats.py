@@ -0,0 +1,203 @@
+"""Statistics of the dipoles of the trials of a simulation, updated one
+trial at a time"""
+
+import numpy as np
+
+from hnn_core.dipole import Dipole
+
+_LAYERS = ('agg', 'L2', 'L5')
+
+
+class _P2Quantile(object):
+    """Estimate a quantile of each sample with the P-square algorithm
+
+    Five markers per sample track the minimum, the quantile, the maximum
+    and two points in between, so the memory used doesn't grow with the
+    number of trials (Jain & Chlamtac, 1985). Until five trials are added,
+    they are kept and the quantile is exact.
+
+    Parameters
+    ----------
+    prob : float
+        The quantile to estimate, between 0 and 1
+    """
+
+    def __init__(self, prob):
+        self.prob = prob
+        self._first = list()
+        self._heights = None
+        self._pos = None
+        self._desired = np.array([1., 1. + 2 * prob, 1. + 4 * prob,
+                                  3. + 2 * prob, 5.])
+        self._incr = np.array([0., prob / 2, prob, (1. + prob) / 2, 1.])
+
+    def add(self, x):
+        if self._heights is None:
+            self._first.append(np.array(x, dtype=float))
+            if len(self._first) == 5:
+                self._heights = np.sort(np.array(self._first), axis=0)
+                self._pos = np.repeat(np.arange(1., 6.)[:, np.newaxis],
+                                      self._heights.shape[1], axis=1)
+                self._first = list()
+            return
+
+        q, n = self._heights, self._pos
+        np.minimum(q[0], x, out=q[0])
+        np.maximum(q[4], x, out=q[4])
+        # the markers above the cell of x move up
+        cell = np.sum(x >= q[1:4], axis=0)
+        n += np.arange(5)[:, np.newaxis] > cell
+        self._desired += self._incr
+
+        for idx in (1, 2, 3):
+            diff = self._desired[idx] - n[idx]
+            move = ((diff >= 1) & (n[idx + 1] - n[idx] > 1)) | \
+                ((diff <= -1) & (n[idx - 1] - n[idx] < -1))
+            if not np.any(move):
+                continue
+            sign = np.sign(diff) * move
+            with np.errstate(divide='ignore', invalid='ignore'):
+                parabolic = q[idx] + sign / (n[idx + 1] - n[idx - 1]) * \
+                    ((n[idx] - n[idx - 1] + sign) * (q[idx + 1] - q[idx]) /
+                     (n[idx + 1] - n[idx]) +
+                     (n[idx + 1] - n[idx] - sign) * (q[idx] - q[idx - 1]) /
+                     (n[idx] - n[idx - 1]))
+                neighbor = np.where(sign > 0, idx + 1, idx - 1)
+                cols = np.arange(q.shape[1])
+                linear = q[idx] + sign * (q[neighbor, cols] - q[idx]) / \
+                    (n[neighbor, cols] - n[idx])
+            use_parabolic = (q[idx - 1] < parabolic) & \
+                (parabolic < q[idx + 1])
+            q[idx] = np.where(move, np.where(use_parabolic, parabolic,
+                                             linear), q[idx])
+            n[idx] += sign
+
+    def get(self):
+        if self._heights is None:
+            return np.percentile(np.array(self._first), self.prob * 100,
+                                 axis=0)
+        return self._heights[2].copy()
+
+
+class DipoleEnsemble(object):
+    """Mean, variance and percentiles of the dipoles of trials
+
+    Trials are added one at a time as they are simulated or read from
+    disk, so that the statistics of many trials can be computed without
+    keeping all of them in memory. The mean and variance are updated with
+    Welford's method and the percentiles are estimated with the P-square
+    algorithm, which is exact for up to five trials.
+
+    Parameters
+    ----------
+    percentiles : tuple of float
+        The percentiles (between 0 and 100) to estimate. The first two are
+        the lower and upper edges of the band returned by get_band.
+
+    Attributes
+    ----------
+    n_trials : int
+        The number of trials added
+    times : array | None
+        The times of the dipoles, None until a trial is added
+    """
+
+    def __init__(self, percentiles=(5., 95.)):
+        self.percentiles = tuple(percentiles)
+        self.n_trials = 0
+        self.times = None
+        self._scale_applied = None
+        self._mean = dict()
+        self._sq_dev = dict()
+        self._quantiles = dict()
+
+    def add(self, dpl):
+        """Add the dipole of a trial
+
+        Parameters
+        ----------
+        dpl : Dipole
+            The dipole of the trial. Its times must be those of the trials
+            already added.
+        """
+        if self.times is None:
+            self.times = np.array(dpl.times)
+            self._scale_applied = dpl.scale_applied
+            for layer in _LAYERS:
+                self._mean[layer] = np.zeros(len(self.times))
+                self._sq_dev[layer] = np.zeros(len(self.times))
+                self._quantiles[layer] = [_P2Quantile(pct / 100.) for pct
+                                          in self.percentiles]
+        elif len(dpl.times) != len(self.times):
+            raise ValueError("Dipole has %d times, expected %d" %
+                             (len(dpl.times), len(self.times)))
+
+        self.n_trials += 1
+        for layer in _LAYERS:
+            data = dpl.data[layer]
+            delta = data - self._mean[layer]
+            self._mean[layer] += delta / self.n_trials
+            self._sq_dev[layer] += delta * (data - self._mean[layer])
+            for quantile in self._quantiles[layer]:
+                quantile.add(data)
+
+    def add_trials(self, dpls):
+        """Add the dipoles of trials, for example from a generator"""
+        for dpl in dpls:
+            self.add(dpl)
+        return self
+
+    def get_mean(self, layer='agg'):
+        """Get the mean over trials of the dipole of a layer"""
+        return self._mean[layer].copy()
+
+    def get_var(self, layer='agg', ddof=0):
+        """Get the variance over trials of the dipole of a layer
+
+        Parameters
+        ----------
+        layer : str
+            'agg', 'L2' or 'L5'
+        ddof : int
+            Delta degrees of freedom. The sum of squared deviations is
+            divided by n_trials - ddof.
+        """
+        if self.n_trials - ddof <= 0:
+            return np.full(len(self.times), np.nan)
+        return self._sq_dev[layer] / (self.n_trials - ddof)
+
+    def get_std(self, layer='agg', ddof=0):
+        """Get the standard deviation over trials of the dipole of a layer"""
+        return np.sqrt(self.get_var(layer, ddof))
+
+    def get_percentile(self, percentile, layer='agg'):
+        """Get an estimated percentile over trials of the dipole of a layer
+
+        Parameters
+        ----------
+        percentile : float
+            One of the percentiles given when creating the ensemble
+        layer : str
+            'agg', 'L2' or 'L5'
+        """
+        if percentile not in self.percentiles:
+            raise ValueError("Percentile %s is not estimated, only %s" %
+                             (percentile, self.percentiles))
+        idx = self.percentiles.index(percentile)
+        return self._quantiles[layer][idx].get()
+
+    def get_band(self, layer='agg'):
+        """Get the lower and upper percentiles of the dipole of a layer"""
+        return (self.get_percentile(self.percentiles[0], layer),
+                self.get_percentile(self.percentiles[1], layer))
+
+    def get_avg_dpl(self):
+        """Get the average dipole, like hnn_core's average_dipoles"""
+        if self.n_trials == 0:
+            raise ValueError("No dipoles added to the ensemble")
+        avg_dpl = Dipole(self.times.copy(),
+                         np.column_stack([self._mean[layer]
+                                          for layer in _LAYERS]))
+        avg_dpl.nave = self.n_trials
+        avg_dpl.scale_applied = self._scale_applied
+        return avg_dpl
@@ -0,0 +1,111 @@
+"""Read experimental dipole data files, caching them in binary sidecars"""
+
+import os
+import hashlib
+import warnings
+from glob import glob
+
+import numpy as np
+
+from .paramrw import get_output_dir
+
+
+def _parse_exp_data(fname):
+    """Parse a text file of columns delimited by whitespace or commas
+
+    The whole file is parsed at once with np.fromstring. Files it can't
+    parse, for example ones with comments, are parsed with np.loadtxt.
+    """
+    with open(fname, 'r') as f:
+        text = f.read()
+
+    lines = [line for line in text.splitlines() if line.strip()]
+    if len(lines) > 0 and '#' not in text:
+        n_cols = len(lines[0].replace(',', ' ').split())
+        with warnings.catch_warnings():
+            # np.fromstring warns instead of failing on invalid numbers
+            warnings.simplefilter('error', DeprecationWarning)
+            try:
+                values = np.fromstring(text.replace(',', ' '), sep=' ')
+            except (ValueError, DeprecationWarning):
+                values = None
+        if values is not None and n_cols > 0 and \
+                values.size == len(lines) * n_cols:
+            return values.reshape(len(lines), n_cols)
+
+    try:
+        data = np.loadtxt(fname)
+    except ValueError:
+        # possible that data file is comma delimited instead of whitespace
+        # delimited
+        data = np.loadtxt(fname, delimiter=',')
+    return np.atleast_2d(data)
+
+
+def _get_sidecar_prefix(fname, cache_dir):
+    path_hash = hashlib.sha1(os.path.abspath(fname).encode()).hexdigest()
+    return os.path.join(cache_dir, path_hash)
+
+
+def read_exp_data(fname, cache_dir=None):
+    """Read an experimental data file
+
+    The text file is parsed once and saved as a .npy sidecar file keyed on
+    its path, size and modification time. Later reads of the same unchanged
+    file memory-map the sidecar instead of parsing the text again.
+
+    Parameters
+    ----------
+    fname : str
+        Path of the text file. The first column holds the times and each of
+        the others holds a dipole, delimited by whitespace or commas.
+    cache_dir : str | None
+        Directory of the sidecar files. If None, 'cache/exp_data' in the
+        output directory is used.
+
+    Returns
+    ----------
+    exp_data : array
+        The (times x columns) read-only data of the file
+
+    Raises
+    ------
+    ValueError
+        If the file can't be parsed
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(get_output_dir(), 'cache', 'exp_data')
+
+    stat = os.stat(fname)
+    prefix = _get_sidecar_prefix(fname, cache_dir)
+    sidecar_fname = '%s_%d_%d.npy' % (prefix, stat.st_size, stat.st_mtime_ns)
+    try:
+        return np.load(sidecar_fname, mmap_mode='r')
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        print("Warning: removing unreadable cache file %s" % sidecar_fname)
+        os.remove(sidecar_fname)
+
+    exp_data = _parse_exp_data(fname)
+
+    # unique per process so that concurrent writers don't collide
+    tmp_fname = '%s.%d.tmp' % (sidecar_fname, os.getpid())
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # sidecars of older versions of the file
+        for old_fname in glob(prefix + '_*.npy'):
+            try:
+                os.remove(old_fname)
+            except FileNotFoundError:
+                # already removed by another process
+                pass
+        with open(tmp_fname, 'wb') as f:
+            np.save(f, exp_data)
+        os.replace(tmp_fname, sidecar_fname)
+    except OSError as e:
+        print("Warning: could not cache data file %s: %s" % (fname, e))
+        exp_data.setflags(write=False)
+        return exp_data
+
+    return np.load(sidecar_fname, mmap_mode='r')
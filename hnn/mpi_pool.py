@@ -0,0 +1,508 @@
+"""Persistent pool of MPI ranks for running many simulations"""
+
+import os
+import sys
+import shlex
+import pickle
+import base64
+import atexit
+import selectors
+import weakref
+from subprocess import Popen, PIPE, TimeoutExpired
+from threading import Lock, Thread
+
+import numpy as np
+
+import hnn_core.parallel_backends as parallel_backends
+from hnn_core.parallel_backends import (MPIBackend, JoblibBackend,
+                                        _gather_trial_data)
+
+from .savestate import run_trials
+
+# '@' is not found in base64 encoding, so these are the borders of the data
+_START_SIGNAL = b'@start_of_data@'
+_END_SIGNAL = b'@end_of_data:'
+
+_POOLS = weakref.WeakSet()
+
+
+def _has_mpi4py():
+    try:
+        import mpi4py
+        mpi4py.__version__  # for flake8 test
+    except ImportError:
+        return False
+    return True
+
+
+@atexit.register
+def _shutdown_pools():
+    """make sure no MPI ranks are left behind when HNN exits"""
+    for pool in list(_POOLS):
+        pool.shutdown()
+
+
+class _ChildDataReader(object):
+    """Separates the result the ranks write on stderr from their output
+
+    The result is written between _START_SIGNAL and _END_SIGNAL, followed by
+    its length and '@'. Only the bytes that were just read are searched for
+    the markers, so that receiving a large result takes linear time.
+
+    Attributes
+    ----------
+    data_bytes : bytes | None
+        The base64 encoded result, or None until all of it has been read
+    data_len : int | None
+        The length of the result sent after the end signal
+    """
+
+    def __init__(self):
+        self.data_bytes = None
+        self.data_len = None
+        self._buf = bytearray()
+        self._started = False
+        self._search_idx = 0
+
+    def feed(self, data):
+        """Add bytes read from stderr
+
+        Parameters
+        ----------
+        data : bytes
+            The bytes read from stderr
+
+        Returns
+        -------
+        output : bytes
+            The bytes that are printable output of the ranks
+        """
+        self._buf += data
+        output = b''
+        if not self._started:
+            start_idx = self._buf.find(_START_SIGNAL)
+            if start_idx < 0:
+                # printable output, except for what could be the beginning
+                # of a start signal
+                keep = min(len(self._buf), len(_START_SIGNAL) - 1)
+                output = bytes(self._buf[:len(self._buf) - keep])
+                del self._buf[:len(self._buf) - keep]
+                return output
+            output = bytes(self._buf[:start_idx])
+            del self._buf[:start_idx + len(_START_SIGNAL)]
+            self._started = True
+
+        end_idx = self._buf.find(_END_SIGNAL, self._search_idx)
+        if end_idx < 0:
+            # the end signal could begin in the last bytes
+            self._search_idx = max(0, len(self._buf) - len(_END_SIGNAL) + 1)
+            return output
+        self._search_idx = end_idx
+        close_idx = self._buf.find(b'@', end_idx + len(_END_SIGNAL))
+        if close_idx < 0:
+            return output
+
+        self.data_bytes = bytes(self._buf[:end_idx])
+        self.data_len = int(self._buf[end_idx + len(_END_SIGNAL):close_idx])
+        output += bytes(self._buf[close_idx + 1:])
+        self._buf = bytearray()
+        return output
+
+
+class MPIPoolBackend(MPIBackend):
+    """The MPIPoolBackend class.
+
+    Unlike MPIBackend, which launches mpiexec, imports Python and loads the
+    NEURON mechanisms for every simulation, the ranks of this backend are
+    started once and stay resident. Each call to simulate() sends the Network
+    to the running ranks over a pipe. The ranks are (re)started on demand, so
+    terminate() can be used to abort a simulation in progress.
+
+    Parameters
+    ----------
+    n_procs : int | None
+        The number of MPI processes requested by the user. If None, then will
+        attempt to detect number of cores (including hyperthreads) and start
+        parallel simulation over all of them.
+    mpi_cmd : str
+        The name of the mpi launcher executable. Will use 'mpiexec'
+        (openmpi) by default.
+    in_process : bool
+        If True, a single process simulation runs in this process instead of
+        in MPI ranks. Set to False when several pools run concurrently.
+
+    Attributes
+    ----------
+    n_procs : int
+        The number of processes MPI will actually use (spread over cores).
+    mpi_cmd_str : str
+        The string of the mpi command with number of procs and options
+    proc : subprocess.Popen | None
+        The handle to the running mpiexec process or None if not started
+    n_sims : int
+        The number of simulations run since the ranks were last started
+    """
+    def __init__(self, n_procs=None, mpi_cmd='mpiexec', in_process=True):
+        super().__init__(n_procs=n_procs, mpi_cmd=mpi_cmd)
+        self.in_process = in_process
+
+        # run our persistent child script instead of hnn-core's one-shot one
+        child_script = os.path.join(os.path.dirname(__file__),
+                                    'mpi_pool_child.py')
+        if self.n_procs == 1:
+            # MPIBackend only builds the command for more than one process
+            self.mpi_cmd_str += ' -np 1 nrniv -python -mpi -nobanner ' + \
+                sys.executable + ' ' + child_script
+        else:
+            hnn_core_script = os.path.join(
+                os.path.dirname(parallel_backends.__file__), 'mpi_child.py')
+            self.mpi_cmd_str = self.mpi_cmd_str.replace(hnn_core_script,
+                                                        child_script)
+
+        if not in_process:
+            # other pools run side by side, so don't pin all of their ranks
+            # to the same cores
+            self.mpi_cmd_str = self.mpi_cmd_str.replace(
+                ' -np ', ' --bind-to none -np ', 1)
+
+        self.proc = None
+        self.n_sims = 0
+        self._proc_lock = Lock()
+        self._sim_lock = Lock()
+        _POOLS.add(self)
+
+    def __enter__(self):
+        self._old_backend = parallel_backends._BACKEND
+        parallel_backends._BACKEND = self
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+        parallel_backends._BACKEND = self._old_backend
+
+    def is_alive(self):
+        """Whether the MPI ranks are running and ready for a simulation"""
+        return self.proc is not None and self.proc.poll() is None
+
+    def _run_in_process(self):
+        return self.n_procs == 1 and self.in_process
+
+    def start(self):
+        """Start the MPI ranks if they are not already running"""
+        if self._run_in_process() or self.is_alive():
+            return
+
+        if 'win' in sys.platform:
+            use_posix = True
+        else:
+            use_posix = False
+        cmdargs = shlex.split(self.mpi_cmd_str, posix=use_posix)
+
+        # set some MPI environment variables
+        my_env = os.environ.copy()
+        if 'win' not in sys.platform:
+            my_env["OMPI_MCA_btl_base_warn_component_unused"] = '0'
+
+        if 'darwin' in sys.platform:
+            my_env["PMIX_MCA_gds"] = "^ds12"  # open-mpi/ompi/issues/7516
+            my_env["TMPDIR"] = "/tmp"  # open-mpi/ompi/issues/2956
+
+        print("Starting MPI worker pool with %d processes" % self.n_procs)
+        with self._proc_lock:
+            self.proc = Popen(cmdargs, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                              env=my_env, cwd=os.getcwd())
+            self.n_sims = 0
+
+    def _echo(self, data):
+        if len(data) > 0:
+            sys.stdout.write(data.decode(errors='replace'))
+
+    def _wait_for_data(self, proc):
+        """Echo output from the ranks until the result has been received"""
+        sel = selectors.DefaultSelector()
+        sel.register(proc.stdout, selectors.EVENT_READ)
+        sel.register(proc.stderr, selectors.EVENT_READ)
+
+        reader = _ChildDataReader()
+        try:
+            while reader.data_bytes is None:
+                if len(sel.get_map()) == 0 or proc.poll() is not None:
+                    # stdout/stderr were closed: ranks exited or were killed
+                    raise RuntimeError("MPI simulation failed")
+
+                for key, _ in sel.select(timeout=1):
+                    data = os.read(key.fileobj.fileno(), 65536)
+                    if len(data) == 0:
+                        sel.unregister(key.fileobj)
+                    elif key.fileobj is proc.stdout:
+                        self._echo(data)
+                    elif reader.data_bytes is None:
+                        self._echo(reader.feed(data))
+                    else:
+                        # output of the ranks after the result
+                        self._echo(data)
+        finally:
+            sel.close()
+
+        return reader.data_bytes, reader.data_len
+
+    def simulate(self, net, n_trials, postproc=True):
+        """Simulate the HNN model in parallel on all cores
+
+        Parameters
+        ----------
+        net : Network object
+            The Network object specifying how cells are
+            connected.
+        n_trials : int
+            Number of trials to simulate.
+        postproc: bool
+            If False, no postprocessing applied to the dipole
+
+        Returns
+        -------
+        dpl: list of Dipole
+            The Dipole results from each simulation trial
+        """
+
+        # a single core runs in this process, where NEURON stays loaded
+        if self._run_in_process():
+            return JoblibBackend(n_jobs=1).simulate(net, n_trials=n_trials,
+                                                    postproc=postproc)
+
+        print("Running %d trials..." % (n_trials))
+        sim_data = self.simulate_trials(net, list(range(n_trials)))
+
+        dpls = _gather_trial_data(sim_data, net, n_trials, postproc)
+        return dpls
+
+    def simulate_trials(self, net, trial_indices, states=None,
+                        save_state=False):
+        """Simulate a subset of the trials of a Network in the MPI ranks
+
+        The drive event times of each trial were already created when
+        constructing net, so trials simulated separately are identical to
+        those simulated one after another.
+
+        Parameters
+        ----------
+        net : Network object
+            The Network object specifying how cells are
+            connected.
+        trial_indices : list of int
+            The trials to simulate
+        states : list of (dict | None) | None
+            The saved simulator state to continue each trial from
+        save_state : bool
+            Whether to save the simulator state of each trial at tstop
+
+        Returns
+        -------
+        sim_data : list of tuple
+            The dipole and spiking data of each trial, in the order of
+            trial_indices. See savestate.run_trials
+        """
+        if self._run_in_process():
+            return run_trials(net, trial_indices, states, save_state)
+
+        with self._sim_lock:
+            self.start()
+            proc = self.proc
+            if proc is None:
+                raise RuntimeError("Terminated")
+
+            job = base64.b64encode(pickle.dumps((net, trial_indices, states,
+                                                 save_state)))
+            try:
+                proc.stdin.write(job + b'\n')
+                proc.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                raise RuntimeError("MPI simulation failed")
+
+            data_bytes, data_len = self._wait_for_data(proc)
+            self.n_sims += 1
+
+        status, sim_data = self._process_child_data(data_bytes, data_len)
+        if status == 'error':
+            # ranks are still alive, so the pool can be used again
+            raise RuntimeError("MPI simulation failed:\n%s" % sim_data)
+
+        return sim_data
+
+    def terminate(self):
+        """Kill the MPI ranks, aborting any running simulation
+
+        The ranks will be restarted by the next call to simulate()
+        """
+        with self._proc_lock:
+            proc = self.proc
+            self.proc = None
+
+        if proc is None or proc.poll() is not None:
+            return
+
+        proc.kill()
+        try:
+            proc.wait(timeout=5)
+        except TimeoutExpired:
+            print("Warning: MPI worker pool did not exit after being killed")
+
+    def shutdown(self, timeout=10):
+        """Ask the MPI ranks to exit once finished with the current job"""
+        with self._proc_lock:
+            proc = self.proc
+            self.proc = None
+
+        if proc is None or proc.poll() is not None:
+            return
+
+        try:
+            # an empty line (or closing stdin) tells the ranks to exit
+            proc.stdin.write(b'\n')
+            proc.stdin.close()
+            proc.wait(timeout=timeout)
+        except (BrokenPipeError, ValueError, TimeoutExpired):
+            proc.kill()
+            proc.wait()
+
+
+class TrialGroupBackend(object):
+    """The TrialGroupBackend class.
+
+    Trials are statistically independent, so instead of simulating them one
+    after another over all cores, the trials are split into groups that are
+    simulated concurrently. Each group runs in its own MPIPoolBackend over
+    n_procs // n_groups processes.
+
+    Parameters
+    ----------
+    n_groups : int
+        The number of groups of trials to simulate concurrently
+    n_procs : int
+        The total number of processes to use over all groups
+    mpi_cmd : str
+        The name of the mpi launcher executable. Will use 'mpiexec'
+        (openmpi) by default.
+
+    Attributes
+    ----------
+    pools : list of MPIPoolBackend
+        The pool simulating each group of trials
+    """
+    def __init__(self, n_groups, n_procs, mpi_cmd='mpiexec'):
+        if not _has_mpi4py():
+            raise RuntimeError("mpi4py is required for simulating groups of"
+                               " trials concurrently")
+
+        procs_per_group = max(1, n_procs // n_groups)
+        print("Running %d concurrent worker pools of %d processes each" %
+              (n_groups, procs_per_group))
+        self.pools = [MPIPoolBackend(n_procs=procs_per_group, mpi_cmd=mpi_cmd,
+                                     in_process=False)
+                      for _ in range(n_groups)]
+
+    def __enter__(self):
+        self._old_backend = parallel_backends._BACKEND
+        parallel_backends._BACKEND = self
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+        parallel_backends._BACKEND = self._old_backend
+
+    def simulate(self, net, n_trials, postproc=True):
+        """Simulate the HNN model with groups of trials in parallel
+
+        Parameters
+        ----------
+        net : Network object
+            The Network object specifying how cells are
+            connected.
+        n_trials : int
+            Number of trials to simulate.
+        postproc: bool
+            If False, no postprocessing applied to the dipole
+
+        Returns
+        -------
+        dpl: list of Dipole
+            The Dipole results from each simulation trial
+        """
+        sim_data = self.simulate_trials(net, list(range(n_trials)))
+
+        dpls = _gather_trial_data(sim_data, net, n_trials, postproc)
+        return dpls
+
+    def simulate_trials(self, net, trial_indices, states=None,
+                        save_state=False):
+        """Simulate a subset of the trials of a Network in groups
+
+        Parameters
+        ----------
+        net : Network object
+            The Network object specifying how cells are
+            connected.
+        trial_indices : list of int
+            The trials to simulate
+        states : list of (dict | None) | None
+            The saved simulator state to continue each trial from
+        save_state : bool
+            Whether to save the simulator state of each trial at tstop
+
+        Returns
+        -------
+        sim_data : list of tuple
+            The dipole and spiking data of each trial, in the order of
+            trial_indices. See savestate.run_trials
+        """
+        groups = [list(group) for group in
+                  np.array_split(np.arange(len(trial_indices)),
+                                 len(self.pools))
+                  if len(group) > 0]
+        print("Running %d trials in %d groups..." % (len(trial_indices),
+                                                     len(groups)))
+
+        group_data = [None] * len(groups)
+        errors = list()
+
+        def _simulate_group(group_idx):
+            group = groups[group_idx]
+            group_states = None
+            if states is not None:
+                group_states = [states[idx] for idx in group]
+            try:
+                group_data[group_idx] = self.pools[group_idx].simulate_trials(
+                    net, [trial_indices[idx] for idx in group], group_states,
+                    save_state)
+            except Exception as e:
+                errors.append(e)
+                # stop the other groups too
+                self.terminate()
+
+        threads = [Thread(target=_simulate_group, args=(group_idx,))
+                   for group_idx in range(len(groups))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(errors) > 0:
+            raise RuntimeError(str(errors[0]))
+
+        # merge groups back together in trial order
+        sim_data = list()
+        for single_group_data in group_data:
+            sim_data.extend(single_group_data)
+
+        return sim_data
+
+    def terminate(self):
+        """Kill the MPI ranks of all groups, aborting any running simulation
+        """
+        for pool in self.pools:
+            pool.terminate()
+
+    def shutdown(self, timeout=10):
+        """Ask the MPI ranks of all groups to exit"""
+        for pool in self.pools:
+            pool.shutdown(timeout=timeout)
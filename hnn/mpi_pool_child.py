@@ -0,0 +1,110 @@
+"""Script for a persistent pool of MPI ranks that run many simulations.
+
+This script is started once by MPIPoolBackend with mpiexec and nrniv. Rank 0
+reads one base64 encoded simulation job per line on stdin and broadcasts it to
+the other ranks. An empty line (or closing stdin) shuts down the pool.
+
+Note: this file must not import the hnn package, which would import Qt.
+"""
+
+import os
+import sys
+import pickle
+import base64
+import traceback
+
+# the hnn package can't be imported, but modules next to this one can
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+class MPIPoolWorker(object):
+    """The MPIPoolWorker class.
+
+    Attributes
+    ----------
+    comm : mpi4py.Comm object
+        The handle used for communicating among MPI processes
+    rank : int
+        The rank for each processor part of the MPI communicator
+    """
+
+    def __init__(self):
+        from mpi4py import MPI
+
+        self.comm = MPI.COMM_WORLD
+        self.rank = self.comm.Get_rank()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        from mpi4py import MPI
+        MPI.Finalize()
+
+    def _read_job(self):
+        """Read the next job on stdin and broadcast it to all ranks
+
+        Returns None when the pool should shut down.
+        """
+        job = None
+        if self.rank == 0:
+            line = sys.stdin.buffer.readline().strip()
+            if len(line) > 0:
+                job = pickle.loads(base64.b64decode(line, validate=True))
+
+        return self.comm.bcast(job, root=0)
+
+    def _write_data_stderr(self, result):
+        """write base64 encoded result to stderr between markers"""
+
+        # only rank 0 has data that should be sent back to MPIPoolBackend
+        if self.rank > 0:
+            return
+
+        pickled_bytes = base64.b64encode(pickle.dumps(result))
+
+        # '@' is not found in base64 encoding, so we can be certain the
+        # markers are the borders of the data
+        sys.stderr.write('@start_of_data@')
+        sys.stderr.write(pickled_bytes.decode())
+        sys.stderr.write('@end_of_data:%d@' % len(pickled_bytes))
+        sys.stderr.flush()  # flush to ensure signal is not buffered
+
+    def run(self, net, trial_indices, states=None, save_state=False):
+        """Run the given trials of one simulation"""
+
+        from savestate import run_trials
+
+        return run_trials(net, trial_indices, states, save_state)
+
+    def serve(self):
+        """Run simulation jobs until told to shut down"""
+        while True:
+            job = self._read_job()
+            if job is None:
+                break
+
+            try:
+                result = ('data', self.run(*job))
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+                result = ('error', traceback.format_exc())
+
+            # flush output buffers from all ranks before sending data
+            sys.stdout.flush()
+            self.comm.Barrier()
+            self._write_data_stderr(result)
+
+
+if __name__ == '__main__':
+    """This file is called on command-line from nrniv"""
+
+    rc = 0
+    try:
+        with MPIPoolWorker() as worker:
+            worker.serve()
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        rc = 2
+
+    sys.exit(rc)
@@ -0,0 +1,699 @@
+"""Optimizers that propose batches of parameter sets to simulate concurrently
+and a memo of the simulations they evaluated
+"""
+
+import os
+import json
+from collections import OrderedDict
+from math import ceil, log10
+from threading import Lock
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+from scipy.special import ndtr
+
+
+class DifferentialEvolution(object):
+    """The DifferentialEvolution class.
+
+    Differential evolution (DE/rand/1/bin) with an ask/tell interface. Every
+    member of a generation can be simulated at the same time, so unlike
+    COBYLA, evaluations don't have to wait for each other.
+
+    Parameters
+    ----------
+    lb : array-like of float
+        Lower bound of each parameter
+    ub : array-like of float
+        Upper bound of each parameter
+    x0 : array-like of float
+        The initial parameter values, which are a member of the first
+        generation
+    popsize : int | None
+        The number of members of each generation. If None, at least 8 and
+        three times the number of parameters, rounded up to a multiple of
+        batch_size.
+    batch_size : int
+        The number of candidates simulated concurrently
+    mutation : float
+        The differential weight (F) of the mutation
+    crossover : float
+        The crossover probability (CR)
+    seed : int | None
+        Seed for the random number generator
+
+    Attributes
+    ----------
+    population : np.ndarray, shape (popsize, n_params) | None
+        The current members of the population. None until the first
+        generation has been evaluated.
+    errors : np.ndarray, shape (popsize,) | None
+        The error of each member of the population
+    best_x : np.ndarray | None
+        The parameters with the lowest error found so far
+    best_err : float
+        The lowest error found so far
+    n_evals : int
+        The number of candidates evaluated so far
+    """
+    def __init__(self, lb, ub, x0, popsize=None, batch_size=1, mutation=0.7,
+                 crossover=0.9, seed=None):
+        self.lb = np.asarray(lb, dtype=float)
+        self.ub = np.asarray(ub, dtype=float)
+        x0 = np.asarray(x0, dtype=float)
+        if self.lb.shape != self.ub.shape or self.lb.shape != x0.shape:
+            raise ValueError("lb, ub and x0 must have the same length")
+        if np.any(self.lb > self.ub):
+            raise ValueError("lb must not be greater than ub")
+        x0 = np.clip(x0, self.lb, self.ub)
+
+        n_params = len(x0)
+        if n_params == 0:
+            # mutation needs a parameter to cross over
+            raise ValueError("At least one parameter is needed")
+        if popsize is None:
+            popsize = max(8, 3 * n_params)
+            popsize = int(ceil(popsize / batch_size)) * batch_size
+        if popsize < 4:
+            # mutation needs three other members
+            raise ValueError("popsize must be at least 4, got %d" % popsize)
+
+        self.popsize = popsize
+        self.mutation = mutation
+        self.crossover = crossover
+        self.rng = np.random.RandomState(seed)
+        self.x0 = x0
+        self.population = None
+        self.errors = None
+        self.best_x = None
+        self.best_err = np.inf
+        self.n_evals = 0
+
+    def _initial_population(self):
+        """x0 and Latin hypercube samples of the rest of the bounds"""
+        unit = _latin_hypercube(self.rng, self.popsize - 1, len(self.x0))
+        samples = self.lb + unit * (self.ub - self.lb)
+
+        return np.vstack([self.x0, samples])
+
+    def ask(self):
+        """Propose the candidates of the next generation
+
+        Returns
+        -------
+        candidates : np.ndarray, shape (popsize, n_params)
+            The parameters to evaluate. The i-th candidate competes with the
+            i-th member of the population.
+        """
+        if self.population is None:
+            return self._initial_population()
+
+        candidates = np.empty_like(self.population)
+        n_params = self.population.shape[1]
+        for member_idx in range(self.popsize):
+            others = [idx for idx in range(self.popsize) if idx != member_idx]
+            r1, r2, r3 = self.rng.choice(others, 3, replace=False)
+            mutant = self.population[r1] + self.mutation * \
+                (self.population[r2] - self.population[r3])
+
+            # at least one parameter comes from the mutant
+            cross = self.rng.uniform(size=n_params) < self.crossover
+            cross[self.rng.randint(n_params)] = True
+            trial = np.where(cross, mutant, self.population[member_idx])
+
+            # reflect parameters that left the bounds back inside them
+            trial = np.where(trial < self.lb, 2 * self.lb - trial, trial)
+            trial = np.where(trial > self.ub, 2 * self.ub - trial, trial)
+            candidates[member_idx] = np.clip(trial, self.lb, self.ub)
+
+        return candidates
+
+    def tell(self, candidates, errors):
+        """Update the population with the errors of evaluated candidates
+
+        Parameters
+        ----------
+        candidates : np.ndarray, shape (n_evaluated, n_params)
+            The first n_evaluated candidates returned by ask(). Fewer than
+            popsize are accepted when the budget of evaluations ran out.
+        errors : array-like of float, shape (n_evaluated,)
+            The error of each candidate
+        """
+        candidates = np.atleast_2d(np.asarray(candidates, dtype=float))
+        errors = np.asarray(errors, dtype=float)
+        if len(candidates) != len(errors):
+            raise ValueError("Got %d candidates but %d errors" %
+                             (len(candidates), len(errors)))
+        if len(candidates) == 0:
+            return
+
+        self.n_evals += len(errors)
+        best_idx = np.argmin(errors)
+        if errors[best_idx] < self.best_err:
+            self.best_err = errors[best_idx]
+            self.best_x = candidates[best_idx].copy()
+
+        if self.population is None:
+            if len(errors) < self.popsize:
+                # can't continue evolving an incomplete population
+                return
+            self.population = candidates.copy()
+            self.errors = errors.copy()
+            return
+
+        n_evaluated = len(errors)
+        improved = errors <= self.errors[:n_evaluated]
+        self.population[:n_evaluated][improved] = candidates[improved]
+        self.errors[:n_evaluated][improved] = errors[improved]
+
+
+def _latin_hypercube(rng, n_samples, n_params):
+    """Latin hypercube samples of the unit cube"""
+    unit = (np.arange(n_samples)[:, np.newaxis] +
+            rng.uniform(size=(n_samples, n_params))) / n_samples
+    for param_idx in range(n_params):
+        rng.shuffle(unit[:, param_idx])
+
+    return unit
+
+
+class GPSurrogate(object):
+    """The GPSurrogate class.
+
+    Gaussian process regression with a squared exponential kernel, for
+    modeling the error of simulations as a function of parameters scaled to
+    the unit cube. Simulations are deterministic, so there is only a small
+    amount of noise for numerical stability.
+
+    Parameters
+    ----------
+    length_scales : list of float
+        The length scales of the kernel to choose from. The one with the
+        highest marginal likelihood is used.
+    noise : float
+        The variance of the noise, relative to that of the errors
+
+    Attributes
+    ----------
+    length_scale : float | None
+        The length scale of the fitted kernel
+    """
+    def __init__(self, length_scales=(0.05, 0.1, 0.2, 0.4, 0.8, 1.6),
+                 noise=1e-6):
+        self.length_scales = length_scales
+        self.noise = noise
+        self.length_scale = None
+
+    def _kernel(self, X1, X2, length_scale):
+        sq_dists = np.sum((X1[:, np.newaxis, :] - X2[np.newaxis, :, :]) ** 2,
+                          axis=2)
+        return np.exp(-0.5 * sq_dists / length_scale ** 2)
+
+    def _fit_length_scale(self, length_scale):
+        K = self._kernel(self.X, self.X, length_scale)
+        K[np.diag_indices_from(K)] += self.noise
+        try:
+            factor = cho_factor(K, lower=True)
+        except np.linalg.LinAlgError:
+            return -np.inf, None, None
+
+        alpha = cho_solve(factor, self.y)
+        log_likelihood = -0.5 * self.y.dot(alpha) - \
+            np.sum(np.log(np.diag(factor[0])))
+        return log_likelihood, factor, alpha
+
+    def fit(self, X, y):
+        """Fit the Gaussian process to evaluated errors
+
+        Parameters
+        ----------
+        X : np.ndarray, shape (n_evals, n_params)
+            The evaluated parameters, scaled to the unit cube
+        y : np.ndarray, shape (n_evals,)
+            The error of each evaluation
+        """
+        self.X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float)
+        self.y_mean = y.mean()
+        self.y_std = y.std()
+        if self.y_std == 0:
+            self.y_std = 1.
+        self.y = (y - self.y_mean) / self.y_std
+
+        best = (-np.inf, None, None, None)
+        for length_scale in self.length_scales:
+            log_likelihood, factor, alpha = \
+                self._fit_length_scale(length_scale)
+            if log_likelihood > best[0]:
+                best = (log_likelihood, length_scale, factor, alpha)
+        if best[1] is None:
+            raise ValueError("Could not fit the Gaussian process")
+        _, self.length_scale, self._factor, self._alpha = best
+
+    def predict(self, X):
+        """Predict the errors of parameters
+
+        Parameters
+        ----------
+        X : np.ndarray, shape (n_points, n_params)
+            The parameters, scaled to the unit cube
+
+        Returns
+        -------
+        mean : np.ndarray, shape (n_points,)
+            The predicted errors
+        std : np.ndarray, shape (n_points,)
+            The standard deviations of the predictions
+        """
+        K_star = self._kernel(np.asarray(X, dtype=float), self.X,
+                              self.length_scale)
+        mean = K_star.dot(self._alpha)
+        v = cho_solve(self._factor, K_star.T)
+        var = np.clip(1. - np.sum(K_star * v.T, axis=1), 0., None)
+
+        return (mean * self.y_std + self.y_mean,
+                np.sqrt(var) * self.y_std)
+
+
+def expected_improvement(mean, std, best_err, xi=0.):
+    """The expected improvement over best_err of predicted errors
+
+    Parameters
+    ----------
+    mean : np.ndarray
+        The predicted errors
+    std : np.ndarray
+        The standard deviations of the predictions
+    best_err : float
+        The lowest error evaluated so far
+    xi : float
+        The minimum improvement that counts
+
+    Returns
+    -------
+    ei : np.ndarray
+        The expected improvement of each prediction
+    """
+    improvement = best_err - mean - xi
+    ei = np.where(improvement > 0, improvement, 0.)
+    has_std = std > 0
+    z = improvement[has_std] / std[has_std]
+    ei[has_std] = improvement[has_std] * ndtr(z) + \
+        std[has_std] * np.exp(-0.5 * z ** 2) / np.sqrt(2 * np.pi)
+
+    return ei
+
+
+class SurrogateOptimizer(object):
+    """The SurrogateOptimizer class.
+
+    Bayesian optimization with an ask/tell interface. A Gaussian process is
+    fitted to the errors of all evaluations, and new candidates are the
+    points with the highest expected improvement. Batches are chosen one
+    point at a time by assuming that the chosen points have their predicted
+    error ("kriging believer").
+
+    Parameters
+    ----------
+    lb : array-like of float
+        Lower bound of each parameter
+    ub : array-like of float
+        Upper bound of each parameter
+    x0 : array-like of float
+        The initial parameter values, which are evaluated first
+    n_init : int | None
+        The number of evaluations (including x0) of Latin hypercube samples
+        before the surrogate is used. If None, the number of parameters + 1.
+    n_samples : int
+        The number of random points to search for the highest expected
+        improvement
+    ei_tol : float
+        Converged when the highest expected improvement is below ei_tol
+        times the range of evaluated errors
+    seed : int | None
+        Seed for the random number generator
+
+    Attributes
+    ----------
+    X : np.ndarray, shape (n_evals, n_params)
+        The evaluated parameters
+    y : np.ndarray, shape (n_evals,)
+        The error of each evaluation
+    converged : bool
+        Whether the last call to ask() found no candidate that is expected to
+        improve the error significantly
+    """
+    def __init__(self, lb, ub, x0, n_init=None, n_samples=2000, ei_tol=1e-4,
+                 seed=None):
+        self.lb = np.asarray(lb, dtype=float)
+        self.ub = np.asarray(ub, dtype=float)
+        x0 = np.asarray(x0, dtype=float)
+        if self.lb.shape != self.ub.shape or self.lb.shape != x0.shape:
+            raise ValueError("lb, ub and x0 must have the same length")
+        if np.any(self.lb >= self.ub):
+            raise ValueError("lb must be less than ub")
+
+        n_params = len(x0)
+        if n_params == 0:
+            raise ValueError("At least one parameter is needed")
+        if n_init is None:
+            n_init = n_params + 1
+        self.n_init = max(1, n_init)
+        self.n_samples = n_samples
+        self.ei_tol = ei_tol
+        self.seed = seed
+        self.x0 = np.clip(x0, self.lb, self.ub)
+        self.X = np.empty((0, n_params))
+        self.y = np.empty(0)
+        self.converged = False
+        self.surrogate = GPSurrogate()
+
+        rng = np.random.RandomState(seed)
+        unit = _latin_hypercube(rng, self.n_init - 1, n_params)
+        self.initial_design = np.vstack([self.x0, self._from_unit(unit)])
+
+    def _to_unit(self, X):
+        return (X - self.lb) / (self.ub - self.lb)
+
+    def _from_unit(self, unit):
+        return self.lb + unit * (self.ub - self.lb)
+
+    @property
+    def n_evals(self):
+        return len(self.y)
+
+    @property
+    def best_x(self):
+        if self.n_evals == 0:
+            return None
+        return self.X[np.argmin(self.y)].copy()
+
+    @property
+    def best_err(self):
+        if self.n_evals == 0:
+            return np.inf
+        return np.min(self.y)
+
+    def ask(self, n_candidates=1):
+        """Propose the next candidates to evaluate
+
+        Parameters
+        ----------
+        n_candidates : int
+            The number of candidates to evaluate concurrently
+
+        Returns
+        -------
+        candidates : np.ndarray, shape (n_candidates, n_params)
+            The parameters to evaluate. Empty if converged.
+        """
+        if self.n_evals < self.n_init:
+            return self.initial_design[self.n_evals:
+                                       self.n_evals + n_candidates].copy()
+
+        # the random points depend on the evaluations so far, so a resumed
+        # optimization proposes the same candidates
+        seed = None if self.seed is None else self.seed + self.n_evals
+        rng = np.random.RandomState(seed)
+        n_params = self.X.shape[1]
+        best_unit = self._to_unit(self.best_x)
+        local = best_unit + 0.05 * rng.normal(size=(self.n_samples // 2,
+                                                    n_params))
+        points = np.vstack([rng.uniform(size=(self.n_samples - len(local),
+                                              n_params)),
+                            np.clip(local, 0., 1.)])
+
+        X_unit = self._to_unit(self.X)
+        y = self.y.copy()
+        err_range = np.ptp(self.y)
+        candidates = list()
+        for candidate_idx in range(n_candidates):
+            self.surrogate.fit(X_unit, y)
+            mean, std = self.surrogate.predict(points)
+            ei = expected_improvement(mean, std, self.best_err)
+            best_idx = np.argmax(ei)
+            if candidate_idx == 0:
+                self.converged = ei[best_idx] <= self.ei_tol * err_range
+                if self.converged:
+                    break
+
+            # believe the prediction while choosing the rest of the batch
+            candidates.append(points[best_idx])
+            X_unit = np.vstack([X_unit, points[best_idx]])
+            y = np.r_[y, mean[best_idx]]
+            points = np.delete(points, best_idx, axis=0)
+
+        return self._from_unit(np.array(candidates).reshape(-1, n_params))
+
+    def tell(self, candidates, errors):
+        """Add the errors of evaluated candidates
+
+        Parameters
+        ----------
+        candidates : np.ndarray, shape (n_evaluated, n_params)
+            The evaluated parameters
+        errors : array-like of float, shape (n_evaluated,)
+            The error of each candidate
+        """
+        candidates = np.atleast_2d(np.asarray(candidates, dtype=float))
+        errors = np.asarray(errors, dtype=float)
+        if len(candidates) != len(errors):
+            raise ValueError("Got %d candidates but %d errors" %
+                             (len(candidates), len(errors)))
+
+        self.X = np.vstack([self.X, candidates])
+        self.y = np.r_[self.y, errors]
+
+    def get_state(self):
+        """The evaluations so far, for resuming the optimization later"""
+        return {'X': self.X.tolist(), 'y': self.y.tolist()}
+
+    def set_state(self, state):
+        """Resume the optimization from the state returned by get_state()"""
+        X = np.asarray(state['X'], dtype=float).reshape(-1, len(self.x0))
+        self.X = X
+        self.y = np.asarray(state['y'], dtype=float)
+
+
+def quantize(value, rtol):
+    """Round a parameter value to a relative precision
+
+    Parameters
+    ----------
+    value : float
+        The parameter value
+    rtol : float
+        The relative precision, rounded to a power of ten. If 0, value is
+        returned unchanged.
+
+    Returns
+    -------
+    value : float
+        The value rounded to the precision
+    """
+    if rtol <= 0:
+        return float(value)
+    n_digits = max(0, int(round(-log10(rtol))))
+    return float('%.*e' % (n_digits, value))
+
+
+class EvalMemo(object):
+    """The EvalMemo class.
+
+    Remembers the average dipoles of the simulations evaluated by the
+    optimizer and the errors calculated from them, which is all that the
+    objective needs. Points that are nearly identical after quantize() are
+    evaluated only once, even across optimization steps. The full results
+    are only kept for the best evaluation, by the optimization.
+
+    Parameters
+    ----------
+    rtol : float
+        The relative precision of the parameter values that identify an
+        evaluation
+    max_entries : int
+        The maximum number of evaluations to remember. The least recently
+        used are forgotten first.
+    max_bytes : int | None
+        The maximum memory used by the dipoles of the evaluations. If None,
+        only max_entries limits it.
+
+    Attributes
+    ----------
+    rtol : float
+        The relative precision of the parameter values that identify an
+        evaluation
+    max_entries : int
+        The maximum number of evaluations to remember
+    max_bytes : int | None
+        The maximum memory used by the dipoles of the evaluations
+    nbytes : int
+        The memory used by the dipoles of the evaluations
+    hits : int
+        Number of lookups that returned a result
+    misses : int
+        Number of lookups that did not return a result
+    """
+
+    def __init__(self, rtol=1e-4, max_entries=200, max_bytes=64 * 1024 ** 2):
+        self.rtol = rtol
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Look up the average dipole of an evaluation
+
+        Parameters
+        ----------
+        key : str
+            Identifies the simulation, with the parameters being optimized
+            rounded by quantize()
+
+        Returns
+        -------
+        avg_dpl : Dipole | None
+            The post-processed average dipole of the simulation or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry['avg_dpl']
+
+    def put(self, key, avg_dpl):
+        """Remember the average dipole of an evaluation
+
+        Parameters
+        ----------
+        key : str
+            Identifies the simulation, as for get()
+        avg_dpl : Dipole
+            The post-processed average dipole of the simulation. It must not
+            be modified after this.
+        """
+        nbytes = avg_dpl.times.nbytes + sum(
+            [np.asarray(layer).nbytes for layer in avg_dpl.data.values()])
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)['nbytes']
+            self._entries[key] = {'avg_dpl': avg_dpl, 'errors': dict(),
+                                  'nbytes': nbytes}
+            self.nbytes += nbytes
+            # the latest evaluation is always kept
+            while len(self._entries) > 1 and \
+                    (len(self._entries) > self.max_entries or
+                     (self.max_bytes is not None and
+                      self.nbytes > self.max_bytes)):
+                _, entry = self._entries.popitem(last=False)
+                self.nbytes -= entry['nbytes']
+
+    def get_error(self, key, err_key):
+        """The error of an evaluation or None if it wasn't calculated
+
+        Parameters
+        ----------
+        key : str
+            Identifies the simulation, as for get()
+        err_key : str
+            Identifies how the error is calculated (window, weights and
+            data)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return entry['errors'].get(err_key)
+
+    def put_error(self, key, err_key, err):
+        """Remember the error of an evaluation that was put()"""
+        with self._lock:
+            if key in self._entries:
+                self._entries[key]['errors'][err_key] = err
+
+    def clear(self):
+        """Forget all evaluations"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def status(self):
+        """Return a one-line summary of memo hits, misses and memory"""
+        return "Evaluation memo: %d hits, %d misses, %.1f MB" % \
+            (self.hits, self.misses, self.nbytes / 1024 ** 2)
+
+
+def read_opt_state(fname, key):
+    """Read the saved state of an optimization step
+
+    Parameters
+    ----------
+    fname : str
+        Full path of the JSON file of the state
+    key : str
+        Identifies the optimization step (parameters, ranges and weights)
+
+    Returns
+    -------
+    state : dict | None
+        The state or None if there is no saved state for the same step
+    """
+    try:
+        with open(fname, 'r') as fp:
+            saved = json.load(fp)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        print("Warning: ignoring unreadable optimization state %s" % fname)
+        return None
+
+    if saved.get('key') != key:
+        return None
+    return saved['state']
+
+
+def write_opt_state(fname, key, state):
+    """Save the state of an optimization step, replacing any earlier one
+
+    Parameters
+    ----------
+    fname : str
+        Full path of the JSON file of the state
+    key : str
+        Identifies the optimization step (parameters, ranges and weights)
+    state : dict
+        The state of the optimization
+    """
+    tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp_fname, 'w') as fp:
+        json.dump({'key': key, 'state': state}, fp)
+    os.replace(tmp_fname, fname)
+
+
+def get_batches(n_candidates, batch_size):
+    """Split candidates into batches to simulate concurrently
+
+    Parameters
+    ----------
+    n_candidates : int
+        The number of candidates
+    batch_size : int
+        The maximum number of candidates in a batch
+
+    Returns
+    -------
+    batches : list of range
+        The indices of the candidates in each batch
+    """
+    return [range(start, min(start + batch_size, n_candidates))
+            for start in range(0, n_candidates, batch_size)]
@@ -5,6 +5,7 @@
 # last major: (SL: cleanup of self.p_all)
 
 import os
+import json
 import numpy as np
 import re
 
@@ -55,9 +56,10 @@ def get_fname(sim_dir, key, trial=None):
                  'figspec': ('rawspec', '.png'),
                  'figspk': ('spk', '.png'),
                  'param': ('param', '.txt'),
-                 'vsoma': ('vsoma', '.pkl')}
+                 'vsoma': ('vsoma', '.pkl'),
+                 'simfile': ('results', '.hnn')}
 
-    if trial is None or key == 'param':
+    if trial is None or key in ('param', 'simfile'):
         # param file currently identical for all trials
         fname = os.path.join(sim_dir, datatypes[key][0] + datatypes[key][1])
     else:
@@ -67,6 +69,67 @@ def get_fname(sim_dir, key, trial=None):
     return fname
 
 
+# how results are saved. These aren't simulation parameters, which hnn_core's
+# Params would drop, so they are settings of the output directory
+_OUTPUT_SETTINGS = {'legacy_files': True, 'spec_scale': 'linear',
+                    'spec_f_min': 1., 'spec_n_freqs': None,
+                    'spec_freqs': None, 'spec_dtype': 'float64'}
+
+
+def read_output_settings():
+    """Read the settings of saving results in the output directory
+
+    Returns
+    ----------
+    settings : dict
+        The settings, with defaults for those that are not in the settings
+        file. 'legacy_files' is whether a file is written for each trial
+        of each kind of result, in addition to the results file. The
+        frequencies of spectral analysis are 'spec_freqs' if it's a list,
+        and otherwise a 'spec_scale' grid ('linear' or 'log') from
+        'spec_f_min' with 'spec_n_freqs' frequencies if it's 'log'. Their
+        precision is 'spec_dtype' ('float64' or 'float32'). See
+        specfn.get_spec_options.
+    """
+    settings = dict(_OUTPUT_SETTINGS)
+    fname = os.path.join(get_output_dir(), 'hnn_settings.json')
+    if not os.path.exists(fname):
+        return settings
+
+    try:
+        with open(fname, 'r') as f:
+            saved = json.load(f)
+    except (OSError, ValueError) as err:
+        print("Warning: could not read file: %s (%s)" % (fname, err))
+        return settings
+    for key, val in saved.items():
+        if key not in settings:
+            print("Warning: unknown setting %s in %s" % (key, fname))
+            continue
+        settings[key] = val
+
+    return settings
+
+
+def write_output_settings(settings):
+    """Write the settings of saving results in the output directory
+
+    Parameters
+    ----------
+    settings : dict
+        The settings to change. Others keep their saved values.
+    """
+    for key in settings:
+        if key not in _OUTPUT_SETTINGS:
+            raise ValueError("Unknown setting: %s" % key)
+
+    new_settings = read_output_settings()
+    new_settings.update(settings)
+    os.makedirs(get_output_dir(), exist_ok=True)
+    with open(os.path.join(get_output_dir(), 'hnn_settings.json'), 'w') as f:
+        json.dump(new_settings, f, indent=2)
+
+
 def get_inputs(params):
     """ get a dictionary of input types used in simulation
         with distal/proximal specificity for evoked,ongoing inputs
@@ -15,7 +15,8 @@ from PyQt5.QtGui import QFont, QPixmap, QIcon
 from hnn_core import read_params, Params
 
 from .paramrw import (usingOngoingInputs, usingEvokedInputs, get_output_dir,
-                      legacy_param_str_to_dict)
+                      legacy_param_str_to_dict, read_output_settings,
+                      write_output_settings)
 from .qt_lib import (setscalegeom, setscalegeomcenter, lookupresource,
                      ClickLabel)
 from .qt_evoked import EvokedInputParamDialog, OptEvokedInputParamDialog
@@ -543,6 +544,23 @@ class RunParamDialog(DictDialog):
         self.dqextra['NumCores'].setText(str(self.mainwin.defncore))
         self.addtransvar('NumCores', 'Number Cores')
         self.ltabs[0].layout.addRow('NumCores', self.dqextra['NumCores'])
+        self.dqextra['TrialGroups'] = QLineEdit(self)
+        self.dqextra['TrialGroups'].setText(str(self.mainwin.ntrialgroups))
+        self.dqextra['TrialGroups'].setToolTip(
+            'Number of groups of trials to simulate concurrently. The cores'
+            ' are divided between groups')
+        self.addtransvar('TrialGroups', 'Concurrent Trial Groups')
+        self.ltabs[0].layout.addRow('TrialGroups',
+                                    self.dqextra['TrialGroups'])
+        self.dqextra['Checkpoint'] = QLineEdit(self)
+        self.dqextra['Checkpoint'].setText(str(self.mainwin.checkpointsim))
+        self.dqextra['Checkpoint'].setToolTip(
+            'Set to 1 to save the simulator state at the end of each'
+            ' simulation and to continue from it when only tstop or the'
+            ' number of trials was increased. Each trial is then simulated'
+            ' on one core, so at most as many cores as trials are used')
+        self.addtransvar('Checkpoint', 'Continue From Checkpoint')
+        self.ltabs[0].layout.addRow('Checkpoint', self.dqextra['Checkpoint'])
 
         self.spec_cmap_cb = None
 
@@ -560,6 +578,34 @@ class RunParamDialog(DictDialog):
         self.ltabs[1].layout.addRow(
             self.transvar('spec_cmap'), self.spec_cmap_cb)
 
+        # settings of the output directory, which aren't params
+        self.spec_scale_cb = QComboBox()
+        for scale in ['linear', 'log']:
+            self.spec_scale_cb.addItem(scale)
+        self.spec_scale_cb.setToolTip(
+            'Frequencies of spectral analysis 1 Hz apart from 1 Hz, or'
+            ' logarithmically spaced')
+        self.addtransvar('spec_scale', 'Spectral Frequency Scale')
+        self.ltabs[1].layout.addRow(
+            self.transvar('spec_scale'), self.spec_scale_cb)
+        self.spec_dtype_cb = QComboBox()
+        for dtype in ['float64', 'float32']:
+            self.spec_dtype_cb.addItem(dtype)
+        self.spec_dtype_cb.setToolTip(
+            'float32 computes and saves spectral analysis in half the'
+            ' memory')
+        self.addtransvar('spec_dtype', 'Spectral Precision')
+        self.ltabs[1].layout.addRow(
+            self.transvar('spec_dtype'), self.spec_dtype_cb)
+        self.dqextra['LegacyFiles'] = QLineEdit(self)
+        self.dqextra['LegacyFiles'].setToolTip(
+            'Set to 0 to save only the results file of each simulation,'
+            ' without a file for each trial of each kind of result')
+        self.addtransvar('LegacyFiles', 'Save Files of Trials')
+        self.ltabs[1].layout.addRow('LegacyFiles',
+                                    self.dqextra['LegacyFiles'])
+        self.setoutputsettings()
+
     def getntrial(self):
         ntrial = int(self.dqline['N_trials'].text().strip())
         if ntrial < 1:
@@ -578,6 +624,49 @@ class RunParamDialog(DictDialog):
 
         return ncore
 
+    def getntrialgroups(self):
+        ntrialgroups = int(self.dqextra['TrialGroups'].text().strip())
+        if ntrialgroups < 1:
+            self.dqextra['TrialGroups'].setText(str(1))
+            ntrialgroups = 1
+
+        # update value in HNNGUI for persistence
+        self.mainwin.ntrialgroups = ntrialgroups
+
+        return ntrialgroups
+
+    def getcheckpoint(self):
+        checkpointsim = int(self.dqextra['Checkpoint'].text().strip())
+        if checkpointsim not in (0, 1):
+            self.dqextra['Checkpoint'].setText(str(0))
+            checkpointsim = 0
+
+        # update value in HNNGUI for persistence
+        self.mainwin.checkpointsim = checkpointsim
+
+        return checkpointsim
+
+    def setoutputsettings(self):
+        """Show the settings of the output directory"""
+        settings = read_output_settings()
+        self.spec_scale_cb.setCurrentIndex(
+            self.spec_scale_cb.findText(settings['spec_scale']))
+        self.spec_dtype_cb.setCurrentIndex(
+            self.spec_dtype_cb.findText(settings['spec_dtype']))
+        self.dqextra['LegacyFiles'].setText(
+            str(int(settings['legacy_files'])))
+
+    def saveoutputsettings(self):
+        """Save the settings of the output directory"""
+        legacy_files = int(self.dqextra['LegacyFiles'].text().strip())
+        if legacy_files not in (0, 1):
+            self.dqextra['LegacyFiles'].setText(str(1))
+            legacy_files = 1
+
+        write_output_settings({'legacy_files': bool(legacy_files),
+                               'spec_scale': self.spec_scale_cb.currentText(),
+                               'spec_dtype': self.spec_dtype_cb.currentText()})
+
     def get_prng_seedcore_opt(self):
         prng_seedcore_opt = self.dqline['prng_seedcore_opt'].text().strip()
 
@@ -592,6 +681,9 @@ class RunParamDialog(DictDialog):
 
         # number of cores may have changed if the configured number failed
         self.dqextra['NumCores'].setText(str(self.mainwin.defncore))
+        self.dqextra['TrialGroups'].setText(str(self.mainwin.ntrialgroups))
+        self.dqextra['Checkpoint'].setText(str(self.mainwin.checkpointsim))
+        self.setoutputsettings()
 
         # update ordered dict of QLineEdit objects with new parameters
         for k, v in din.items():
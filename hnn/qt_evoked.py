@@ -11,7 +11,7 @@ import re
 
 from PyQt5.QtWidgets import QPushButton, QTabWidget, QWidget, QDialog
 from PyQt5.QtWidgets import QGridLayout, QLabel, QFrame, QSpacerItem
-from PyQt5.QtWidgets import QCheckBox, QSizePolicy, QLineEdit
+from PyQt5.QtWidgets import QCheckBox, QSizePolicy, QLineEdit, QComboBox
 from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QFormLayout
 from PyQt5.QtGui import QPixmap
 from PyQt5.QtCore import Qt
@@ -22,6 +22,12 @@ from .paramrw import _get_ordered_param_inputs
 
 decay_multiplier = 1.6
 
+# optimization algorithms and their names in the GUI
+_OPT_ALGORITHMS = [('cobyla', 'COBYLA (one simulation at a time)'),
+                   ('de', 'Differential evolution (concurrent simulations)'),
+                   ('surrogate', 'Gaussian process surrogate (fewer'
+                    ' simulations)')]
+
 
 def _consolidate_chunks(input_dict):
     # MOVE to hnn-core
@@ -649,6 +655,8 @@ class OptEvokedInputParamDialog (EvokedInputBaseDialog):
         self.sim_dt = 0.0
         self.default_num_step_sims = 30
         self.default_num_total_sims = 50
+        self.default_num_concurrent = 4
+        self.default_memo_tolerance = 1e-4
         self.mainwin = mainwin
         self.optimization_running = False
         self.initUI()
@@ -674,6 +682,32 @@ class OptEvokedInputParamDialog (EvokedInputBaseDialog):
         row += 1
         self.grid.addWidget(self.tabs, row, 0)
 
+        row += 1
+        algorithm_layout = QHBoxLayout()
+        algorithm_layout.addWidget(QLabel("Algorithm:"))
+        self.opt_algorithm_cb = QComboBox()
+        for _, algorithm_name in _OPT_ALGORITHMS:
+            self.opt_algorithm_cb.addItem(algorithm_name)
+        algorithm_layout.addWidget(self.opt_algorithm_cb)
+        algorithm_layout.addWidget(QLabel("Concurrent simulations:"))
+        self.qconcurrent = QLineEdit(str(self.default_num_concurrent))
+        self.qconcurrent.setToolTip(
+            'Number of parameter sets simulated at the same time by'
+            ' differential evolution or the surrogate. The cores are divided'
+            ' between them. A step starting after 0 ms reuses its simulation'
+            ' up to the start only if each trial is simulated on one core,'
+            ' so such steps may instead simulate as many parameter sets at a'
+            ' time as there are cores, when that is estimated to be faster')
+        algorithm_layout.addWidget(self.qconcurrent)
+        algorithm_layout.addWidget(QLabel("Memo tolerance:"))
+        self.qmemotol = QLineEdit(str(self.default_memo_tolerance))
+        self.qmemotol.setToolTip(
+            'Relative precision of the parameter values that identify a'
+            ' simulation. Nearly identical simulations of this session are'
+            ' not run again')
+        algorithm_layout.addWidget(self.qmemotol)
+        self.grid.addLayout(algorithm_layout, row, 0)
+
         row += 1
         self.btnrunop = QPushButton('Run Optimization', self)
         self.btnrunop.resize(self.btnrunop.sizeHint())
@@ -1062,6 +1096,31 @@ class OptEvokedInputParamDialog (EvokedInputBaseDialog):
     def get_num_chunks(self):
         return len(self.chunk_list)
 
+    def get_opt_algorithm(self):
+        return _OPT_ALGORITHMS[self.opt_algorithm_cb.currentIndex()][0]
+
+    def get_num_concurrent_sims(self):
+        try:
+            num_concurrent = int(self.qconcurrent.text())
+        except ValueError:
+            num_concurrent = self.default_num_concurrent
+        if num_concurrent < 1:
+            num_concurrent = 1
+        self.qconcurrent.setText(str(num_concurrent))
+
+        return num_concurrent
+
+    def get_memo_tolerance(self):
+        try:
+            memo_tolerance = float(self.qmemotol.text())
+        except ValueError:
+            memo_tolerance = self.default_memo_tolerance
+        if memo_tolerance < 0:
+            memo_tolerance = 0.
+        self.qmemotol.setText(str(memo_tolerance))
+
+        return memo_tolerance
+
     def get_sims_for_chunk(self, step):
         try:
             num_sims = int(self.lqnumsim[step].text())
@@ -7,39 +7,38 @@
 # Python builtins
 import sys
 import os
-import multiprocessing
-import numpy as np
 import traceback
-from copy import deepcopy
-from psutil import cpu_count
 
 # External libraries
 from PyQt5.QtWidgets import (QMainWindow, QAction, qApp, QApplication,
                              QFileDialog, QComboBox, QToolTip, QPushButton,
                              QGridLayout, QInputDialog, QMenu, QMessageBox,
-                             QWidget, QLayout)
+                             QWidget, QLayout, QLabel)
 from PyQt5.QtGui import QIcon, QFont
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT
 import matplotlib.pyplot as plt
 
 from hnn_core import read_params
-from hnn_core.dipole import average_dipoles
 
 # HNN modules
 from .qt_dialog import (BaseParamDialog, EvokedOrRhythmicDialog,
                         WaitSimDialog, HelpDialog, SchematicDialog,
                         bringwintotop)
 from .qt_evoked import OptEvokedInputParamDialog
-from .paramrw import (usingOngoingInputs, get_output_dir,
-                      write_gids_param, get_fname)
+from .paramrw import get_output_dir, read_output_settings
 from .simdata import SimData
+from .expdata import read_exp_data
 from .qt_sim import SIMCanvas
 from .qt_thread import SimThread, OptThread, _add_missing_frames
+from .mpi_pool import MPIPoolBackend, TrialGroupBackend, _has_mpi4py
+from .simcache import SimResultCache
+from .optfn import EvalMemo
+from .simfn import get_defncore, postproc_dipoles, write_sim_data
+from .specfn import get_spec_options
 from .qt_lib import (getmplDPI, getscreengeom, lookupresource,
                      setscalegeomcenter)
-from .specfn import spec_dpl_kernel, save_spec_data
 from .DataViewGUI import DataViewGUI
 from .qt_dipole import DipoleCanvas
 from .qt_vsoma import VSomaViewGUI, VSomaCanvas
@@ -52,21 +51,6 @@ drawavgdpl = 0
 fontsize = plt.rcParams['font.size'] = 10
 
 
-def _get_defncore():
-    """get default number of cores """
-
-    try:
-        defncore = len(os.sched_getaffinity(0))
-    except AttributeError:
-        defncore = cpu_count(logical=False)
-
-    if defncore is None or defncore == 0:
-        # in case psutil is not supported (e.g. BSD)
-        defncore = multiprocessing.cpu_count()
-
-    return defncore
-
-
 def isWindows():
     # are we on windows? or linux/mac ?
     return sys.platform.startswith('win')
@@ -108,9 +92,16 @@ class HNNGUI(QMainWindow):
         relative_root_path = os.path.join(os.path.dirname(__file__), '..')
         hnn_root_dir = os.path.realpath(relative_root_path)
 
-        self.defncore = _get_defncore()
+        self.defncore = get_defncore()
         self.runningsim = False
         self.runthread = None
+        self.sim_pools = {}
+        self.ntrialgroups = 1
+        self.checkpointsim = 0
+        self.sim_cache = SimResultCache()
+        # evaluations of optimizations, kept across optimizations
+        self.opt_memo = EvalMemo()
+        qApp.aboutToQuit.connect(self.shutdown_sim_pool)
         self.fontsize = fontsize
         self.linewidth = plt.rcParams['lines.linewidth'] = 1
         self.markersize = plt.rcParams['lines.markersize'] = 5
@@ -120,7 +111,9 @@ class HNNGUI(QMainWindow):
         self.prng_seedcore_opt = 0
         self.baseparamwin = BaseParamDialog(self, paramfn)
         self.is_optimization = False
-        self.sim_data = SimData()
+        # simulations beyond this are spilled to disk (MB)
+        self.sim_memory_budget = 2048
+        self.sim_data = SimData(self.sim_memory_budget * 1024 ** 2)
         self.initUI()
         self.helpwin = HelpDialog(self)
         self.erselectdistal = \
@@ -179,6 +172,20 @@ class HNNGUI(QMainWindow):
             self.linewidth = plt.rcParams['lines.linewidth'] = i
             self.redraw()
 
+    def changeMemoryBudget(self):
+        """bring up window to change the memory budget of simulations"""
+        i, ok = QInputDialog.getInt(self, "Set Memory Budget",
+                                    "Memory for simulations (MB):",
+                                    self.sim_memory_budget, 1, 1024 ** 2, 256)
+        if ok:
+            self.sim_memory_budget = i
+            self.sim_data.set_max_bytes(i * 1024 ** 2)
+            self.updateMemoryUsage()
+
+    def updateMemoryUsage(self):
+        """show the memory used by simulations in the status bar"""
+        self.memlabel.setText(self.sim_data.memory_status())
+
     def changeMarkerSize(self):
         """bring up window to change marker size"""
         i, ok = QInputDialog.getInt(self, "Set Marker Size", "Font Size:",
@@ -240,16 +247,11 @@ class HNNGUI(QMainWindow):
 
         extdata = None
         try:
-            extdata = np.loadtxt(fn)
+            extdata = read_exp_data(fn)
         except ValueError:
-            # possible that data file is comma delimited instead of whitespace
-            # delimited
-            try:
-                extdata = np.loadtxt(fn, delimiter=',')
-            except ValueError:
-                QMessageBox.information(self, "HNN", "WARNING: could not load"
-                                        "  data file %s" % fn)
-                return False
+            QMessageBox.information(self, "HNN", "WARNING: could not load"
+                                    "  data file %s" % fn)
+            return False
         except IsADirectoryError:
             QMessageBox.information(self, "HNN", "WARNING: could not load data"
                                     " file %s" % fn)
@@ -521,6 +523,12 @@ class HNNGUI(QMainWindow):
         self.sim_canvas.draw()
         self.setWindowTitle('')
 
+    def clearSimCache(self):
+        """remove all cached simulation results"""
+        self.sim_cache.clear()
+        self.opt_memo.clear()
+        self.statusBar().showMessage("Cleared simulation result cache")
+
     def initMenu(self):
         """initialize the GUI's menu"""
         exitAction = QAction(QIcon.fromTheme('exit'), 'Exit', self)
@@ -599,6 +607,17 @@ class HNNGUI(QMainWindow):
         clearDataFileAct2.triggered.connect(self.clearDataFile)
         editMenu.addAction(clearDataFileAct2)
         editMenu.addAction(clearCanv)
+        clearCacheAct = QAction('Clear simulation result cache', self)
+        clearCacheAct.setStatusTip('Remove cached results so that all'
+                                   ' simulations are run again')
+        clearCacheAct.triggered.connect(self.clearSimCache)
+        editMenu.addAction(clearCacheAct)
+        memoryBudgetAct = QAction('Set Memory Budget', self)
+        memoryBudgetAct.setStatusTip('Set the memory for simulations. Least'
+                                     ' recently viewed ones beyond it are'
+                                     ' moved to disk')
+        memoryBudgetAct.triggered.connect(self.changeMemoryBudget)
+        editMenu.addAction(memoryBudgetAct)
 
         # view menu - to view drawing/visualizations
         viewMenu = self.menubar.addMenu('&View')
@@ -766,6 +785,12 @@ class HNNGUI(QMainWindow):
 
         self.initMenu()
         self.statusBar()
+        self.memlabel = QLabel()
+        self.statusBar().addPermanentWidget(self.memlabel)
+        # not a child, which setcursors() expects to be widgets
+        self.memtimer = QTimer()
+        self.memtimer.timeout.connect(self.updateMemoryUsage)
+        self.memtimer.start(2000)
 
         # start GUI in center of screenm, scale based on screen w x h
         setscalegeomcenter(self, 1500, 1300)
@@ -920,6 +945,7 @@ class HNNGUI(QMainWindow):
         # write_legacy_paramf(param_out, self.params)
         seed = self.baseparamwin.runparamwin.get_prng_seedcore_opt()
         ncore = self.baseparamwin.runparamwin.getncore()
+        self.baseparamwin.runparamwin.saveoutputsettings()
         self.runthread = OptThread(ncore, self.baseparamwin.params,
                                    num_steps,
                                    seed, self.sim_data,
@@ -995,6 +1021,11 @@ class HNNGUI(QMainWindow):
                   " Setting to 1.")
             self.baseparamwin.params['N_trials'] = 1
 
+        # groups of trials can be simulated concurrently
+        self.baseparamwin.runparamwin.getntrialgroups()
+        self.baseparamwin.runparamwin.getcheckpoint()
+        self.baseparamwin.runparamwin.saveoutputsettings()
+
         self.runthread = SimThread(ncore, self.baseparamwin.params,
                                    self.sim_result_callback, mainwin=self)
 
@@ -1007,64 +1038,52 @@ class HNNGUI(QMainWindow):
 
         bringwintotop(self.waitsimwin)
 
-    def sim_result_callback(self, result):
-        sim_data = result.data
-        sim_data['spec'] = []
-        params = result.params
+    def get_sim_pool(self, ncore, n_trial_groups=1):
+        """get the MPI worker pool, (re)creating it for ncore cores
 
-        sim_data['dpls'] = deepcopy(sim_data['raw_dpls'])
-        ntrial = len(sim_data['raw_dpls'])
-        for trial_idx in range(ntrial):
-            window_len = params['dipole_smooth_win']  # specified in ms
-            fctr = params['dipole_scalefctr']
-            if window_len > 0:  # param files set this to zero for no smoothing
-                sim_data['dpls'][trial_idx].smooth(window_len=window_len)
-            if fctr > 0:
-                sim_data['dpls'][trial_idx].scale(fctr)
-
-        # save average dipole from individual trials in a single file
-        if ntrial > 1:
-            sim_data['avg_dpl'] = average_dipoles(sim_data['dpls'])
-        elif ntrial == 1:
-            sim_data['avg_dpl'] = sim_data['dpls'][0]
-        else:
-            raise ValueError("No dipole(s) returned from simulation")
-
-        # make sure the directory for saving data has been created
-        data_dir = os.path.join(get_output_dir(), 'data')
-        sim_dir = os.path.join(data_dir, params['sim_prefix'])
-        try:
-            os.mkdir(sim_dir)
-        except FileExistsError:
-            pass
-
-        # TODO: Can below be removed if spk.txt is new hnn-core format with 3
-        # columns (including spike type)?
-        # Follow https://github.com/jonescompneurolab/hnn-core/issues/219
-        write_gids_param(get_fname(sim_dir, 'param'), sim_data['gid_ranges'])
+        The ranks of the pool stay resident for the whole session, so
+        simulations and optimization steps don't pay for launching mpiexec
+        and loading NEURON every time. With more than one group of trials,
+        the groups are simulated concurrently by separate pools.
+        """
+        if n_trial_groups > 1 and not _has_mpi4py():
+            print("Warning: mpi4py not installed. Cannot simulate groups of"
+                  " trials concurrently")
+            n_trial_groups = 1
+
+        pool_config = (ncore, n_trial_groups)
+        if pool_config not in self.sim_pools:
+            if n_trial_groups > 1:
+                pool = TrialGroupBackend(n_groups=n_trial_groups,
+                                         n_procs=ncore, mpi_cmd='mpiexec')
+            else:
+                pool = MPIPoolBackend(n_procs=ncore, mpi_cmd='mpiexec')
 
-        # save spikes by trial
-        glob = os.path.join(sim_dir, 'spk_%d.txt')
-        sim_data['spikes'].write(glob)
+            # keep at most one pool of each kind running
+            for other_config in list(self.sim_pools.keys()):
+                if (other_config[1] > 1) == (n_trial_groups > 1):
+                    self.sim_pools.pop(other_config).shutdown()
+            self.sim_pools[pool_config] = pool
 
-        # save dipole for each trial and perform spectral analysis
-        for trial_idx, dpl in enumerate(sim_data['dpls']):
-            dipole_fn = get_fname(sim_dir, 'normdpl', trial_idx)
-            dpl.write(dipole_fn)
+        return self.sim_pools[pool_config]
 
-            if params['save_dpl']:
-                raw_dipole_fn = get_fname(sim_dir, 'rawdpl', trial_idx)
-                sim_data['raw_dpls'][trial_idx].write(raw_dipole_fn)
+    def shutdown_sim_pool(self):
+        """stop the MPI ranks of the worker pools"""
+        for pool in self.sim_pools.values():
+            pool.shutdown()
+        self.sim_pools.clear()
 
-            if params['save_spec_data'] or \
-                    usingOngoingInputs(params):
-                spec_results = spec_dpl_kernel(dpl, params['f_max_spec'],
-                                               params['dt'], params['tstop'])
-                sim_data['spec'].append(spec_results)
+    def sim_result_callback(self, result):
+        sim_data = result.data
+        params = result.params
 
-                if params['save_spec_data']:
-                    spec_fn = get_fname(sim_dir, 'rawspec', trial_idx)
-                    save_spec_data(spec_fn, spec_results)
+        postproc_dipoles(sim_data, params)
+        settings = read_output_settings()
+        spec_freqs, spec_dtype = get_spec_options(settings,
+                                                  params['f_max_spec'])
+        write_sim_data(sim_data, params, spec_freqs=spec_freqs,
+                       spec_dtype=spec_dtype,
+                       legacy_files=settings['legacy_files'])
 
         paramfn = os.path.join(get_output_dir(), 'param',
                                params['sim_prefix'] + '.param')
@@ -1072,7 +1091,8 @@ class HNNGUI(QMainWindow):
         self.sim_data.update_sim_data(paramfn, params, sim_data['dpls'],
                                       sim_data['avg_dpl'], sim_data['spikes'],
                                       sim_data['gid_ranges'],
-                                      sim_data['spec'], sim_data['vsoma'])
+                                      sim_data['spec'], sim_data['vsoma'],
+                                      sim_data['dpl_stats'])
 
     def opt_callback(self):
         # re-enable all the range sliders (last step)
@@ -1136,7 +1156,9 @@ class HNNGUI(QMainWindow):
                 self.sim_data.save_spec_with_hist(self.baseparamwin.paramfn,
                                                   self.baseparamwin.params)
 
-            if self.baseparamwin.params['record_vsoma']:
+            # the results file already has the voltages
+            if self.baseparamwin.params['record_vsoma'] and \
+                    read_output_settings()['legacy_files']:
                 self.sim_data.save_vsoma(self.baseparamwin.paramfn,
                                          self.baseparamwin.params)
 
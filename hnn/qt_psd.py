@@ -1,7 +1,6 @@
 import os
 import sys
 from math import sqrt
-from copy import deepcopy
 
 from PyQt5.QtWidgets import QSizePolicy, QAction, QFileDialog
 from PyQt5.QtGui import QIcon
@@ -17,41 +16,51 @@ import matplotlib.gridspec as gridspec
 from hnn_core.dipole import average_dipoles, Dipole
 
 from .DataViewGUI import DataViewGUI
-from .specfn import spec_dpl_kernel, extract_spec
+from .expdata import read_exp_data
+from .specfn import psd_dpls, freq_spacing, get_spec_options
+from .paramrw import read_output_settings
 
 fontsize = plt.rcParams['font.size'] = 10
 random_label = np.random.rand(100)
 
 
-def extract_psd(dpl, f_max_spec):
+def extract_psd(dpl, f_max_spec, freqs=None, dtype=np.float64):
     """Extract PSDs for layers using Morlet method
 
+    The PSDs are the time averages of the Morlet TFRs, calculated without
+    the TFRs by psd_dpls.
+
     Parameters
     ----------
     dpls: Dipole object
         Dipole for a single trial
     f_max_spec: float
         Maximum frequency of analysis
+    freqs: array | None
+        Frequencies of analysis. If None, every integer frequency up to
+        f_max_spec is used.
+    dtype: dtype
+        float64, or float32 for single precision PSDs
 
     Returns
     ----------
     F: array
         Frequencies associated with Morlet spectral analysis
-    psds: list of MortletSpec objects
-        List containing results of spectral analysis for each layer
+    psds: array
+        The PSDs of the agg, L2 and L5 dipoles
 
     """
 
-    psds = []
     dt = dpl.times[1] - dpl.times[0]
     tstop = dpl.times[-1]
 
-    spec_results = spec_dpl_kernel(dpl, f_max_spec, dt, tstop)
+    psd_results, _ = psd_dpls([dpl], f_max_spec, dt, tstop, freqs=freqs,
+                              dtype=dtype)
+    psd_results = psd_results[0]
 
-    for col in ['TFR', 'TFR_L2', 'TFR_L5']:
-        psds.append(np.mean(spec_results[col], axis=1))
+    psds = [psd_results[key] for key in ['PSD', 'PSD_L2', 'PSD_L5']]
 
-    return spec_results['freq'], np.array(psds)
+    return psd_results['freq'], np.array(psds)
 
 
 class PSDCanvas(FigureCanvasQTAgg):
@@ -70,14 +79,14 @@ class PSDCanvas(FigureCanvasQTAgg):
         self.invertedhistax = False
         self.G = gridspec.GridSpec(10, 1)
         self.dpls = self.gui.dpls
-        self.specs = self.gui.specs
-        self.avg_spec = self.gui.avg_spec
+        self.trial_psds = self.gui.trial_psds
+        self.avg_psd = self.gui.avg_psd
         self.avg_dpl = self.gui.avg_dpl
         self.lextdatobj = []
 
         self.plot()
 
-    def drawpsd(self, dspec, fig, G, ltextra=''):
+    def drawpsd(self, dpsd, fig, G, ltextra=''):
         global random_label
 
         lax = []
@@ -85,7 +94,7 @@ class PSDCanvas(FigureCanvasQTAgg):
         stds = []
 
         lkF = ['f_L2', 'f_L5', 'f_L2']
-        lkS = ['TFR_L2', 'TFR_L5', 'TFR']
+        lkS = ['PSD_L2', 'PSD_L5', 'PSD']
 
         plt.ion()
 
@@ -93,18 +102,18 @@ class PSDCanvas(FigureCanvasQTAgg):
 
         ltitle = ['Layer 2/3', 'Layer 5', 'Aggregate']
 
-        yl = [sys.float_info, -(sys.float_info)]
+        yl = [sys.float_info.max, -(sys.float_info.max)]
 
         for _, kS in enumerate(lkS):
-            avg = np.mean(dspec[kS], axis=1)
-            std = np.std(dspec[kS], axis=1) / sqrt(dspec[kS].shape[1])
+            avg = dpsd[kS]
+            std = dpsd[kS + '_err']
             yl[0] = min(yl[0], np.amin(avg - std))
             yl[1] = max(yl[1], np.amax(avg + std))
             avgs.append(avg)
             stds.append(std)
 
         yl = tuple(yl)
-        xl = (dspec['f_L2'][0], dspec['f_L2'][-1])
+        xl = (dpsd['f_L2'][0], dpsd['f_L2'][-1])
 
         for i, kS in enumerate(lkS):
             ax = fig.add_subplot(gdx, label=random_label)
@@ -114,15 +123,17 @@ class PSDCanvas(FigureCanvasQTAgg):
             if i == 2:
                 ax.set_xlabel('Frequency (Hz)')
 
-            ax.plot(dspec[lkF[i]], np.mean(dspec[lkS[i]], axis=1), color='w',
+            ax.plot(dpsd[lkF[i]], avgs[i], color='w',
                     linewidth=self.gui.linewidth + 2)
-            ax.plot(dspec[lkF[i]], avgs[i] - stds[i], color='gray',
+            ax.plot(dpsd[lkF[i]], avgs[i] - stds[i], color='gray',
                     linewidth=self.gui.linewidth)
-            ax.plot(dspec[lkF[i]], avgs[i] + stds[i], color='gray',
+            ax.plot(dpsd[lkF[i]], avgs[i] + stds[i], color='gray',
                     linewidth=self.gui.linewidth)
 
             ax.set_ylim(yl)
             ax.set_xlim(xl)
+            if freq_spacing(dpsd[lkF[i]]) == 'log':
+                ax.set_xscale('log')
 
             ax.set_facecolor('k')
             ax.grid(True)
@@ -182,18 +193,18 @@ class PSDCanvas(FigureCanvasQTAgg):
         self.lextdatobj.append(ax.legend(handles=self.lpatch))
 
     def plot(self):
-        if len(self.specs) == 0:
+        if len(self.trial_psds) == 0:
             # data hasn't been loaded yet
             return
 
         if self.index == 0:
             ltextra = 'All Trials'
-            self.lax = self.drawpsd(self.avg_spec, self.figure, self.G,
+            self.lax = self.drawpsd(self.avg_psd, self.figure, self.G,
                                     ltextra=ltextra)
         else:
             ltextra = 'Trial ' + str(self.index)
-            self.lax = self.drawpsd(self.specs[self.index - 1], self.figure,
-                                    self.G, ltextra=ltextra)
+            self.lax = self.drawpsd(self.trial_psds[self.index - 1],
+                                    self.figure, self.G, ltextra=ltextra)
 
         self.figure.subplots_adjust(bottom=0.06, left=0.06, right=0.98,
                                     top=0.97, wspace=0.1, hspace=0.09)
@@ -207,13 +218,13 @@ class PSDViewGUI(DataViewGUI):
     Required parameters: N_trials, f_max_spec, sim_prefix
     """
     def __init__(self, CanvasType, params, sim_data, title):
-        self.specs = []  # used by drawspec
+        self.trial_psds = []  # used by drawpsd
         self.psds = []  # used by plotextdat
         self.lextfiles = []  # external data files
         self.lF = []  # frequencies associated with external data psd
         self.dpls = None
         self.avg_dpl = []
-        self.avg_spec = {}
+        self.avg_psd = {}
         self.params = params
 
         # used by loadSimData
@@ -246,28 +257,26 @@ class PSDViewGUI(DataViewGUI):
         if self.sim_data is not None:
             self.avg_dpl = self.sim_data['avg_dpl']
             self.dpls = self.sim_data['dpls']
-            self.specs = self.sim_data['spec']
-            if self.specs is None or len(self.specs) == 0:
-                self.specs = extract_spec(self.dpls, self.params['f_max_spec'])
-
-            # calculate TFR from spec trial data
-            self.avg_spec = deepcopy(self.specs[0])
             ntrials = self.params['N_trials']
-            TFR_list = [self.specs[i]['TFR'] for i in range(ntrials)]
-            TFR_L2_list = [self.specs[i]['TFR_L2'] for i in range(ntrials)]
-            TFR_L5_list = [self.specs[i]['TFR_L5'] for i in range(ntrials)]
-            self.avg_spec['TFR'] = np.mean(np.array(TFR_list), axis=0)
-            self.avg_spec['TFR_L2'] = np.mean(np.array(TFR_L2_list), axis=0)
-            self.avg_spec['TFR_L5'] = np.mean(np.array(TFR_L5_list), axis=0)
+
+            # the PSDs are calculated directly, which is much faster than
+            # reading or calculating the TFRs of the trials
+            dt = self.dpls[0].times[1] - self.dpls[0].times[0]
+            tstop = self.dpls[0].times[-1]
+            freqs, dtype = get_spec_options(read_output_settings(),
+                                            self.params['f_max_spec'])
+            self.trial_psds, self.avg_psd = psd_dpls(
+                self.dpls[:ntrials], self.params['f_max_spec'], dt, tstop,
+                freqs=freqs, dtype=dtype)
 
             # populate the data inside canvas object before calling
             # self.m.plot()
             self.m.avg_dpl = self.avg_dpl
             self.m.dpls = self.dpls
-            self.m.specs = self.specs
-            self.m.avg_spec = self.avg_spec
+            self.m.trial_psds = self.trial_psds
+            self.m.avg_psd = self.avg_psd
 
-        if len(self.specs) > 0:
+        if len(self.trial_psds) > 0:
             self.printStat('Plotting simulation PSDs.')
             self.m.lF = self.lF
             self.m.dpls = self.dpls
@@ -285,7 +294,7 @@ class PSDViewGUI(DataViewGUI):
             return
 
         self.m.index = 0
-        file_data = np.loadtxt(fname, dtype=float)
+        file_data = read_exp_data(fname)
         if file_data.shape[1] > 2:
             # Multiple trials contained in this file. Only 'agg' dipole is
             # present for each trial
@@ -318,7 +327,9 @@ class PSDViewGUI(DataViewGUI):
         f_max_spec = 120.0  # use 120 Hz as maximum for PSD plots
 
         # a progress bar would be helpful right here!
-        f, psd = extract_psd(self.avg_dpl, f_max_spec)
+        freqs, dtype = get_spec_options(read_output_settings(), f_max_spec)
+        f, psd = extract_psd(self.avg_dpl, f_max_spec, freqs=freqs,
+                             dtype=dtype)
         self.psds.append(psd)
         self.lF.append(f)
 
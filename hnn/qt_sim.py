@@ -13,6 +13,7 @@ from .paramrw import countEvokedInputs
 from .qt_lib import getscreengeom
 from .paramrw import get_output_dir, get_inputs
 from .simdata import check_feeds_to_plot, plot_hists_on_gridspec
+from .simdata import get_avg_spec
 from .specfn import plot_spec
 from .spikefn import ExtInputs
 
@@ -432,7 +433,8 @@ class SIMCanvas(FigureCanvasQTAgg):
             self.axspec = self.figure.add_subplot(self.G[6:10, 0])
             cax = plot_spec(self.axspec, sim_data['spec'], ntrial,
                             self.params['spec_cmap'], xlim,
-                            fontsize)
+                            fontsize,
+                            avg_spec=get_avg_spec(sim_data, ntrial))
 
             # plot colorbar horizontally to save space
             cbaxes = self.figure.add_axes([0.6, 0.49, 0.3, 0.005])
@@ -6,7 +6,7 @@
 import numpy as np
 import os
 
-from PyQt5.QtWidgets import QSizePolicy, QAction, QFileDialog
+from PyQt5.QtWidgets import QSizePolicy, QAction, QFileDialog, QLabel
 from PyQt5.QtGui import QIcon
 
 import matplotlib.pyplot as plt
@@ -16,7 +16,11 @@ from matplotlib.figure import Figure
 from hnn_core.dipole import average_dipoles, Dipole
 
 from .DataViewGUI import DataViewGUI
-from .specfn import plot_spec, extract_spec
+from .expdata import read_exp_data
+from .specfn import (plot_spec, extract_spec, average_spec, wavelet_cache,
+                     get_spec_options)
+from .paramrw import read_output_settings
+from .simdata import get_avg_spec
 
 fontsize = plt.rcParams['font.size'] = 10
 random_label = np.random.rand(100)
@@ -44,6 +48,7 @@ class SpecCanvas(FigureCanvasQTAgg):
         self.G = gridspec.GridSpec(10, 1)
         self.dpls = self.gui.dpls
         self.specs = self.gui.specs
+        self.avg_spec = self.gui.avg_spec
         self.avg_dpl = self.gui.avg_dpl
         self.lax = []
 
@@ -104,7 +109,8 @@ class SpecCanvas(FigureCanvasQTAgg):
         random_label += 1
         ntrial = len(dpls)
 
-        plot_spec(ax, spec_data, ntrial, self.spec_cmap, xlim)
+        plot_spec(ax, spec_data, ntrial, self.spec_cmap, xlim,
+                  avg_spec=self.avg_spec)
 
         lax.append(ax)
 
@@ -129,6 +135,7 @@ class SpecViewGUI(DataViewGUI):
     """
     def __init__(self, CanvasType, params, sim_data, title):
         self.specs = []
+        self.avg_spec = None
         self.lextfiles = []  # external data files
         self.dpls = None
         self.avg_dpl = []
@@ -139,6 +146,9 @@ class SpecViewGUI(DataViewGUI):
         super(SpecViewGUI, self).__init__(CanvasType, self.params, sim_data,
                                           title)
         self._addLoadDataActions()
+        # like the memory used by simulations in the main window
+        self.cachelabel = QLabel()
+        self.statusBar().addPermanentWidget(self.cachelabel)
         self.loadSimData(self.params['sim_prefix'], self.params['f_max_spec'])
 
     def _addLoadDataActions(self):
@@ -166,13 +176,22 @@ class SpecViewGUI(DataViewGUI):
             self.dpls = self.sim_data['dpls']
             self.specs = self.sim_data['spec']
             if self.specs is None or len(self.specs) == 0:
-                self.specs = extract_spec(self.dpls, f_max_spec)
+                freqs, dtype = get_spec_options(read_output_settings(),
+                                                f_max_spec)
+                self.specs = extract_spec(self.dpls, f_max_spec, freqs=freqs,
+                                          dtype=dtype)
+                self.avg_spec = average_spec(self.specs)
+                self.cachelabel.setText(wavelet_cache.status())
+            else:
+                # calculated once for the simulation
+                self.avg_spec = get_avg_spec(self.sim_data)
 
             # populate the data inside canvas object before calling
             # self.m.plot()
             self.m.avg_dpl = self.avg_dpl
             self.m.dpls = self.dpls
             self.m.specs = self.specs
+            self.m.avg_spec = self.avg_spec
 
             self.ntrial = len(self.specs)
 
@@ -195,7 +214,7 @@ class SpecViewGUI(DataViewGUI):
             return
 
         self.m.index = 0
-        file_data = np.loadtxt(fname, dtype=float)
+        file_data = read_exp_data(fname)
         if file_data.shape[1] > 2:
             # Multiple trials contained in this file. Only 'agg' dipole is
             # present for each trial
@@ -226,7 +245,12 @@ class SpecViewGUI(DataViewGUI):
         print('Loaded data from %s: %d trials.' % (fname, ntrials))
         print('Extracting Spectrograms...')
         # a progress bar would be helpful right here!
-        self.specs = extract_spec(self.dpls, self.params['f_max_spec'])
+        freqs, dtype = get_spec_options(read_output_settings(),
+                                        self.params['f_max_spec'])
+        self.specs = extract_spec(self.dpls, self.params['f_max_spec'],
+                                  freqs=freqs, dtype=dtype)
+        self.avg_spec = average_spec(self.specs)
+        self.cachelabel.setText(wavelet_cache.status())
 
         # updateCB depends on ntrial being set
         self.ntrial = len(self.specs)
@@ -238,6 +262,7 @@ class SpecViewGUI(DataViewGUI):
         if len(self.specs) > 0:
             self.printStat('Plotting Spectrograms.')
             self.m.specs = self.specs
+            self.m.avg_spec = self.avg_spec
             self.m.dpls = self.dpls
             self.m.avg_dpl = self.avg_dpl
             self.m.plot()
@@ -6,19 +6,29 @@
 
 import os
 import sys
+import hashlib
 from math import ceil, isclose
 from contextlib import redirect_stdout
 import traceback
 from queue import Queue
-from threading import Event, Lock
+from threading import Event, Lock, Thread
 import numpy as np
 from collections import namedtuple
 
 import nlopt
 from PyQt5 import QtCore
-from hnn_core import simulate_dipole, Network, MPIBackend
+from hnn_core import Network
 
 from .paramrw import get_output_dir, hnn_core_compat_params
+from .simcache import get_cache_key
+from .simfn import simulate, postproc_dipoles
+from .simdata import calc_dipole_err
+from .checkpoint import (read_checkpoint, read_checkpoint_results,
+                         simulate_checkpoint, get_checkpoint_time)
+from .savestate import check_save_state
+from .mpi_pool import _has_mpi4py
+from .optfn import (DifferentialEvolution, SurrogateOptimizer, get_batches,
+                    quantize, read_opt_state, write_opt_state)
 
 
 class BasicSignal(QtCore.QObject):
@@ -36,11 +46,6 @@ class QueueSignal(QtCore.QObject):
     qsig = QtCore.pyqtSignal(Queue, str, float)
 
 
-class QueueDataSignal(QtCore.QObject):
-    """for returning data"""
-    qsig = QtCore.pyqtSignal(Queue, str, np.ndarray, float, float)
-
-
 class EventSignal(QtCore.QObject):
     """for synchronization"""
     esig = QtCore.pyqtSignal(Event, str)
@@ -83,38 +88,6 @@ def _add_missing_frames(tb):
     return result
 
 
-def simulate(net):
-    """Start the simulation with hnn_core.simulate
-
-    Parameters
-    ----------
-    net : Network object
-        The constructed Network object from hnn-core
-    """
-
-    sim_data = {}
-    # run the simulation with MPIBackend for faster completion time
-    record_vsoma = bool(net.params['record_vsoma'])
-
-    numspikes_params = net.params['numspikes_*']
-    # optimization can feed in floats for numspikes
-    for param_name, spikes in numspikes_params.items():
-        net.params[param_name] = round(spikes)
-
-    sim_data['raw_dpls'] = simulate_dipole(net, net.params['N_trials'],
-                                           postproc=False,
-                                           record_vsoma=record_vsoma)
-
-    # hnn-core changes this to bool, change back to int
-    if isinstance(net.params['record_vsoma'], bool):
-        net.params['record_vsoma'] = int(record_vsoma)
-    sim_data['gid_ranges'] = net.gid_ranges
-    sim_data['spikes'] = net.cell_response
-    sim_data['vsoma'] = net.cell_response.vsoma
-
-    return sim_data
-
-
 # based on https://nikolak.com/pyqt-threading-tutorial/
 class SimThread(QtCore.QThread):
     """The SimThread class.
@@ -160,8 +133,21 @@ class SimThread(QtCore.QThread):
         when running an optimization simulation.
     killed_lock : threading.Lock
         Lock to protect killed variable mutual exclusion
-    backend : MPIBackend
-        The hnn-core backend responsible for running simulations
+    backend : MPIPoolBackend | TrialGroupBackend
+        The backend responsible for running simulations. It is shared
+        with other simulations run from mainwin
+    fork_checkpoint : dict | None
+        A checkpoint of the simulation up to an earlier time, saved with
+        different values of fork_params. If the inputs depending on
+        fork_params have no events before that time, the simulation is
+        continued from the checkpoint instead of simulated from 0 ms.
+    fork_results : dict | None
+        The results of the simulation that fork_checkpoint was saved with
+    fork_params : list of str
+        The parameters that may differ from those of fork_checkpoint
+    one_proc_per_trial : bool
+        Whether the simulations continuing from fork_checkpoint simulate
+        each trial on one core, as fork_checkpoint must be saved with
     """
 
     def __init__(self, ncore, params, result_callback, mainwin):
@@ -175,6 +161,10 @@ class SimThread(QtCore.QThread):
         self.killed = False
         self.backend = None
         self.killed_lock = Lock()
+        self.fork_checkpoint = None
+        self.fork_results = None
+        self.fork_params = list()
+        self.one_proc_per_trial = False
 
         self.paramfn = os.path.join(get_output_dir(), 'param',
                                     self.params['sim_prefix'] + '.param')
@@ -247,12 +237,144 @@ class SimThread(QtCore.QThread):
         with self.killed_lock:
             self.killed = False
 
+        sim_data = self._get_sim_data(self.params, sim_length)
+
+        # put sim_data into the val attribute of a ResultObj
+        self.result_signal.sig.emit(ResultObj(sim_data, self.params))
+
+    def _get_sim_data(self, params, sim_length=None):
+        """Simulate params or load the results of an identical simulation
+
+        Parameters
+        ----------
+        params : dict
+            Dictionary of params describing simulation config
+        sim_length : float | None
+            Optional to limit the stopping point of the simulation. If None,
+            the entire simulation length will be run until 'tstop'
+
+        Returns
+        -------
+        sim_data : dict
+            The raw simulation results
+        """
         # make copy of params dict in Params object before
         # modifying tstop
-        sim_params = hnn_core_compat_params(self.params)
+        sim_params = hnn_core_compat_params(params)
         if sim_length is not None:
             sim_params['tstop'] = round(sim_length, 8)
 
+        # continue from the state saved at the end of the last simulation.
+        # The result cache doesn't store the simulator state.
+        use_checkpoint = self.mainwin.checkpointsim and \
+            not self.is_optimization and sim_length is None
+        checkpoint = results = None
+        if use_checkpoint:
+            sim_dir = os.path.join(get_output_dir(), 'data',
+                                   sim_params['sim_prefix'])
+            checkpoint = read_checkpoint(sim_dir)
+            if checkpoint is not None:
+                results = read_checkpoint_results(sim_dir)
+
+        # identical parameters give identical results: reuse them if cached
+        sim_cache = self.mainwin.sim_cache
+        cache_key = get_cache_key(sim_params, sim_length)
+        sim_data = None
+        if not use_checkpoint:
+            sim_data = sim_cache.get(cache_key)
+        if sim_data is not None:
+            txt = "Loaded results of identical simulation from cache. " + \
+                sim_cache.status()
+            print(txt)
+            self._updatewaitsimwin(txt)
+            return sim_data
+
+        if use_checkpoint:
+            # states saved over several processes per trial can't be
+            # continued
+            reason = check_save_state()
+            if reason is not None:
+                txt = "Not saving a checkpoint: %s" % reason
+            else:
+                ncore, _ = self._get_pool_config(sim_params['N_trials'],
+                                                 one_proc_per_trial=True)
+                txt = "Simulating each trial on one core (%d in total) to" \
+                    " save a checkpoint" % ncore
+            print(txt)
+            self._updatewaitsimwin(txt)
+            sim_data = self._simulate(sim_params, use_checkpoint=True,
+                                      one_proc_per_trial=reason is None,
+                                      checkpoint=checkpoint, results=results)
+        elif self.fork_checkpoint is not None:
+            # only continue if the result is the same as from 0 ms
+            sim_data = self._simulate(
+                sim_params, use_checkpoint=True,
+                one_proc_per_trial=self.one_proc_per_trial,
+                checkpoint=self.fork_checkpoint, results=self.fork_results,
+                exclude_params=self.fork_params, exact=True, save_state=False)
+            sim_data.pop('continued_from', None)
+        else:
+            sim_data = self._simulate(sim_params)
+
+        # continued simulations can differ from simulating from 0 ms
+        if 'continued_from' not in sim_data:
+            sim_cache.put(cache_key, {key: val for key, val in
+                                      sim_data.items() if key != 'checkpoint'})
+        self._updatewaitsimwin(sim_cache.status())
+
+        return sim_data
+
+    def _get_pool_config(self, n_trials, one_proc_per_trial=False):
+        """The number of cores and of groups of trials of a worker pool
+
+        Parameters
+        ----------
+        n_trials : int
+            The number of trials to simulate
+        one_proc_per_trial : bool
+            If True, each trial is simulated by one process, so that its
+            state can be saved and continued. As many trials as there are
+            cores are simulated concurrently.
+
+        Returns
+        -------
+        ncore : int
+            The number of cores of the pool
+        n_trial_groups : int
+            The number of groups of trials simulated concurrently
+        """
+        if not one_proc_per_trial:
+            return self.ncore, min(self.mainwin.ntrialgroups, n_trials,
+                                   self.ncore)
+
+        n_trial_groups = min(n_trials, self.ncore)
+        if not _has_mpi4py():
+            # one process simulates the trials one after another
+            n_trial_groups = 1
+        return n_trial_groups, n_trial_groups
+
+    def _simulate(self, sim_params, use_checkpoint=False,
+                  one_proc_per_trial=False, **checkpoint_kwargs):
+        """Simulate, retrying with fewer cores if the simulation fails
+
+        Parameters
+        ----------
+        sim_params : dict
+            The hnn-core parameters to simulate
+        use_checkpoint : bool
+            Whether to simulate with simulate_checkpoint(), which is passed
+            checkpoint_kwargs
+        one_proc_per_trial : bool
+            Whether to simulate each trial on one core, which states must be
+            saved from to be continued
+        **checkpoint_kwargs : dict
+            Keyword arguments of simulate_checkpoint()
+
+        Returns
+        -------
+        sim_data : dict
+            The simulation results
+        """
         while True:
             if self.ncore == 0:
                 raise RuntimeError("No cores available for simulation")
@@ -263,13 +385,20 @@ class SimThread(QtCore.QThread):
                     # create the network from the parameter file
                     # Note: NEURON objects haven't been created yet
                     net = Network(sim_params, add_drives_from_params=True)
-                    with MPIBackend(
-                            n_procs=self.ncore, mpi_cmd='mpiexec') as backend:
+                    # the MPI ranks stay resident between simulations
+                    ncore, n_trial_groups = self._get_pool_config(
+                        sim_params['N_trials'], one_proc_per_trial)
+                    with self.mainwin.get_sim_pool(
+                            ncore, n_trial_groups) as backend:
                         self.backend = backend
                         with self.killed_lock:
                             if self.killed:
                                 raise RuntimeError("Terminated")
-                        sim_data = simulate(net)
+                        if use_checkpoint:
+                            sim_data = simulate_checkpoint(
+                                net, backend, **checkpoint_kwargs)
+                        else:
+                            sim_data = simulate(net)
                     self.backend = None
                 break
             except RuntimeError as e:
@@ -290,8 +419,7 @@ class SimThread(QtCore.QThread):
             print(txt)
             self._updatewaitsimwin(txt)
 
-        # put sim_data into the val attribute of a ResultObj
-        self.result_signal.sig.emit(ResultObj(sim_data, self.params))
+        return sim_data
 
 
 class OptThread(SimThread):
@@ -334,12 +462,25 @@ class OptThread(SimThread):
         Number of parameters to be optimized in every step
     step_ranges : dict
         Parameter ranges for this step
+    opt_param_names : list of str
+        The parameters of step_ranges that COBYLA optimizes, in the order of
+        its parameter vector. Parameters with a range of zero width are not
+        optimized.
     step_sims : int
         Number of sim in this step
     sim_data : SimData object
         Reference to the class containing simulation data. Only used for
         references to functions for emitting signals. The one exception is
         using the SimData.in_sim_data member function
+    exp_data : dict
+        The experimental data in sim_data when the optimization started,
+        for calculating the weighted RMSE in this thread
+    memo : EvalMemo
+        The evaluations of this session, shared with later optimizations
+        through mainwin. Nearly identical parameters are not simulated
+        again.
+    err_key : str | None
+        Identifies how the weighted RMSE is calculated in this step
     result_callback: function
         Handle for callback to call after every sim completion
     seed : seed for optimization set in the GUI. The parameter for this is
@@ -347,6 +488,8 @@ class OptThread(SimThread):
         hnn-core
     best_step_werr : float
         The current best weighted RMSE for this step
+    best_result : ResultObj | None
+        The post-processed results of the simulation with best_step_werr
     initial_err : float
         The regular RMSE for initial simulation
     paramfn : str
@@ -362,7 +505,31 @@ class OptThread(SimThread):
         simulations (first part of simulation may be ignored)
     opt_end : float
         Time is ms to stop
+    prefix_checkpoint : dict | None
+        The state of the simulation at opt_start (rounded down to a multiple
+        of dt) with the parameters at the start of this step. Simulations of
+        this step continue from it when the parameters being optimized don't
+        change the simulation before opt_start.
+    prefix_results : dict | None
+        The results of the simulation that prefix_checkpoint was saved with
+    prefix_pending : bool
+        Whether prefix_checkpoint is yet to be simulated. It is only
+        simulated when a simulation of this step is not in the memo.
     opt : nlopt.opt object
+    opt_algorithm : str
+        The optimization algorithm. 'cobyla' runs one simulation at a time,
+        'de' runs differential evolution and 'surrogate' chooses simulations
+        with a Gaussian process model of the weighted RMSE. The last two
+        run num_concurrent simulations at a time.
+    num_concurrent : int
+        The number of simulations run concurrently by differential
+        evolution or the surrogate. Each simulation runs over
+        ncore // num_concurrent cores.
+    step_concurrent : int
+        The number of simulations run concurrently in this step. It is
+        num_concurrent, unless the simulations of this step continue from
+        prefix_checkpoint (one_proc_per_trial is True): then each runs on
+        one core and as many as there are cores run concurrently.
     opt_weights : np.ndarray
         Array containing the weights used for RMSE calculation for this step
     killed : bool
@@ -384,8 +551,10 @@ class OptThread(SimThread):
         and initial error using the contents of sim_data[paramfn]
     get_err_from_sim_data : QueueSignal object
         Signal to be emitted to request the regular RMSE be put in the queue
-    get_werr_from_sim_data : QueueDataSignal object
-        Signal to be emitted to request the weighted RMSE be put in the queue
+    best_signal : ObjectSignal object
+        Signal to be emitted with best_result for showing it in the GUI.
+        Intermediate simulations are not sent to the GUI, written to disk
+        or analysed spectrally.
     """
     def __init__(self, ncore, params, num_steps, seed, sim_data,
                  result_callback, opt_callback, mainwin):
@@ -396,17 +565,30 @@ class OptThread(SimThread):
         self.num_steps = num_steps
         self.num_params = 0
         self.step_ranges = {}
+        self.opt_param_names = list()
         self.step_sims = 0
         self.sim_data = sim_data
+        self.exp_data = sim_data.get_exp_data()
+        self.memo = self.mainwin.opt_memo
+        self.memo.rtol = self.optparamwin.get_memo_tolerance()
+        self.err_key = None
         self.result_callback = result_callback
         self.seed = seed
         self.best_step_werr = sys.float_info.max
+        self.best_result = None
         self.initial_err = sys.float_info.max
         self.sim_thread = None
         self.sim_running = False
         self.opt_start = 0.0
         self.opt_end = 0.0
+        self.prefix_checkpoint = None
+        self.prefix_results = None
+        self.prefix_pending = False
         self.opt = None
+        self.opt_algorithm = self.optparamwin.get_opt_algorithm()
+        self.num_concurrent = min(self.optparamwin.get_num_concurrent_sims(),
+                                  self.ncore)
+        self.step_concurrent = self.num_concurrent
         self.opt_weights = None
         self.killed = False
 
@@ -430,8 +612,8 @@ class OptThread(SimThread):
         self.get_err_from_sim_data = QueueSignal()
         self.get_err_from_sim_data.qsig.connect(sim_data.get_err_wrapper)
 
-        self.get_werr_from_sim_data = QueueDataSignal()
-        self.get_werr_from_sim_data.qsig.connect(sim_data.get_werr_wrapper)
+        self.best_signal = ObjectSignal()
+        self.best_signal.sig.connect(sim_data.update_opt_data_from_result)
 
     def run(self):
         msg = ''
@@ -442,7 +624,11 @@ class OptThread(SimThread):
         """Terminate running simulation"""
         with self.killed_lock:
             self.killed = True
-            self.sim_thread.stop()
+            if self.sim_thread is not None:
+                self.sim_thread.stop()
+            # the simulation up to opt_start runs in this thread
+            if self.backend is not None:
+                self.backend.terminate()
 
         self.done_signal.tsig.emit("Optimization terminated")
 
@@ -468,7 +654,9 @@ class OptThread(SimThread):
                 continue
 
             self.step_ranges = self.optparamwin.get_chunk_ranges(step)
-            if len(self.step_ranges) == 0:
+            # parameters with a range of zero width are not optimized
+            if all([ranges['minval'] == ranges['maxval']
+                    for ranges in self.step_ranges.values()]):
                 txt = "Skipping optimization step %d (0 parameters)" % \
                     (step + 1)
                 self._updatewaitsimwin(txt)
@@ -489,13 +677,37 @@ class OptThread(SimThread):
             # weights calculated once per step
             self.opt_weights = \
                 self.optparamwin.get_chunk_weights(self.cur_step)
+            self.err_key = self._get_err_key()
+
+            # simulations of this step only differ after opt_start
+            self.one_proc_per_trial, self.step_concurrent, reason = \
+                self._plan_step_pools()
+            if reason is not None:
+                txt = "Simulating from 0 ms: %s" % reason
+                self._updatewaitsimwin(txt)
+                print(txt)
+            self.prefix_pending = self.one_proc_per_trial
 
             # run an opt step
-            algorithm = nlopt.LN_COBYLA
-            self.num_params = len(self.step_ranges)
-            self.opt = nlopt.opt(algorithm, self.num_params)
-            opt_results = self._run_opt_step(self.step_ranges, self.step_sims,
-                                             algorithm)
+            self.num_params = len(self._get_opt_bounds(self.step_ranges)[0])
+            if self.opt_algorithm == 'de':
+                opt_results = self._run_de_opt_step(self.step_ranges,
+                                                    self.step_sims)
+            elif self.opt_algorithm == 'surrogate':
+                opt_results = self._run_surrogate_opt_step(self.step_ranges,
+                                                           self.step_sims)
+            else:
+                opt_results = self._run_opt_step(self.step_ranges,
+                                                 self.step_sims,
+                                                 nlopt.LN_COBYLA)
+            self.prefix_checkpoint = None
+            self.prefix_results = None
+            self.prefix_pending = False
+            self.one_proc_per_trial = False
+            self.step_concurrent = self.num_concurrent
+            txt = self.memo.status()
+            self._updatewaitsimwin(txt)
+            print(txt)
 
             # update with optimized params for the next round
             for var_name, new_value in zip(self.step_ranges, opt_results):
@@ -518,11 +730,18 @@ class OptThread(SimThread):
             # update optimization dialog window
             self.optparamwin.push_chunk_ranges(push_values)
 
-        # update opt_data with the final best
-        update_event = Event()
-        self.update_sim_data_from_opt_data.esig.emit(update_event,
-                                                     self.paramfn)
-        update_event.wait()
+        if self.best_result is not None:
+            # only the final best is written to disk and analysed
+            # spectrally. Queued before the RMSE request below. The copy
+            # keeps the results shown from opt_data from being modified.
+            self.result_signal.sig.emit(ResultObj(
+                dict(self.best_result.data), self.best_result.params))
+        else:
+            # update sim_data with the initial simulation in opt_data
+            update_event = Event()
+            self.update_sim_data_from_opt_data.esig.emit(update_event,
+                                                         self.paramfn)
+            update_event.wait()
         self.refresh_signal.sig.emit()  # redraw with updated RMSE
 
         # check that optimization improved RMSE
@@ -603,8 +822,115 @@ class OptThread(SimThread):
                                              self.params['tstop'])
         self.initial_err = err_queue.get()
 
+    def _get_step_checkpoint(self):
+        """The prefix_checkpoint of this step and its results, simulated
+        when first needed
+        """
+        if self.prefix_pending:
+            self.prefix_pending = False
+            self.prefix_checkpoint, self.prefix_results = \
+                self._get_prefix_checkpoint()
+        return self.prefix_checkpoint, self.prefix_results
+
+    def _plan_step_pools(self):
+        """Choose how the simulations of this step are spread over the cores
+
+        Continuing from the simulation before opt_start needs each trial to
+        be simulated on one core, as states saved over several processes per
+        trial can't be restored. This is chosen when it is estimated to be
+        faster than simulating from 0 ms with several cores per trial,
+        assuming that a simulation scales perfectly with its cores.
+
+        Returns
+        -------
+        one_proc_per_trial : bool
+            Whether the simulations of this step continue from the
+            simulation before opt_start, simulating each trial on one core
+        step_concurrent : int
+            The number of simulations run concurrently by differential
+            evolution or the surrogate
+        reason : str | None
+            Why the simulation before opt_start is not reused, or None if
+            it is or opt_start is 0
+        """
+        n_trials = self.params['N_trials']
+        t_fork = get_checkpoint_time(self.opt_start, self.params['dt'])
+        if t_fork <= 0:
+            return False, self.num_concurrent, None
+        reason = check_save_state()
+        if reason is not None:
+            return False, self.num_concurrent, reason
+
+        has_mpi4py = _has_mpi4py()
+        if self.opt_algorithm != 'cobyla':
+            # each pool simulates the trials of a candidate in turn. Without
+            # mpi4py, there is one pool and candidates take turns
+            n_pools = self.num_concurrent if has_mpi4py else 1
+            n_single = self.ncore if has_mpi4py else 1
+            n_batches = ceil(self.step_sims / n_pools)
+            n_batches_single = ceil(self.step_sims / n_single)
+            n_trials_pool = n_trials_single = n_trials
+        else:
+            # the pools simulate the groups of trials of one simulation
+            _, n_pools = self._get_pool_config(n_trials)
+            if not has_mpi4py:
+                n_pools = 1
+            _, n_single = self._get_pool_config(n_trials,
+                                                one_proc_per_trial=True)
+            n_batches = n_batches_single = self.step_sims
+            n_trials_pool = ceil(n_trials / n_pools)
+            n_trials_single = ceil(n_trials / n_single)
+        n_procs = max(1, self.ncore // n_pools)
+
+        multi_time = n_batches * self.opt_end * n_trials_pool / n_procs
+        single_time = (t_fork + n_batches_single *
+                       (self.opt_end - t_fork)) * n_trials_single
+        if single_time >= multi_time:
+            return False, self.num_concurrent, \
+                "faster over %d cores per trial than continuing from" \
+                " %.3f ms on one core per trial" % (n_procs, t_fork)
+
+        if self.opt_algorithm != 'cobyla':
+            return True, n_single, None
+        return True, self.num_concurrent, None
+
+    def _get_prefix_checkpoint(self):
+        """Simulate up to opt_start and save the state to continue from
+
+        The simulations of this step must simulate each trial on one core
+        (one_proc_per_trial), like this one. Returns the checkpoint and the
+        results of the simulation, or None and None if opt_start is 0 or the
+        simulation failed
+        """
+        sim_params = hnn_core_compat_params(self.params)
+        t_fork = get_checkpoint_time(self.opt_start, sim_params['dt'])
+        if t_fork <= 0:
+            return None, None
+
+        txt = "Simulating [0.000-%3.3f] ms once for this step, each trial" \
+            " on one core" % t_fork
+        self._updatewaitsimwin(txt)
+        print(txt)
+
+        sim_params['tstop'] = t_fork
+        self.sim_running = True
+        try:
+            if self.opt_algorithm != 'cobyla':
+                sim_data = self._simulate_candidates([sim_params])[0]
+            else:
+                sim_data = self._simulate(sim_params, use_checkpoint=True,
+                                          one_proc_per_trial=True)
+        except RuntimeError as e:
+            print("Not reusing the simulation before %.2f ms: %s" %
+                  (t_fork, e))
+            return None, None
+        finally:
+            self.sim_running = False
+
+        return sim_data.get('checkpoint'), sim_data
+
     def _opt_sim(self, new_params, grad=0):
-        """Run a SimThread simulation and calculate weighted RMSE
+        """Run a simulation and calculate weighted RMSE in this thread
 
         Called by nlopt.opt routine
         """
@@ -615,8 +941,7 @@ class OptThread(SimThread):
 
         # Prepare a dict of parameters for this simulation to populate in GUI
         opt_params = {}
-        for param_name, param_value in zip(self.step_ranges.keys(),
-                                           new_params):
+        for param_name, param_value in zip(self.opt_param_names, new_params):
             if param_value >= self.step_ranges[param_name]['minval'] and \
                     param_value <= self.step_ranges[param_name]['maxval']:
                 opt_params[param_name] = param_value
@@ -637,26 +962,103 @@ class OptThread(SimThread):
         for param_name, param_value in opt_params.items():
             sim_params[param_name] = param_value
 
-        # run the simulation, but stop at self.opt_end
-        self.sim_thread = SimThread(self.ncore, sim_params,
-                                    self.result_callback,
-                                    mainwin=self.mainwin)
+        memo_key = self._get_memo_key(sim_params)
+        avg_dpl = self.memo.get(memo_key)
+        if avg_dpl is not None:
+            self._report_memo_hit()
+            return self._get_sim_werr(sim_params, avg_dpl, memo_key)
+
+        # continue from opt_start if only the inputs after it changed
+        self.fork_checkpoint, self.fork_results = self._get_step_checkpoint()
+        self.fork_params = list(self.step_ranges)
 
         self.sim_running = True
-        # may not need to run the entire simulation
-        self.sim_thread.run(sim_length=self.opt_end)
-        self.sim_thread.wait()
-        with self.killed_lock:
-            if self.killed:
-                self.quit()
-        self.sim_running = False
+        try:
+            # run the simulation, but stop at self.opt_end
+            sim_data = self._get_sim_data(sim_params, sim_length=self.opt_end)
+        finally:
+            self.sim_running = False
+            self.fork_checkpoint = None
+            self.fork_results = None
+
+        postproc_dipoles(sim_data, sim_params)
+        self.memo.put(memo_key, sim_data['avg_dpl'])
+
+        return self._get_sim_werr(sim_params, sim_data['avg_dpl'], memo_key,
+                                  sim_data)
+
+    def _get_memo_key(self, sim_params):
+        """Identify a simulation of this step in the evaluation memo"""
+        memo_params = sim_params.copy()
+        for param_name in self.step_ranges:
+            memo_params[param_name] = quantize(memo_params[param_name],
+                                               self.memo.rtol)
+        core_params = hnn_core_compat_params(memo_params)
+        core_params['tstop'] = round(self.opt_end, 8)
+        # the memo has the smoothed and scaled dipole
+        core_params['memo_postproc'] = [sim_params['dipole_scalefctr'],
+                                        sim_params['dipole_smooth_win']]
+        return get_cache_key(core_params, self.opt_end)
+
+    def _get_err_key(self):
+        """Identify how the weighted RMSE is calculated in this step"""
+        exp_hash = hashlib.sha256()
+        for exp_fn in sorted(self.exp_data):
+            exp_hash.update(
+                np.ascontiguousarray(self.exp_data[exp_fn]).tobytes())
+        return get_cache_key({'opt_start': self.opt_start,
+                              'opt_end': self.opt_end,
+                              'opt_weights': np.asarray(
+                                  self.opt_weights).tolist(),
+                              'exp_data': exp_hash.hexdigest()})
+
+    def _report_memo_hit(self):
+        txt = "Reusing the evaluation of nearly identical parameters. " + \
+            self.memo.status()
+        print(txt)
+        self._updatewaitsimwin(txt)
 
-        # calculate wRMSE for all steps
-        err_queue = Queue()
-        self.get_werr_from_sim_data.qsig.emit(err_queue, self.paramfn,
-                                              self.opt_weights, self.opt_end,
-                                              self.opt_start)
-        werr = err_queue.get()
+    def _get_full_result(self, sim_params):
+        """The post-processed results of an evaluation in the memo
+
+        The memo only has the average dipole, so the results are read from
+        the result cache or simulated again.
+        """
+        self.sim_running = True
+        try:
+            sim_data = self._get_sim_data(sim_params, sim_length=self.opt_end)
+        finally:
+            self.sim_running = False
+        sim_data.pop('continued_from', None)
+        postproc_dipoles(sim_data, sim_params)
+        return sim_data
+
+    def _get_sim_werr(self, sim_params, avg_dpl, memo_key, sim_data=None):
+        """Calculate the weighted RMSE of a simulation in this thread
+
+        Updates the best result of this step and sends it to the GUI
+        without waiting for it to be shown.
+
+        Parameters
+        ----------
+        sim_params : dict
+            Dictionary of params describing the simulation config
+        avg_dpl : Dipole
+            The post-processed average dipole of the simulation
+        memo_key : str
+            Identifies the simulation in the evaluation memo, which stores
+            the weighted RMSE
+        sim_data : dict | None
+            The post-processed results of the simulation. If None and the
+            simulation is the new best, they are read from the result cache
+            or simulated again.
+        """
+        werr = self.memo.get_error(memo_key, self.err_key)
+        if werr is None:
+            _, werr = calc_dipole_err(self.exp_data, avg_dpl,
+                                      self.opt_end, self.opt_start,
+                                      self.opt_weights)
+            self.memo.put_error(memo_key, self.err_key, werr)
 
         txt = "Weighted RMSE = %f" % werr
         print(txt)
@@ -673,29 +1075,179 @@ class OptThread(SimThread):
         if werr < self.best_step_werr:
             self._updatewaitsimwin("new best with RMSE %f" % werr)
 
-            update_event = Event()
-            self.update_opt_data_from_sim_data.esig.emit(update_event,
-                                                         self.paramfn)
-            update_event.wait()
-
             self.best_step_werr = werr
+            if sim_data is None:
+                sim_data = self._get_full_result(sim_params)
+            self.best_result = ResultObj(sim_data, sim_params)
+            # sim_data isn't used by this thread after this
+            self.best_signal.sig.emit(self.best_result)
+            self.refresh_signal.sig.emit()  # redraw with the new best
             # save best param file
             # param_out = os.path.join(sim_dir, 'step_%d_best.param' %
             #                          self.cur_step)
             # write_legacy_paramf(param_out, self.params)
 
-        if self.cur_itr == 0 and self.cur_step > 0:
-            # Update plots for the first simulation only of this step
-            # (best results from last round). Skip the first step because
-            # there are no optimization results to show yet.
-            self.refresh_signal.sig.emit()  # redraw with updated RMSE
-
         self.cur_itr += 1
 
         return werr
 
-    def _run_opt_step(self, params_input, num_sims, algorithm):
-        """Core function for starting the nlopt optimization routine"""
+    def _simulate_candidates(self, candidate_params, **checkpoint_kwargs):
+        """Simulate parameter sets concurrently, each over its own cores
+
+        Parameters
+        ----------
+        candidate_params : list of dict
+            The hnn-core parameters of each simulation, at most
+            step_concurrent
+        **checkpoint_kwargs : dict
+            Keyword arguments of simulate_checkpoint()
+
+        Returns
+        -------
+        candidate_data : list of dict
+            The results of each simulation
+        """
+        candidate_data = [None] * len(candidate_params)
+        errors = list()
+
+        # one pool of MPI ranks per candidate, resident between batches
+        if self.one_proc_per_trial:
+            backend = self.mainwin.get_sim_pool(self.step_concurrent,
+                                                self.step_concurrent)
+        else:
+            backend = self.mainwin.get_sim_pool(self.ncore,
+                                                self.num_concurrent)
+        pools = getattr(backend, 'pools', [backend])
+
+        def _simulate_candidate(candidate_idx, pool):
+            try:
+                net = Network(candidate_params[candidate_idx],
+                              add_drives_from_params=True)
+                candidate_data[candidate_idx] = simulate_checkpoint(
+                    net, pool, **checkpoint_kwargs)
+            except Exception as e:
+                errors.append(e)
+                # stop the other candidates too
+                backend.terminate()
+
+        sim_log = self._log_sim_status(parent=self)
+        with redirect_stdout(sim_log):
+            with self.killed_lock:
+                if self.killed:
+                    raise RuntimeError("Terminated")
+                self.backend = backend
+            try:
+                # without mpi4py, there is one pool and candidates take turns
+                for batch in get_batches(len(candidate_params), len(pools)):
+                    threads = [Thread(target=_simulate_candidate,
+                                      args=(candidate_idx, pool))
+                               for candidate_idx, pool in zip(batch, pools)]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+            finally:
+                self.backend = None
+
+        with self.killed_lock:
+            if self.killed:
+                raise RuntimeError("Terminated")
+        if len(errors) > 0:
+            raise RuntimeError(str(errors[0]))
+
+        return candidate_data
+
+    def _opt_sims(self, param_names, candidates):
+        """Simulate candidates concurrently and calculate weighted RMSEs
+
+        Parameters
+        ----------
+        param_names : list of str
+            The names of the parameters being optimized
+        candidates : np.ndarray, shape (n_candidates, n_params)
+            The values of the parameters for each simulation, at most
+            step_concurrent
+
+        Returns
+        -------
+        werrs : list of float
+            The weighted RMSE of each candidate
+        """
+        txt = "Optimization step %d, simulations %d-%d" % \
+            (self.cur_step + 1, self.cur_itr + 1,
+             self.cur_itr + len(candidates))
+        self._updatewaitsimwin(txt)
+        print(txt)
+
+        all_opt_params = list()
+        all_sim_params = list()
+        for new_params in candidates:
+            opt_params = dict(zip(param_names, new_params))
+            sim_params = self.params.copy()
+            sim_params.update(opt_params)
+            all_opt_params.append(opt_params)
+            all_sim_params.append(sim_params)
+
+        # only simulate the candidates that aren't memoized or cached
+        sim_cache = self.mainwin.sim_cache
+        memo_keys = list()
+        cache_keys = list()
+        all_avg_dpls = list()
+        all_sim_data = [None] * len(all_sim_params)
+        uncached = list()
+        for candidate_idx, sim_params in enumerate(all_sim_params):
+            memo_keys.append(self._get_memo_key(sim_params))
+            core_params = hnn_core_compat_params(sim_params)
+            core_params['tstop'] = round(self.opt_end, 8)
+            cache_keys.append(get_cache_key(core_params, self.opt_end))
+            all_avg_dpls.append(self.memo.get(memo_keys[-1]))
+            if all_avg_dpls[-1] is not None:
+                self._report_memo_hit()
+                continue
+            sim_data = sim_cache.get(cache_keys[-1])
+            if sim_data is None:
+                uncached.append((candidate_idx, core_params))
+            else:
+                postproc_dipoles(sim_data, sim_params)
+                self.memo.put(memo_keys[-1], sim_data['avg_dpl'])
+                all_avg_dpls[-1] = sim_data['avg_dpl']
+                all_sim_data[candidate_idx] = sim_data
+
+        new_sim_data = list()
+        if len(uncached) > 0:
+            # continue from opt_start if only the inputs after it changed
+            checkpoint, results = self._get_step_checkpoint()
+            self.sim_running = True
+            try:
+                new_sim_data = self._simulate_candidates(
+                    [core_params for _, core_params in uncached],
+                    checkpoint=checkpoint, results=results,
+                    exclude_params=list(self.step_ranges), exact=True,
+                    save_state=False)
+            finally:
+                self.sim_running = False
+
+        for (candidate_idx, _), sim_data in zip(uncached, new_sim_data):
+            sim_data.pop('continued_from', None)
+            sim_cache.put(cache_keys[candidate_idx], sim_data)
+            postproc_dipoles(sim_data, all_sim_params[candidate_idx])
+            self.memo.put(memo_keys[candidate_idx], sim_data['avg_dpl'])
+            all_avg_dpls[candidate_idx] = sim_data['avg_dpl']
+            all_sim_data[candidate_idx] = sim_data
+        self._updatewaitsimwin(sim_cache.status())
+
+        werrs = list()
+        for candidate_idx, opt_params in enumerate(all_opt_params):
+            self.baseparamwin.update_gui_params(opt_params)
+            werrs.append(self._get_sim_werr(
+                all_sim_params[candidate_idx], all_avg_dpls[candidate_idx],
+                memo_keys[candidate_idx], all_sim_data[candidate_idx]))
+
+        return werrs
+
+    def _get_opt_bounds(self, params_input):
+        """The parameters with a range to optimize over and their bounds"""
+        param_names = []
         opt_params = []
         lb = []
         ub = []
@@ -706,14 +1258,134 @@ class OptThread(SimThread):
             if upper == lower:
                 continue
 
+            param_names.append(param_name)
             ub.append(upper)
             lb.append(lower)
             opt_params.append(params_input[param_name]['initial'])
 
+        return param_names, opt_params, lb, ub
+
+    def _get_opt_results(self, params_input, param_names, best_params):
+        """The values of all parameters of the step, in order"""
+        best = dict(zip(param_names, best_params))
+        return [best.get(param_name, params_input[param_name]['initial'])
+                for param_name in params_input.keys()]
+
+    def _run_de_opt_step(self, params_input, num_sims):
+        """Run a step of differential evolution over num_sims simulations
+        """
+        param_names, opt_params, lb, ub = self._get_opt_bounds(params_input)
+        de = DifferentialEvolution(lb, ub, opt_params,
+                                   batch_size=self.step_concurrent,
+                                   seed=self.seed + self.cur_step)
+        txt = "Differential evolution with %d candidates per generation," \
+            " %d simulated at a time" % (de.popsize, self.step_concurrent)
+        self._updatewaitsimwin(txt)
+        print(txt)
+
+        while de.n_evals < num_sims:
+            candidates = de.ask()[:num_sims - de.n_evals]
+            werrs = list()
+            for batch in get_batches(len(candidates), self.step_concurrent):
+                werrs.extend(self._opt_sims(param_names, candidates[batch]))
+            de.tell(candidates, werrs)
+
+        return self._get_opt_results(params_input, param_names, de.best_x)
+
+    def _get_opt_state_key(self, param_names, lb, ub, x0):
+        """Identify an optimization step for resuming it"""
+        step_desc = hnn_core_compat_params(self.params)
+        step_desc.update({'opt_param_names': param_names, 'opt_lb': lb,
+                          'opt_ub': ub, 'opt_x0': x0,
+                          'opt_start': self.opt_start,
+                          'opt_end': self.opt_end,
+                          'opt_weights': np.asarray(
+                              self.opt_weights).tolist(),
+                          'opt_seed': self.seed})
+        return get_cache_key(step_desc)
+
+    def _run_surrogate_opt_step(self, params_input, num_sims):
+        """Run a step of surrogate optimization over num_sims simulations
+
+        The evaluations are saved after each batch, so that running the
+        same step again resumes from them. Once the surrogate expects no
+        significant improvement, the remaining simulations refine the best
+        parameters with COBYLA.
+        """
+        param_names, opt_params, lb, ub = self._get_opt_bounds(params_input)
+        # the initial design takes at most half of the simulations
+        n_init = max(1, min(len(opt_params) + 1, num_sims // 2))
+        surrogate = SurrogateOptimizer(lb, ub, opt_params, n_init=n_init,
+                                       seed=self.seed + self.cur_step)
+
+        state_fname = os.path.join(get_output_dir(), 'data',
+                                   self.params['sim_prefix'],
+                                   'opt_step_%d.json' % (self.cur_step + 1))
+        state_key = self._get_opt_state_key(param_names, lb, ub, opt_params)
+        state = read_opt_state(state_fname, state_key)
+        num_saved = 0
+        if state is not None:
+            surrogate.set_state(state)
+            num_saved = surrogate.n_evals
+            txt = "Resuming optimization step %d from %d saved simulations" \
+                % (self.cur_step + 1, surrogate.n_evals)
+            self._updatewaitsimwin(txt)
+            print(txt)
+            self.cur_itr = surrogate.n_evals
+        os.makedirs(os.path.dirname(state_fname), exist_ok=True)
+
+        def _evaluate(candidates):
+            werrs = self._opt_sims(param_names, candidates)
+            surrogate.tell(candidates, werrs)
+            write_opt_state(state_fname, state_key, surrogate.get_state())
+            return werrs
+
+        while surrogate.n_evals < num_sims:
+            candidates = surrogate.ask(min(self.step_concurrent,
+                                           num_sims - surrogate.n_evals))
+            if surrogate.converged:
+                break
+            _evaluate(candidates)
+
+        num_refine = num_sims - surrogate.n_evals
+        if num_refine > 0:
+            txt = "Surrogate converged. Refining with COBYLA over %d" \
+                " simulations" % num_refine
+            self._updatewaitsimwin(txt)
+            print(txt)
+
+            def _refine_sim(new_params, grad=0):
+                candidate = np.clip(new_params, lb, ub)
+                return _evaluate(candidate[np.newaxis])[0]
+
+            self.opt = nlopt.opt(nlopt.LN_COBYLA, len(opt_params))
+            self.opt.set_lower_bounds(lb)
+            self.opt.set_upper_bounds(ub)
+            # stay close to the best parameters found by the surrogate
+            self.opt.set_initial_step(0.05 * (np.array(ub) - np.array(lb)))
+            self.opt.set_min_objective(_refine_sim)
+            self.opt.set_xtol_rel(1e-4)
+            self.opt.set_maxeval(num_refine)
+            self.opt.optimize(surrogate.best_x)
+
+        if np.argmin(surrogate.y) < num_saved:
+            # the best simulation was saved by an earlier run, so simulate it
+            # again (usually from the result cache) to show it
+            self._opt_sims(param_names, surrogate.best_x[np.newaxis])
+
+        return self._get_opt_results(params_input, param_names,
+                                     surrogate.best_x)
+
+    def _run_opt_step(self, params_input, num_sims, algorithm):
+        """Core function for starting the nlopt optimization routine"""
+        param_names, opt_params, lb, ub = self._get_opt_bounds(params_input)
+        self.opt_param_names = param_names
+        self.opt = nlopt.opt(algorithm, len(param_names))
+
         if algorithm == nlopt.G_MLSL_LDS or algorithm == nlopt.G_MLSL:
             # In case these mixed mode (global + local) algorithms are
             # used in the future
-            local_opt = nlopt.opt(nlopt.LN_COBYLA, self.num_params)
+            local_opt = nlopt.opt(nlopt.LN_COBYLA, len(param_names))
             self.opt.set_local_optimizer(local_opt)
 
         self.opt.set_lower_bounds(lb)
@@ -725,6 +1397,6 @@ class OptThread(SimThread):
         self.opt.set_maxeval(num_sims)
 
         # start the optimization: run self.runsim for # iterations in num_sims
-        opt_results = self.opt.optimize(opt_params)
+        best_params = self.opt.optimize(opt_params)
 
-        return opt_results
+        return self._get_opt_results(params_input, param_names, best_params)
@@ -0,0 +1,313 @@
+"""Simulate trials that save or resume from the NEURON simulator state
+
+The functions here run in the MPI ranks of mpi_pool_child.py as well as in
+the GUI process.
+
+Note: this file must not import the hnn package, which would import Qt.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+
+# the versions of hnn-core whose internals simulate_trial mirrors
+_SAVE_STATE_VERSIONS = ['0.1']
+
+
+def check_save_state():
+    """Check that hnn-core has the internals that simulate_trial relies on
+
+    simulate_trial mirrors a private function of hnn-core, so saving and
+    restoring states is only supported with the versions of hnn-core it was
+    copied from. Private names that other versions happen to share don't
+    mean that they simulate the same way.
+
+    Returns
+    -------
+    reason : str | None
+        Why states can't be saved with the installed hnn-core, or None if
+        they can
+    """
+    import hnn_core
+    from hnn_core import Network, network_builder
+
+    version = '.'.join(hnn_core.__version__.split('.')[:2])
+    if version not in _SAVE_STATE_VERSIONS:
+        return "hnn-core %s is not supported, only %s" % \
+            (hnn_core.__version__, ', '.join(_SAVE_STATE_VERSIONS))
+
+    missing = [name for name in ('_PC', '_CVODE', '_simulate_single_trial')
+               if not hasattr(network_builder, name)]
+    if not hasattr(Network, '_instantiate_drives'):
+        missing.append('Network._instantiate_drives')
+    if not hasattr(Network, 'add_evoked_drive'):
+        # the drives are described by Network.external_drives
+        missing.append('Network.external_drives')
+    if len(missing) > 0:
+        return "hnn-core has no %s" % ', '.join(missing)
+    return None
+
+
+def _get_state_bytes(h):
+    """Save the state of this rank with NEURON's SaveState"""
+    ss = h.SaveState()
+    ss.save()
+
+    fd, fname = tempfile.mkstemp(suffix='.dat')
+    os.close(fd)
+    try:
+        state_file = h.File()
+        state_file.wopen(fname)
+        ss.fwrite(state_file)
+        state_file.close()
+        with open(fname, 'rb') as f:
+            state_bytes = f.read()
+    finally:
+        os.remove(fname)
+
+    return state_bytes
+
+
+def _restore_state_bytes(h, neuron_net, state_bytes):
+    """Restore the state of this rank saved by _get_state_bytes
+
+    SaveState also restores the weights of NetCons, which are parameters of
+    the network being continued rather than state, so they are kept.
+    """
+    weights = [(nc, nc.weight[0]) for ncs in neuron_net.ncs.values()
+               for nc in ncs]
+
+    fd, fname = tempfile.mkstemp(suffix='.dat')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(state_bytes)
+        ss = h.SaveState()
+        state_file = h.File()
+        state_file.ropen(fname)
+        ss.fread(state_file)
+        state_file.close()
+    finally:
+        os.remove(fname)
+
+    ss.restore()
+    for nc, weight in weights:
+        nc.weight[0] = weight
+
+    # recordings start over from the restored time
+    h.frecord_init()
+
+
+def _create_injectors(h, neuron_net):
+    """Create the NetCons that send events to the VecStims of the drives
+
+    Events that VecStims schedule for themselves would need their vector of
+    event times to be the same when the state is restored, which is not
+    possible because SaveState restores the pointer to the vector of the
+    process that saved the state. Instead, the VecStims are left empty and
+    every event is sent to them by a NetCon. These must be created before
+    the state is saved or restored, so that the NetCons match.
+    """
+    injectors = dict()
+    for drive_cell in neuron_net._drive_cells:
+        drive_cell.nrn_vecstim.play()
+        injectors[drive_cell.gid] = h.NetCon(None, drive_cell.nrn_vecstim)
+
+    return injectors
+
+
+def _schedule_drives(neuron_net, injectors, t_start, t_stop):
+    """Send the events of all drives in (t_start, t_stop] to their VecStims
+
+    Events after t_stop are left out so that a saved state has no drive
+    events scheduled: they are sent again from the Network of the run that
+    continues from the state.
+    """
+    for drive_cell in neuron_net._drive_cells:
+        event_times = np.array(drive_cell.nrn_eventvec.to_python())
+        if t_start is not None:
+            event_times = event_times[event_times > t_start]
+        event_times = np.sort(event_times[event_times <= t_stop])
+
+        # flag 1 makes the VecStim send a spike at event_time
+        for event_time in event_times:
+            injectors[drive_cell.gid].event(event_time, 1)
+
+
+def simulate_trial(net, trial_idx, state=None, save_state=False):
+    """Simulate one trial, optionally resuming from a saved state
+
+    This mirrors hnn_core.network_builder._simulate_single_trial, which
+    always starts from t=0.
+
+    Parameters
+    ----------
+    net : Network object
+        The Network object specifying how cells are connected. Only the
+        drive events after the time of state are used.
+    trial_idx : int
+        The index of the trial to simulate
+    state : dict | None
+        The state returned by an earlier run of this trial. The simulation
+        runs from the time of the state to tstop. If None, the trial is run
+        from t=0.
+    save_state : bool
+        Whether to save the state at tstop so that the trial can be
+        continued later
+
+    Returns
+    -------
+    dpl : Dipole
+        The dipole from the time of state (or 0) to tstop
+    spikedata : tuple
+        The spiking data as returned by NetworkBuilder.get_data_from_neuron
+    state : dict | None
+        The state at tstop if save_state is True (only on rank 0)
+    """
+    from neuron import h
+    from hnn_core import network_builder
+    from hnn_core.network_builder import (NetworkBuilder, _get_rank,
+                                          _get_nhosts)
+    from hnn_core.dipole import Dipole
+
+    neuron_net = NetworkBuilder(net, trial_idx=trial_idx)
+    pc = network_builder._PC
+    cvode = network_builder._CVODE
+
+    h.load_file("stdrun.hoc")
+
+    rank = _get_rank()
+    nhosts = _get_nhosts()
+
+    t_start = 0.
+    if state is not None:
+        t_start = state['tstop']
+        if len(state['nrn_states']) != nhosts:
+            raise RuntimeError("Cannot continue a simulation saved from %d"
+                               " processes with %d processes" %
+                               (len(state['nrn_states']), nhosts))
+
+    pc.barrier()  # sync for output to screen
+    if rank == 0:
+        print("running trial %d on %d cores from %.2f ms" %
+              (trial_idx + 1, nhosts, t_start))
+
+    h.tstop = net.params['tstop']
+    h.dt = net.params['dt']
+    h.celsius = net.params['celsius']
+
+    times = net.cell_response.times
+    times = times[np.argmin(np.abs(times - t_start)):]
+
+    # the dipole sums must be as long as the part that is simulated
+    for cell_type in neuron_net.dipoles:
+        neuron_net.dipoles[cell_type] = h.Vector(times.size, 0)
+
+    injectors = _create_injectors(h, neuron_net)
+
+    pc.set_maxstep(10)
+    h.finitialize()
+
+    if state is None:
+        _schedule_drives(neuron_net, injectors, None, h.tstop)
+    else:
+        _restore_state_bytes(h, neuron_net, state['nrn_states'][rank])
+        _schedule_drives(neuron_net, injectors, t_start, h.tstop)
+
+    def simulation_time():
+        print('Simulation time: {0} ms...'.format(round(h.t, 2)))
+
+    if rank == 0:
+        for tt in range(int(np.ceil(t_start / 10.)) * 10, int(h.tstop), 10):
+            cvode.event(tt, simulation_time)
+
+    if state is None:
+        h.fcurrent()
+
+    # initialization complete, but wait for all procs to start the solver
+    pc.barrier()
+
+    pc.psolve(h.tstop)
+
+    pc.barrier()
+
+    new_state = None
+    if save_state:
+        nrn_states = pc.py_gather(_get_state_bytes(h), 0)
+        if rank == 0:
+            new_state = {'tstop': h.tstop, 'nrn_states': nrn_states}
+    del injectors
+
+    for cell in neuron_net.cells:
+        if cell.celltype in ('L5_pyramidal', 'L2_pyramidal') and \
+                cell.dipole.size() != times.size:
+            raise RuntimeError("Recorded %d dipole samples, expected %d" %
+                               (cell.dipole.size(), times.size))
+
+    # these calls aggregate data across procs/nodes
+    neuron_net.aggregate_data()
+    pc.allreduce(neuron_net.dipoles['L5_pyramidal'], 1)
+    pc.allreduce(neuron_net.dipoles['L2_pyramidal'], 1)
+
+    # aggregate the currents and voltages independently on each proc
+    vsoma_list = pc.py_gather(neuron_net._vsoma, 0)
+    isoma_list = pc.py_gather(neuron_net._isoma, 0)
+
+    # combine spiking data from each proc
+    spike_times_list = pc.py_gather(neuron_net._spike_times, 0)
+    spike_gids_list = pc.py_gather(neuron_net._spike_gids, 0)
+
+    # only rank 0's lists are complete
+    if rank == 0:
+        for spike_vec in spike_times_list:
+            neuron_net._all_spike_times.append(spike_vec)
+        for spike_vec in spike_gids_list:
+            neuron_net._all_spike_gids.append(spike_vec)
+        for vsoma in vsoma_list:
+            neuron_net._vsoma.update(vsoma)
+        for isoma in isoma_list:
+            neuron_net._isoma.update(isoma)
+
+    pc.barrier()  # get all nodes to this place before continuing
+
+    dpl_l2 = np.array(neuron_net.dipoles['L2_pyramidal'].to_python())
+    dpl_l5 = np.array(neuron_net.dipoles['L5_pyramidal'].to_python())
+    dpl = Dipole(times, np.c_[dpl_l2 + dpl_l5, dpl_l2, dpl_l5])
+
+    return dpl, neuron_net.get_data_from_neuron(), new_state
+
+
+def run_trials(net, trial_indices, states=None, save_state=False):
+    """Run the given trials of one simulation
+
+    Parameters
+    ----------
+    net : Network object
+        The Network object specifying how cells are connected.
+    trial_indices : list of int
+        The trials to simulate
+    states : list of (dict | None) | None
+        The saved state to resume each trial from. None to run all trials
+        from t=0.
+    save_state : bool
+        Whether to save the state of each trial at tstop
+
+    Returns
+    -------
+    sim_data : list of tuple
+        The dipole and spiking data of each trial, in the order of
+        trial_indices. With states or save_state, the state of each trial at
+        tstop (or None) is the third element of each tuple.
+    """
+    from hnn_core.parallel_backends import _clone_and_simulate
+
+    if states is None and not save_state:
+        return [_clone_and_simulate(net, trial_idx)
+                for trial_idx in trial_indices]
+
+    if states is None:
+        states = [None] * len(trial_indices)
+
+    return [simulate_trial(net, trial_idx, state, save_state)
+            for trial_idx, state in zip(trial_indices, states)]
@@ -0,0 +1,194 @@
+"""Disk-backed cache of simulation results keyed on their parameters"""
+
+import os
+import json
+import numbers
+import pickle
+import hashlib
+from glob import glob
+from threading import Lock
+
+import hnn_core
+
+from .paramrw import get_output_dir
+
+# parameters that only change how results are post-processed, saved or
+# displayed, never the simulation itself
+_OUTPUT_ONLY_PARAMS = ['sim_prefix', 'expmt_groups', 'save_figs',
+                       'save_spec_data', 'save_dpl', 'f_max_spec', 'spec_cmap',
+                       'dipole_scalefctr', 'dipole_smooth_win',
+                       'prng_seedcore_opt']
+
+
+def get_cache_key(sim_params, sim_length=None):
+    """Compute a stable hash of the parameters of a simulation
+
+    Parameters
+    ----------
+    sim_params : dict
+        The output of hnn_core_compat_params() used to build the Network
+    sim_length : float | None
+        The length the simulation was limited to, if not the full tstop
+
+    Returns
+    -------
+    key : str
+        The hex digest identifying the simulation
+
+    Notes
+    -----
+    The key must be computed before the simulation is run, because
+    simulate() modifies the parameters of the Network.
+    """
+    normalized = {}
+    for key, val in sim_params.items():
+        if key in _OUTPUT_ONLY_PARAMS:
+            continue
+        if key.startswith('numspikes_'):
+            # simulate() rounds these before building the network
+            val = round(val)
+        if isinstance(val, bool):
+            val = int(val)
+        if isinstance(val, numbers.Real):
+            # 1 and 1.0, or sums with rounding errors, are the same value
+            val = float('%.12g' % val)
+        normalized[key] = val
+
+    if sim_length is not None:
+        sim_length = round(sim_length, 8)
+
+    # results also depend on the version of the simulator
+    desc = json.dumps({'params': normalized, 'sim_length': sim_length,
+                       'hnn_core': hnn_core.__version__}, sort_keys=True)
+
+    return hashlib.sha256(desc.encode()).hexdigest()
+
+
+class SimResultCache(object):
+    """The SimResultCache class.
+
+    Stores the raw results of simulations (dipoles, spikes, vsoma and gid
+    ranges) so that a parameter set that was already simulated does not have
+    to be simulated again. The least recently used entries are evicted when
+    the cache grows beyond max_bytes.
+
+    Parameters
+    ----------
+    cache_dir : str | None
+        Directory where results are stored. If None, then 'cache' in the
+        output directory is used
+    max_bytes : int
+        Maximum size of the cache on disk in bytes
+
+    Attributes
+    ----------
+    cache_dir : str
+        Directory where results are stored
+    max_bytes : int
+        Maximum size of the cache on disk in bytes
+    hits : int
+        Number of lookups that returned a result this session
+    misses : int
+        Number of lookups that did not return a result this session
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=2 * 1024 ** 3):
+        if cache_dir is None:
+            cache_dir = os.path.join(get_output_dir(), 'cache')
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _get_fname(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        """Look up the results of a simulation
+
+        Parameters
+        ----------
+        key : str
+            The key returned by get_cache_key() for the simulation
+
+        Returns
+        -------
+        sim_data : dict | None
+            The dictionary returned by simulate() or None if not cached
+        """
+        fname = self._get_fname(key)
+
+        with self._lock:
+            try:
+                with open(fname, 'rb') as f:
+                    sim_data = pickle.load(f)
+            except FileNotFoundError:
+                sim_data = None
+            except Exception:
+                print("Warning: removing unreadable cache file %s" % fname)
+                os.remove(fname)
+                sim_data = None
+
+            if sim_data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                # mark as most recently used
+                os.utime(fname)
+
+        return sim_data
+
+    def put(self, key, sim_data):
+        """Store the results of a simulation
+
+        Parameters
+        ----------
+        key : str
+            The key returned by get_cache_key() for the simulation
+        sim_data : dict
+            The dictionary returned by simulate()
+        """
+        fname = self._get_fname(key)
+        # unique per process so that concurrent writers don't collide
+        tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+
+        with self._lock:
+            with open(tmp_fname, 'wb') as f:
+                pickle.dump(sim_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_fname, fname)
+
+            self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until under max_bytes"""
+        entries = list()
+        for fname in glob(os.path.join(self.cache_dir, '*.pkl')):
+            try:
+                stat = os.stat(fname)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+
+        total_bytes = sum([entry[1] for entry in entries])
+        for _, size, fname in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(fname)
+            except FileNotFoundError:
+                # already evicted by another process
+                pass
+            total_bytes -= size
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        with self._lock:
+            for fname in glob(os.path.join(self.cache_dir, '*.pkl')):
+                os.remove(fname)
+
+    def status(self):
+        """Return a one-line summary of cache hits and misses"""
+        return "Result cache: %d hits, %d misses" % (self.hits, self.misses)
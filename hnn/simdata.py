@@ -1,30 +1,106 @@
 import os
 import sys
+import hashlib
+import tempfile
 import numpy as np
 from math import ceil
+from numbers import Number
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from threading import Lock, RLock
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
-from pickle import dump, load
-from copy import deepcopy
+from pickle import dump, load, HIGHEST_PROTOCOL
 
 from scipy import signal
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
-from hnn_core import read_spikes
-from hnn_core.dipole import read_dipole, average_dipoles
+from hnn_core import read_spikes, CellResponse
+from hnn_core.dipole import Dipole, read_dipole
 
 from .spikefn import ExtInputs
-from .specfn import plot_spec
+from .dplstats import DipoleEnsemble
+from .specfn import plot_spec, average_spec
 from .paramrw import get_output_dir, get_fname, get_inputs
 from .paramrw import read_gids_param
+from .simfile import open_sim_file
 
 drawindivdpl = 1
 drawavgdpl = 1
 fontsize = plt.rcParams['font.size'] = 10
 
 
-def get_dipoles_from_disk(sim_dir, ntrials):
+def _read_trial_files(read_fn, fnames, errors=(OSError, ValueError),
+                      n_jobs=None):
+    """Read the files of the trials concurrently
+
+    Parameters
+    ----------
+    read_fn : callable
+        Function reading the data of one trial from a file name
+    fnames : list of str
+        The files of the trials
+    errors : tuple of Exception
+        The errors of read_fn that mean a file could not be read
+    n_jobs : int | None
+        The maximum number of files read at once. If None, the number of
+        CPUs is used, but at least 4 since reading mostly waits on the disk.
+
+    Returns
+    ----------
+    results : list of tuple
+        The data of each file, in the order of fnames, and whether it
+        could be read. The data of files that could not be read is None.
+    """
+    def _read(fname):
+        try:
+            return read_fn(fname), True
+        except errors:
+            return None, False
+
+    if n_jobs is None:
+        n_jobs = max(os.cpu_count() or 1, 4)
+    n_jobs = min(n_jobs, len(fnames))
+    if n_jobs <= 1:
+        return [_read(fname) for fname in fnames]
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(_read, fnames))
+
+
+def _get_trial_fnames(sim_dir, pattern, key):
+    """Get the files of the trials, or the old style file of one trial"""
+    glob_list = sorted(glob(str(os.path.join(sim_dir, pattern))))
+    if len(glob_list) == 0:
+        # get the old style filename
+        glob_list = [get_fname(sim_dir, key)]
+    return glob_list
+
+
+def _read_trials(sim_dir, read_fn, fnames):
+    """Read the files of the trials, warning about unreadable ones"""
+    trials = []
+    for fname, (trial, success) in zip(fnames,
+                                       _read_trial_files(read_fn, fnames)):
+        if not success and os.path.exists(sim_dir):
+            print('Warning: could not read file:', fname)
+        trials.append(trial)
+    return trials
+
+
+def _open_sim_file(sim_dir, use_sim_file, name):
+    """Open the results file of a simulation if it has an array"""
+    if not use_sim_file:
+        return None
+    sim_file = open_sim_file(sim_dir)
+    if sim_file is None or name not in sim_file:
+        return None
+    return sim_file
+
+
+def get_dipoles_from_disk(sim_dir, ntrials, use_sim_file=True, raw=False):
     """Read dipole trial data from disk
 
     Parameters
@@ -33,6 +109,11 @@ def get_dipoles_from_disk(sim_dir, ntrials):
         Path of simulation data directory
     ntrials : int
         Number of trials expected to be read from disk
+    use_sim_file : bool
+        If True, read the results file of the simulation if there is one
+        instead of the files of the trials
+    raw : bool
+        If True, read the dipoles before smoothing and scaling
 
     Returns
     ----------
@@ -40,25 +121,16 @@ def get_dipoles_from_disk(sim_dir, ntrials):
         List containing Dipoles of each trial
     """
 
-    dpls = []
-    dpl_fname_pattern = os.path.join(sim_dir, 'dpl_*.txt')
-    glob_list = sorted(glob(str(dpl_fname_pattern)))
-    if len(glob_list) == 0:
-        # get the old style filename
-        glob_list = [get_fname(sim_dir, 'normdpl')]
-
-    for dipole_fn in glob_list:
-        dpl_trial = None
-        try:
-            dpl_trial = read_dipole(dipole_fn)
-        except OSError:
-            if os.path.exists(sim_dir):
-                print('Warning: could not read file:', dipole_fn)
-        except ValueError:
-            if os.path.exists(sim_dir):
-                print('Warning: could not read file:', dipole_fn)
-
-        dpls.append(dpl_trial)
+    sim_file = _open_sim_file(sim_dir, use_sim_file,
+                              'raw_dpls' if raw else 'dpls')
+    if sim_file is not None:
+        dpls = sim_file.read_dipoles(raw=raw)
+    elif raw:
+        glob_list = _get_trial_fnames(sim_dir, 'rawdpl_*.txt', 'rawdpl')
+        dpls = _read_trials(sim_dir, read_dipole, glob_list)
+    else:
+        glob_list = _get_trial_fnames(sim_dir, 'dpl_*.txt', 'normdpl')
+        dpls = _read_trials(sim_dir, read_dipole, glob_list)
 
     if len(dpls) == 0:
         print("Warning: no dipole(s) read from %s" % sim_dir)
@@ -70,73 +142,112 @@ def get_dipoles_from_disk(sim_dir, ntrials):
     return dpls
 
 
-def read_spectrials(sim_dir):
-    """read spectrogram data files for individual trials"""
-    spec_list = []
+def read_dpl_stats(sim_dir, ntrials, use_sim_file=True, n_jobs=None):
+    """Read the statistics of the trial dipoles from disk
 
-    spec_fname_pattern = os.path.join(sim_dir, 'rawspec_*.npz')
-    glob_list = sorted(glob(str(spec_fname_pattern)))
-    if len(glob_list) == 0:
-        # get the old style filename
-        glob_list = [get_fname(sim_dir, 'rawspec')]
+    The trials are added to the statistics as they are read, so that all of
+    them are never in memory at once.
 
-    for spec_fn in glob_list:
-        spec_trial = None
-        try:
-            with np.load(spec_fn, allow_pickle=True) as spec_data:
-                # need to make a copy of data so we can close NpzFile
-                spec_trial = dict(spec_data)
-        except OSError:
-            if os.path.exists(sim_dir):
-                print('Warning: could not read file:', spec_fn)
-        except ValueError:
-            if os.path.exists(sim_dir):
-                print('Warning: could not read file:', spec_fn)
+    Parameters
+    ----------
+    sim_dir : str
+        Path of simulation data directory
+    ntrials : int
+        Number of trials expected to be read from disk
+    use_sim_file : bool
+        If True, read the results file of the simulation if there is one
+        instead of the files of the trials
+    n_jobs : int | None
+        The number of files of trials read at once. If None, as many as
+        _read_trial_files reads concurrently.
 
-        spec_list.append(spec_trial)
+    Returns
+    ----------
+    dpl_stats : DipoleEnsemble
+        The statistics of the dipoles of the trials that could be read
+    """
 
-    return spec_list
+    dpl_stats = DipoleEnsemble()
+    sim_file = _open_sim_file(sim_dir, use_sim_file, 'dpls')
+    if sim_file is not None:
+        # the trials are views of the memory-mapped dipoles
+        dpl_stats.add_trials(sim_file.read_dipoles())
+    else:
+        glob_list = _get_trial_fnames(sim_dir, 'dpl_*.txt', 'normdpl')
+        if n_jobs is None:
+            n_jobs = max(os.cpu_count() or 1, 4)
+        for start_idx in range(0, len(glob_list), n_jobs):
+            dpls = _read_trials(sim_dir, read_dipole,
+                                glob_list[start_idx:start_idx + n_jobs])
+            dpl_stats.add_trials([dpl for dpl in dpls if dpl is not None])
+
+    if dpl_stats.n_trials == 0:
+        print("Warning: no dipole(s) read from %s" % sim_dir)
+    elif dpl_stats.n_trials < ntrials:
+        print("Warning: only read %d of %d dipole files in %s" %
+              (dpl_stats.n_trials, ntrials, sim_dir))
 
+    return dpl_stats
 
-def read_vsomatrials(sim_dir):
-    """read somatic voltage data files for individual trials"""
-    vsoma_list = []
 
-    vsoma_fname_pattern = os.path.join(sim_dir, 'vsoma_*.pkl')
-    glob_list = sorted(glob(str(vsoma_fname_pattern)))
-    if len(glob_list) == 0:
-        # get the old style filename
-        glob_list = [get_fname(sim_dir, 'vsoma')]
+def _read_spec_file(spec_fn):
+    with np.load(spec_fn, allow_pickle=True) as spec_data:
+        # need to make a copy of data so we can close NpzFile
+        return dict(spec_data)
 
-    for vsoma_fn in glob_list:
-        vsoma_trial = None
-        try:
-            with open(vsoma_fn, 'rb') as f:
-                vsoma_trial = load(f)
-        except OSError:
-            if os.path.exists(sim_dir):
-                print('Warning: could not read file:', vsoma_fn)
-        except ValueError:
-            if os.path.exists(sim_dir):
-                print('Warning: could not read file:', vsoma_fn)
 
-        vsoma_list.append(vsoma_trial)
+def read_spectrials(sim_dir, use_sim_file=True):
+    """read spectrogram data files for individual trials"""
+    sim_file = _open_sim_file(sim_dir, use_sim_file, 'spec/TFR')
+    if sim_file is not None:
+        return sim_file.read_spec()
+
+    glob_list = _get_trial_fnames(sim_dir, 'rawspec_*.npz', 'rawspec')
+    return _read_trials(sim_dir, _read_spec_file, glob_list)
+
+
+def _read_vsoma_file(vsoma_fn):
+    with open(vsoma_fn, 'rb') as f:
+        return load(f)
+
 
-    return vsoma_list
+def read_vsomatrials(sim_dir, use_sim_file=True):
+    """read somatic voltage data files for individual trials"""
+    sim_file = _open_sim_file(sim_dir, use_sim_file, 'vsoma')
+    if sim_file is not None:
+        return sim_file.read_vsoma()
+
+    glob_list = _get_trial_fnames(sim_dir, 'vsoma_*.pkl', 'vsoma')
+    return _read_trials(sim_dir, _read_vsoma_file, glob_list)
 
 
-def read_spktrials(sim_dir, gid_ranges):
+def read_spktrials(sim_dir, gid_ranges, use_sim_file=True):
+    sim_file = _open_sim_file(sim_dir, use_sim_file, 'spike_times')
+    if sim_file is not None:
+        return sim_file.read_spikes()
+
     spk_fname_pattern = os.path.join(sim_dir, 'spk_*.txt')
-    if len(glob(str(spk_fname_pattern))) == 0:
+    glob_list = sorted(glob(str(spk_fname_pattern)))
+    if len(glob_list) == 0:
         # if legacy HNN only ran one trial, then no spk_0.txt gets written
-        spk_fname_pattern = get_fname(sim_dir, 'rawspk')
+        glob_list = [get_fname(sim_dir, 'rawspk')]
 
-    try:
-        spikes = read_spikes(spk_fname_pattern, gid_ranges)
-    except FileNotFoundError:
-        print('Warning: could not read file:', spk_fname_pattern)
+    def _read_spk_file(spk_fn):
+        return read_spikes(spk_fn, gid_ranges)
 
-    return spikes
+    spike_times, spike_gids, spike_types = list(), list(), list()
+    results = _read_trial_files(_read_spk_file, glob_list,
+                                errors=(FileNotFoundError,))
+    for spk_fn, (spikes, success) in zip(glob_list, results):
+        if not success:
+            print('Warning: could not read file:', spk_fn)
+            continue
+        spike_times.extend(spikes.spike_times)
+        spike_gids.extend(spikes.spike_gids)
+        spike_types.extend(spikes.spike_types)
+
+    return CellResponse(spike_times=spike_times, spike_gids=spike_gids,
+                        spike_types=spike_types)
 
 
 def check_feeds_to_plot(feeds_from_spikes, params):
@@ -227,11 +338,561 @@ def plot_hists_on_gridspec(figure, gridspec, feeds_to_plot, extinputs, times,
     return axes
 
 
+def _freeze_arrays(data):
+    """Make the arrays of simulation results read-only
+
+    Read-only results are shared between sim_data and opt_data instead of
+    copied. Code that modifies them must copy them first.
+
+    Parameters
+    ----------
+    data : object
+        A Dipole, array or spectral analysis, or a dict, list or tuple of
+        them. Other objects are left as they are.
+    """
+    if isinstance(data, np.ndarray):
+        data.setflags(write=False)
+    elif isinstance(data, Dipole):
+        _freeze_arrays(data.times)
+        _freeze_arrays(data.data)
+    elif isinstance(data, dict):
+        for val in data.values():
+            _freeze_arrays(val)
+    elif isinstance(data, _LazySimData):
+        # results that haven't been read yet are frozen when read
+        _freeze_arrays(data.get_loaded())
+    elif isinstance(data, (list, tuple)):
+        # lists of numbers, like the recorded voltages, have no arrays
+        if len(data) > 0 and isinstance(data[0], Number):
+            return
+        for val in data:
+            _freeze_arrays(val)
+
+
+def get_avg_spec(data, ntrial=None):
+    """Get the trial average of the spectral analyses of a simulation
+
+    The average is cached in the results as 'avg_spec', so that it's
+    calculated once for each simulation instead of on each redraw.
+
+    Parameters
+    ----------
+    data : dict
+        The results of a simulation in SimData
+    ntrial : int | None
+        The number of trials to average, starting with the first. If None,
+        all trials are averaged.
+
+    Returns
+    ----------
+    avg_spec : dict
+        The average returned by average_spec
+    """
+    spec = data['spec']
+    if ntrial is None:
+        ntrial = len(spec)
+    avg_spec = data.get('avg_spec')
+    if avg_spec is None or avg_spec['n_trials'] != ntrial:
+        avg_spec = average_spec(spec, ntrial)
+        _freeze_arrays(avg_spec)
+        data['avg_spec'] = avg_spec
+    return avg_spec
+
+
+def get_dpl_stats(data):
+    """Get the statistics of the trial dipoles of a simulation
+
+    Simulations post-processed by postproc_dipoles or read from disk have
+    them already. Otherwise they are calculated from the trial dipoles and
+    cached in the results as 'dpl_stats'.
+
+    Parameters
+    ----------
+    data : dict
+        The results of a simulation in SimData
+
+    Returns
+    ----------
+    dpl_stats : DipoleEnsemble
+        The statistics of the dipoles of the trials
+    """
+    dpl_stats = data.get('dpl_stats')
+    if dpl_stats is None:
+        dpl_stats = DipoleEnsemble().add_trials(data['dpls'])
+        data['dpl_stats'] = dpl_stats
+    return dpl_stats
+
+
+def _share_data(data):
+    """Copy the dict of simulation results, sharing the read-only results
+
+    The lists of trials are copied so that changing one of them doesn't
+    change the other.
+    """
+    if isinstance(data, _LazySimData):
+        return data.copy()
+    return {key: list(val) if isinstance(val, list) else val
+            for key, val in data.items()}
+
+
+class _LazySimData(MutableMapping):
+    """The results of a simulation, read from disk when first accessed
+
+    Each of the trial dipoles, spikes, spectral analyses and somatic
+    voltages is read the first time it is accessed, so that showing a
+    simulation only reads what is plotted. The statistics of the trial
+    dipoles, including the average dipole, are computed while reading the
+    trials one at a time, without keeping them. When pickled, for example
+    when spilled by SimStore, the results that were read are left out and
+    read again when accessed.
+
+    Parameters
+    ----------
+    sim_dir : str
+        Path of simulation data directory
+    params : dict
+        Dictionary containing parameters
+    gid_ranges : dict
+        The gid ranges of the cell types of the network
+    """
+
+    _keys = ('dpls', 'avg_dpl', 'dpl_stats', 'spikes', 'gid_ranges', 'spec',
+             'vsoma')
+
+    def __init__(self, sim_dir, params, gid_ranges):
+        self._sim_dir = sim_dir
+        self._ntrials = params['N_trials']
+        using_feeds = get_inputs(params)
+        self._read_spec = params['save_spec_data'] or \
+            using_feeds['ongoing'] or using_feeds['pois'] or \
+            using_feeds['tonic']
+        self._read_vsoma = params['record_vsoma']
+        self._values = {'gid_ranges': gid_ranges}
+        # the keys of the values read from disk
+        self._loaded = set()
+
+    def _load(self, key):
+        if key == 'dpls':
+            return get_dipoles_from_disk(self._sim_dir, self._ntrials)
+        elif key == 'avg_dpl':
+            return self['dpl_stats'].get_avg_dpl()
+        elif key == 'dpl_stats':
+            if 'dpls' in self._values:
+                return DipoleEnsemble().add_trials(self['dpls'])
+            return read_dpl_stats(self._sim_dir, self._ntrials)
+        elif key == 'spikes':
+            spikes = read_spktrials(self._sim_dir, self['gid_ranges'])
+            if len(spikes.spike_times) < self._ntrials:
+                print("Warning: only read %d of %d spike files in %s" %
+                      (len(spikes.spike_times), self._ntrials,
+                       self._sim_dir))
+            return spikes
+        elif key == 'spec':
+            if not self._read_spec:
+                return None
+            spec = read_spectrials(self._sim_dir)
+            if len(spec) == 0:
+                print("Warning: no spec data read from %s" % self._sim_dir)
+            elif len(spec) < self._ntrials:
+                print("Warning: only read %d of %d spec files in %s" %
+                      (len(spec), self._ntrials, self._sim_dir))
+            return spec
+        elif key == 'vsoma':
+            if not self._read_vsoma:
+                return None
+            vsoma = read_vsomatrials(self._sim_dir)
+            if len(vsoma) == 0:
+                print("Warning: no somatic voltages read from %s" %
+                      self._sim_dir)
+            elif len(vsoma) < self._ntrials:
+                print("Warning: only read %d of %d voltage files in %s" %
+                      (len(vsoma), self._ntrials, self._sim_dir))
+            return vsoma
+        raise KeyError(key)
+
+    def get_loaded(self):
+        """Return a dict of the results that have been read so far"""
+        return dict(self._values)
+
+    def copy(self):
+        """Copy the results, sharing the ones that have been read"""
+        data = _LazySimData.__new__(_LazySimData)
+        data.__dict__.update(self.__dict__)
+        data._values = {key: list(val) if isinstance(val, list) else val
+                        for key, val in self._values.items()}
+        data._loaded = set(self._loaded)
+        return data
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_values'] = {key: val for key, val in self._values.items()
+                            if key not in self._loaded}
+        state['_loaded'] = set()
+        return state
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            value = self._load(key)
+            _freeze_arrays(value)
+            self._values[key] = value
+            self._loaded.add(key)
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._loaded.discard(key)
+
+    def __delitem__(self, key):
+        del self._values[key]
+        self._loaded.discard(key)
+
+    def __contains__(self, key):
+        return key in self._keys or key in self._values
+
+    def __iter__(self):
+        keys = list(self._keys)
+        keys.extend([key for key in self._values if key not in keys])
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+class _ErrPlan(object):
+    """How a simulated dipole is aligned with experimental data
+
+    Experimental files whose data is compared with the same window of the
+    simulation, resampled to the same length, form a group. The data of
+    each group is resampled once and stacked in a matrix, so that the
+    errors of all its columns are calculated together.
+    """
+
+    def __init__(self, exp_data, sim_times, tstart, tstop, weights):
+        self.groups = dict()
+        self.n_cols = 0
+
+        for dat in exp_data.values():
+            exp_times = dat[:, 0]
+
+            # do tstart and tstop fall within both datasets?
+            # if not, use the closest data point as the new tstop/tstart
+            for tseries in [exp_times, sim_times]:
+                if tstart < tseries[0]:
+                    tstart = tseries[0]
+                if tstop > tseries[-1]:
+                    tstop = tseries[-1]
+
+            # make sure start and end times are valid for both dipoles
+            exp_start_index = (np.abs(exp_times - tstart)).argmin()
+            exp_end_index = (np.abs(exp_times - tstop)).argmin()
+            exp_length = exp_end_index - exp_start_index
+
+            sim_start_index = (np.abs(sim_times - tstart)).argmin()
+            sim_end_index = (np.abs(sim_times - tstop)).argmin()
+            sim_length = sim_end_index - sim_start_index
+
+            exp_cols = dat[exp_start_index:exp_end_index, 1:]
+            if sim_length < exp_length:
+                # downsample exp timeseries to match simulation data
+                exp_cols = signal.resample(exp_cols, sim_length, axis=0)
+            length = min(sim_length, exp_length)
+
+            col_indices = np.arange(self.n_cols,
+                                    self.n_cols + exp_cols.shape[1])
+            self.n_cols += exp_cols.shape[1]
+
+            group_key = (sim_start_index, sim_end_index, length)
+            if group_key in self.groups:
+                group = self.groups[group_key]
+                group['exp_cols'] = np.c_[group['exp_cols'], exp_cols]
+                group['col_indices'] = np.r_[group['col_indices'],
+                                             col_indices]
+                continue
+
+            weight = None
+            if weights is not None:
+                weight = weights[sim_start_index:sim_end_index]
+                if sim_length > exp_length:
+                    weight = signal.resample(weight, exp_length)
+                    weight[weight < 1e-4] = 0
+
+            self.groups[group_key] = {'exp_cols': exp_cols,
+                                      'col_indices': col_indices,
+                                      'weight': weight}
+
+    def calc(self, sim_dpl):
+        """The error of each column of the experimental data"""
+        errs = np.zeros(self.n_cols)
+        for (start, end, length), group in self.groups.items():
+            dpl = sim_dpl[start:end]
+            if len(dpl) > length:
+                # downsample simulation timeseries to match exp data
+                dpl = signal.resample(dpl, length)
+
+            sq_diffs = (dpl[:, np.newaxis] - group['exp_cols']) ** 2
+            weight = group['weight']
+            if weight is not None:
+                errs[group['col_indices']] = np.sqrt(
+                    weight.dot(sq_diffs) / weight.sum())
+            else:
+                errs[group['col_indices']] = np.sqrt(sq_diffs.mean(axis=0))
+        return errs
+
+
+# plans are reused by every evaluation of an optimization step and every
+# redraw of the dipole canvas
+_err_plans = OrderedDict()
+_err_plans_lock = Lock()
+_MAX_ERR_PLANS = 16
+
+
+def _get_array_key(arr):
+    arr = np.ascontiguousarray(arr)
+    return (arr.shape, hashlib.sha1(arr.tobytes()).hexdigest())
+
+
+def _get_err_plan(exp_data, sim_times, tstart, tstop, weights):
+    """Get a cached _ErrPlan or make a new one
+
+    The experimental data, which can be memory-mapped files of many MB, is
+    identified by its file name and the identity of its read-only array
+    instead of its contents. The cached plan keeps a reference to the
+    arrays, so that their ids are not reused by other arrays.
+    """
+    exp_arrays = tuple(exp_data.values())
+    key = (tuple((exp_fn, id(dat)) for exp_fn, dat in exp_data.items()),
+           (len(sim_times), sim_times[0], sim_times[-1]), tstart, tstop,
+           None if weights is None else _get_array_key(weights))
+
+    with _err_plans_lock:
+        entry = _err_plans.get(key)
+        if entry is not None:
+            _err_plans.move_to_end(key)
+            return entry[0]
+
+    plan = _ErrPlan(exp_data, sim_times, tstart, tstop, weights)
+    with _err_plans_lock:
+        _err_plans[key] = (plan, exp_arrays)
+        while len(_err_plans) > _MAX_ERR_PLANS:
+            _err_plans.popitem(last=False)
+    return plan
+
+
+def calc_dipole_err(exp_data, avg_dpl, tstop, tstart=0.0, weights=None):
+    """Calculate root mean squared error of a dipole
+
+    Parameters
+    ----------
+    exp_data : dict
+        The data from np.loadtxt() of each experimental data file
+    avg_dpl : Dipole
+        The (average) simulated dipole
+    tstop : float
+        Time in ms defining the end of the region to calculate RMSE
+    tstart : float
+        Time in ms defining the start of the region to calculate RMSE
+    weights : array | None
+        An array containing weights for each data point of the simulation.
+        If weights is provided, then the weighted root mean square error
+        will be returned. If None is provided, then standard RMSE will be
+        returned.
+
+    Returns
+    ----------
+    lerr : list of floats
+        A list of RMSE values between the simulation and each experimental
+        data file
+    errtot : float
+        Average RMSE over all experimental data files
+    """
+
+    if len(exp_data) == 0:
+        return [], 0.0
+
+    plan = _get_err_plan(exp_data, avg_dpl.times, tstart, tstop, weights)
+    errs = plan.calc(avg_dpl.data['agg'])
+
+    errtot = 0.0
+    if len(errs) > 0:
+        errtot = float(errs.mean())
+    return errs.tolist(), errtot
+
+
+def _get_nbytes(data):
+    """Estimate the memory used by simulation results"""
+    if isinstance(data, np.memmap):
+        # read from a results file by the OS as needed
+        return 0
+    elif isinstance(data, np.ndarray):
+        return data.nbytes
+    elif isinstance(data, dict):
+        return sum([_get_nbytes(val) for val in data.values()])
+    elif isinstance(data, _LazySimData):
+        return _get_nbytes(data.get_loaded())
+    elif isinstance(data, (list, tuple)):
+        if len(data) > 0 and isinstance(data[0], Number):
+            # pointer and float object of each element
+            return 32 * len(data)
+        return sum([_get_nbytes(val) for val in data])
+    elif hasattr(data, '__dict__'):
+        # Dipole, CellResponse
+        return _get_nbytes(vars(data))
+    return sys.getsizeof(data)
+
+
+class SimStore(MutableMapping):
+    """The SimStore class.
+
+    A dict of the simulations of SimData that keeps at most max_bytes of
+    them in memory. The least recently accessed simulations are spilled to
+    pickle files and loaded again transparently when accessed. Keys are
+    iterated in the order they were added, regardless of where their
+    simulations are.
+
+    Parameters
+    ----------
+    max_bytes : int | None
+        Memory budget of the simulations in bytes. If None, all simulations
+        are kept in memory.
+    spill_dir : str | None
+        Directory for the spilled simulations. If None, a temporary
+        directory that is removed on exit is used.
+
+    Attributes
+    ----------
+    max_bytes : int | None
+        Memory budget of the simulations in bytes
+    mem_bytes : int
+        Estimated memory used by the simulations in memory
+    n_spilled : int
+        The number of simulations spilled to disk
+    """
+
+    def __init__(self, max_bytes=None, spill_dir=None):
+        self.max_bytes = max_bytes
+        self._spill_dir = spill_dir
+        self._tmp_dir = None
+        # all keys in the order they were added
+        self._keys = OrderedDict()
+        # the simulations in memory, least recently used first
+        self._entries = OrderedDict()
+        self._nbytes = dict()
+        self._spilled = dict()
+        self._lock = RLock()
+
+    @property
+    def mem_bytes(self):
+        return sum(self._nbytes.values())
+
+    @property
+    def n_spilled(self):
+        return len(self._spilled)
+
+    def _get_spill_fname(self, key):
+        if self._spill_dir is None:
+            self._tmp_dir = tempfile.TemporaryDirectory(prefix='hnn_sims_')
+            self._spill_dir = self._tmp_dir.name
+        os.makedirs(self._spill_dir, exist_ok=True)
+        fname = hashlib.sha1(key.encode()).hexdigest() + '.pkl'
+        return os.path.join(self._spill_dir, fname)
+
+    def _spill(self, key):
+        fname = self._get_spill_fname(key)
+        with open(fname, 'wb') as f:
+            dump(self._entries.pop(key), f, protocol=HIGHEST_PROTOCOL)
+        del self._nbytes[key]
+        self._spilled[key] = fname
+
+    def _unspill(self, key):
+        fname = self._spilled.pop(key)
+        with open(fname, 'rb') as f:
+            entry = load(f)
+        os.remove(fname)
+        _freeze_arrays(entry.get('data'))
+        return entry
+
+    def evict(self, keep=None):
+        """Spill the least recently used simulations until within budget
+
+        Parameters
+        ----------
+        keep : str | None
+            A key to keep in memory even if over budget
+        """
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            for key in list(self._entries):
+                if self.mem_bytes <= self.max_bytes:
+                    break
+                if key != keep:
+                    self._spill(key)
+
+    def __getitem__(self, key):
+        with self._lock:
+            if key in self._spilled:
+                self._entries[key] = self._unspill(key)
+                self._nbytes[key] = _get_nbytes(self._entries[key])
+                self.evict(keep=key)
+            entry = self._entries[key]
+            self._entries.move_to_end(key)
+            if isinstance(entry.get('data'), _LazySimData):
+                # results read from disk since the last access
+                self._nbytes[key] = _get_nbytes(entry)
+                self.evict(keep=key)
+            return entry
+
+    def __setitem__(self, key, entry):
+        with self._lock:
+            if key in self._spilled:
+                os.remove(self._spilled.pop(key))
+            self._keys[key] = None
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._nbytes[key] = _get_nbytes(entry)
+            self.evict(keep=key)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._keys[key]
+            if key in self._spilled:
+                os.remove(self._spilled.pop(key))
+            else:
+                del self._entries[key]
+                del self._nbytes[key]
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def clear(self):
+        """Remove all simulations without loading spilled ones"""
+        with self._lock:
+            for fname in self._spilled.values():
+                os.remove(fname)
+            self._spilled.clear()
+            self._entries.clear()
+            self._nbytes.clear()
+            self._keys.clear()
+
+
 class SimData(object):
-    """The SimData class"""
+    """The SimData class
+
+    Parameters
+    ----------
+    max_bytes : int | None
+        Memory budget of the simulations in bytes. Simulations beyond it
+        are spilled to disk. If None, all simulations are kept in memory.
+    """
 
-    def __init__(self):
-        self._sim_data = {}
+    def __init__(self, max_bytes=None):
+        self._sim_data = SimStore(max_bytes)
         self._opt_data = {'initial_dpl': None,
                           'initial_error': sys.float_info.max}
         self._exp_data = {}
@@ -248,10 +909,12 @@ class SimData(object):
         del self._sim_data[paramfn]
 
     def update_sim_data(self, paramfn, params, dpls, avg_dpl, spikes,
-                        gid_ranges, spec=None, vsoma=None):
+                        gid_ranges, spec=None, vsoma=None, dpl_stats=None):
+        _freeze_arrays([dpls, avg_dpl, spec, vsoma])
         self._sim_data[paramfn] = {'params': params,
                                    'data': {'dpls': dpls,
                                             'avg_dpl': avg_dpl,
+                                            'dpl_stats': dpl_stats,
                                             'spikes': spikes,
                                             'gid_ranges': gid_ranges,
                                             'spec': spec, 'vsoma': vsoma}}
@@ -266,6 +929,28 @@ class SimData(object):
 
         self._sim_data.clear()
 
+    def set_max_bytes(self, max_bytes):
+        """Change the memory budget of the simulations
+
+        Parameters
+        ----------
+        max_bytes : int | None
+            Memory budget of the simulations in bytes. If None, all
+            simulations are kept in memory.
+        """
+
+        self._sim_data.max_bytes = max_bytes
+        self._sim_data.evict()
+
+    def get_max_bytes(self):
+        return self._sim_data.max_bytes
+
+    def memory_status(self):
+        """Return a one-line summary of the memory used by simulations"""
+
+        return "Simulations: %.1f MB in memory, %d on disk" % \
+            (self._sim_data.mem_bytes / 1024 ** 2, self._sim_data.n_spilled)
+
     def update_exp_data(self, exp_fn, exp_data):
         """Adds experimental data to SimData
 
@@ -274,8 +959,11 @@ class SimData(object):
         exp_fn : str
             Filename of experimental data
         exp_data : array
-            Data from np.loadtxt() on experimental data file
+            Data from np.loadtxt() on experimental data file. It is made
+            read-only, because RMSE calculations identify it by the array
+            rather than its contents.
         """
+        _freeze_arrays(exp_data)
         self._exp_data[exp_fn] = exp_data
 
     def get_exp_data_size(self):
@@ -289,6 +977,18 @@ class SimData(object):
 
         return len(self._exp_data)
 
+    def get_exp_data(self):
+        """Get the experimental data for use outside of the GUI thread
+
+        Returns
+        ----------
+        exp_data : dict
+            The data of each experimental data file in SimData. Files that
+            are loaded or cleared later are not added to or removed from it.
+        """
+
+        return dict(self._exp_data)
+
     def update_sim_data_from_disk(self, paramfn, params):
         """Adds simulation data to SimData
 
@@ -310,57 +1010,37 @@ class SimData(object):
             self.update_sim_data(paramfn, params, None, None, None, None)
             return False
 
-        dpls = get_dipoles_from_disk(sim_dir, params['N_trials'])
-        if len(dpls) == 0:
+        # only check that the results exist, they are read when accessed
+        sim_file = open_sim_file(sim_dir)
+        if sim_file is None and \
+                len(glob(os.path.join(sim_dir, 'dpl_*.txt'))) == 0 and \
+                not os.path.exists(get_fname(sim_dir, 'normdpl')):
+            print("Warning: no dipole(s) read from %s" % sim_dir)
             self.update_sim_data(paramfn, params, None, None, None, None)
             return False
-        elif len(dpls) == 1:
-            avg_dpl = dpls[0]
-        else:
-            avg_dpl = average_dipoles(dpls)
 
         warning_message = 'Warning: could not read file:'
         # gid_ranges
         paramtxt_fn = get_fname(sim_dir, 'param')
         try:
-            gid_ranges = read_gids_param(paramtxt_fn)
+            if sim_file is not None:
+                gid_ranges = sim_file.read_gid_ranges()
+            else:
+                gid_ranges = read_gids_param(paramtxt_fn)
         except FileNotFoundError:
             print(warning_message, paramtxt_fn)
             return False
 
         # spikes
-        spikes = read_spktrials(sim_dir, gid_ranges)
-        if len(spikes.spike_times) == 0:
+        if sim_file is None and \
+                len(glob(os.path.join(sim_dir, 'spk_*.txt'))) == 0 and \
+                not os.path.exists(get_fname(sim_dir, 'rawspk')):
             print("Warning: no spikes read from %s" % sim_dir)
             return False
-        elif len(spikes.spike_times) < params['N_trials']:
-            print("Warning: only read %d of %d spike files in %s" %
-                  (len(spikes.spike_times), params['N_trials'], sim_dir))
-
-        # spec data
-        spec = None
-        using_feeds = get_inputs(params)
-        if params['save_spec_data'] or using_feeds['ongoing'] or \
-                using_feeds['pois'] or using_feeds['tonic']:
-            spec = read_spectrials(sim_dir)
-            if len(spec) == 0:
-                print("Warning: no spec data read from %s" % sim_dir)
-            elif len(spec) < params['N_trials']:
-                print("Warning: only read %d of %d spec files in %s" %
-                      (len(spec), params['N_trials'], sim_dir))
 
-        # somatic voltages
-        vsoma = None
-        if params['record_vsoma']:
-            vsoma = read_vsomatrials(sim_dir)
-            if len(vsoma) == 0:
-                print("Warning: no somatic voltages read from %s" % sim_dir)
-            elif len(vsoma) < params['N_trials']:
-                print("Warning: only read %d of %d voltage files in %s" %
-                      (len(vsoma), params['N_trials'], sim_dir))
-
-        self.update_sim_data(paramfn, params, dpls, avg_dpl, spikes,
-                             gid_ranges, spec, vsoma)
+        self._sim_data[paramfn] = {'params': params,
+                                   'data': _LazySimData(sim_dir, params,
+                                                        gid_ranges)}
 
         return True
 
@@ -392,63 +1072,9 @@ class SimData(object):
             Average RMSE over all experimental data files
         """
 
-        NSig = errtot = 0.0
-        lerr = []
-        for _, dat in self._exp_data.items():
-            shp = dat.shape
-
-            exp_times = dat[:, 0]
-            sim_times = self._sim_data[paramfn]['data']['avg_dpl'].times
-
-            # do tstart and tstop fall within both datasets?
-            # if not, use the closest data point as the new tstop/tstart
-            for tseries in [exp_times, sim_times]:
-                if tstart < tseries[0]:
-                    tstart = tseries[0]
-                if tstop > tseries[-1]:
-                    tstop = tseries[-1]
-
-            # make sure start and end times are valid for both dipoles
-            exp_start_index = (np.abs(exp_times - tstart)).argmin()
-            exp_end_index = (np.abs(exp_times - tstop)).argmin()
-            exp_length = exp_end_index - exp_start_index
-
-            sim_start_index = (np.abs(sim_times - tstart)).argmin()
-            sim_end_index = (np.abs(sim_times - tstop)).argmin()
-            sim_length = sim_end_index - sim_start_index
-
-            if weights is not None:
-                weight = weights[sim_start_index:sim_end_index]
-
-            for c in range(1, shp[1], 1):
-                sim_dpl = self._sim_data[paramfn]['data']['avg_dpl']
-                dpl1 = sim_dpl.data['agg'][sim_start_index:sim_end_index]
-                dpl2 = dat[exp_start_index:exp_end_index, c]
-
-                if (sim_length > exp_length):
-                    # downsample simulation timeseries to match exp data
-                    dpl1 = signal.resample(dpl1, exp_length)
-                    if weights is not None:
-                        weight = signal.resample(weight, exp_length)
-                        indices = np.where(weight < 1e-4)
-                        weight[indices] = 0
-
-                elif (sim_length < exp_length):
-                    # downsample exp timeseries to match simulation data
-                    dpl2 = signal.resample(dpl2, sim_length)
-
-                if weights is not None:
-                    err0 = np.sqrt((weight * ((dpl1 - dpl2) ** 2)).sum() /
-                                   weight.sum())
-                else:
-                    err0 = np.sqrt(((dpl1 - dpl2) ** 2).mean())
-                lerr.append(err0)
-                errtot += err0
-                NSig += 1
-
-        if not NSig == 0.0:
-            errtot /= NSig
-        return lerr, errtot
+        return calc_dipole_err(self._exp_data,
+                               self._sim_data[paramfn]['data']['avg_dpl'],
+                               tstop, tstart, weights)
 
     def clear_opt_data(self):
         self._opt_data = {'initial_dpl': None,
@@ -461,25 +1087,46 @@ class SimData(object):
 
     def update_opt_data(self, paramfn, params, avg_dpl, dpls=None,
                         spikes=None, gid_ranges=None, spec=None,
-                        vsoma=None):
+                        vsoma=None, dpl_stats=None):
+        _freeze_arrays([dpls, avg_dpl, spec, vsoma])
         self._opt_data = {'initial_dpl': self._opt_data['initial_dpl'],
                           'initial_error': self._opt_data['initial_error'],
                           'paramfn': paramfn,
                           'params': params,
-                          'data': {'dpls': None,
+                          'data': {'dpls': dpls,
                                    'avg_dpl': avg_dpl,
-                                   'spikes': None,
-                                   'gid_ranges': None,
-                                   'spec': None,
-                                   'vsoma': None}}
+                                   'dpl_stats': dpl_stats,
+                                   'spikes': spikes,
+                                   'gid_ranges': gid_ranges,
+                                   'spec': spec,
+                                   'vsoma': vsoma}}
+
+    def update_opt_data_from_result(self, result):
+        """Show the best simulation of an optimization so far
+
+        The optimization thread doesn't modify result after sending it, so
+        it is not copied.
+
+        Parameters
+        ----------
+        result : ResultObj
+            The post-processed results (data) of a simulation of params
+        """
+        sim_data = result.data
+        paramfn = os.path.join(get_output_dir(), 'param',
+                               result.params['sim_prefix'] + '.param')
+        self.update_opt_data(paramfn, result.params, sim_data['avg_dpl'],
+                             sim_data['dpls'], sim_data['spikes'],
+                             sim_data['gid_ranges'], sim_data.get('spec'),
+                             sim_data['vsoma'], sim_data.get('dpl_stats'))
 
     def update_initial_opt_data_from_sim_data(self, event, paramfn):
         if paramfn not in self._sim_data:
             raise ValueError("Simulation not in sim_data: %s" % paramfn)
 
+        # read-only, so it can be shared
         single_sim_data = self._sim_data[paramfn]['data']
-        self._opt_data['initial_dpl'] = \
-            deepcopy(single_sim_data['avg_dpl'])
+        self._opt_data['initial_dpl'] = single_sim_data['avg_dpl']
         self._opt_data['initial_error'] = self.get_err(paramfn)
 
         event.set()
@@ -515,33 +1162,22 @@ class SimData(object):
         if paramfn not in self._sim_data:
             raise ValueError("Simulation not in sim_data: %s" % paramfn)
 
+        # the results are read-only, so they are shared instead of copied
         sim_params = self._sim_data[paramfn]['params']
         single_sim = self._sim_data[paramfn]['data']
         self._opt_data = {'initial_dpl': self._opt_data['initial_dpl'],
                           'initial_error': self._opt_data['initial_error'],
                           'paramfn': paramfn,
-                          'params': deepcopy(sim_params),
-                          'data': {'dpls': deepcopy(single_sim['dpls']),
-                                   'avg_dpl': deepcopy(single_sim['avg_dpl']),
-                                   'spikes': deepcopy(single_sim['spikes']),
-                                   'gid_ranges':
-                                       deepcopy(single_sim['gid_ranges']),
-                                   'spec': deepcopy(single_sim['spec']),
-                                   'vsoma': deepcopy(single_sim['vsoma'])}}
+                          'params': dict(sim_params),
+                          'data': _share_data(single_sim)}
 
         event.set()
 
     def update_sim_data_from_opt_data(self, event, paramfn):
-        opt_data = self._opt_data['data']
+        # the results are read-only, so they are shared instead of copied
         single_sim = {'paramfn': paramfn,
-                      'params': deepcopy(self._opt_data['params']),
-                      'data': {'dpls': deepcopy(opt_data['dpls']),
-                               'avg_dpl': deepcopy(opt_data['avg_dpl']),
-                               'spikes': deepcopy(opt_data['spikes']),
-                               'gid_ranges':
-                                   deepcopy(opt_data['gid_ranges']),
-                               'spec': deepcopy(opt_data['spec']),
-                               'vsoma': deepcopy(opt_data['vsoma'])}}
+                      'params': dict(self._opt_data['params']),
+                      'data': _share_data(self._opt_data['data'])}
         self._sim_data[paramfn] = single_sim
 
         event.set()
@@ -621,8 +1257,10 @@ class SimData(object):
             axdipole = f.add_subplot(gs1[:, :])
 
             spec_data = self._sim_data[paramfn]['data']['spec']
+            avg_spec = get_avg_spec(self._sim_data[paramfn]['data'], ntrial)
             cax = plot_spec(axspec, spec_data, ntrial,
-                            params['spec_cmap'], xlim, fontsize)
+                            params['spec_cmap'], xlim, fontsize,
+                            avg_spec=avg_spec)
             f.colorbar(cax, ax=axspec)
 
             # set xlim based on TFR plot
@@ -695,7 +1333,8 @@ class SimData(object):
             if trial_idx + 1 > len(current_sim_data['vsoma']):
                 raise ValueError("No vsoma data for trial %d" % trial_idx)
 
-            vsoma = current_sim_data['vsoma'][trial_idx]
+            # shared with opt_data
+            vsoma = dict(current_sim_data['vsoma'][trial_idx])
 
             # store tvec with voltages. it will be the same for
             # all trials
@@ -737,15 +1376,15 @@ class SimData(object):
                     linewidth=linewidth)
 
             sim_data = self._sim_data[paramfn]['data']
-            ntrial = len(sim_data['dpls'])
-            # plot dipoles from individual trials
+            dpl_stats = get_dpl_stats(sim_data)
+            ntrial = dpl_stats.n_trials
+            # shade the range of the dipoles of individual trials
             if ntrial > 1 and drawindivdpl:
-                for dpltrial in sim_data['dpls']:
-                    ax.plot(dpltrial.times, dpltrial.data['agg'],
-                            color='gray',
-                            linewidth=linewidth)
-                    yl[0] = min(yl[0], dpltrial.data['agg'].min())
-                    yl[1] = max(yl[1], dpltrial.data['agg'].max())
+                lower, upper = dpl_stats.get_band('agg')
+                ax.fill_between(dpl_stats.times, lower, upper, color='gray',
+                                alpha=0.5, linewidth=0)
+                yl[0] = min(yl[0], lower.min())
+                yl[1] = max(yl[1], upper.max())
 
             if drawavgdpl or ntrial == 1:
                 # this is the average dipole (across trials)
@@ -0,0 +1,364 @@
+"""A binary file holding all the results of a simulation
+
+The file starts with a manifest describing the arrays stored after it, so
+that each array can be memory-mapped without reading the others:
+
+    8 bytes   magic string
+    8 bytes   length of the manifest (little endian)
+    n bytes   JSON manifest, padded to a multiple of 64 bytes
+    ...       the arrays, each starting at a multiple of 64 bytes
+
+The dipoles of all trials are stored as one (trials x layers x times)
+array, the spikes as columns of times, gids, trials and types, and the
+spectral analyses and somatic voltages as arrays with a first dimension of
+trials.
+"""
+
+import os
+import json
+from fnmatch import fnmatch
+from threading import get_ident
+
+import numpy as np
+
+from hnn_core import CellResponse
+from hnn_core.dipole import Dipole
+
+from .paramrw import get_fname
+
+SIM_FILE_VERSION = 1
+_MAGIC = b'HNNSIM\x00\x01'
+_ALIGN = 64
+_DPL_LAYERS = ['agg', 'L2', 'L5']
+
+# the files of the trials that the results file replaces
+LEGACY_PATTERNS = [('dpl_*.txt', 'normdpl'), ('rawdpl_*.txt', 'rawdpl'),
+                   ('spk_*.txt', 'rawspk'), ('rawspec_*.npz', 'rawspec'),
+                   ('vsoma_*.pkl', 'vsoma')]
+
+
+def _pad(nbytes):
+    return -(-nbytes // _ALIGN) * _ALIGN
+
+
+def _stack_trials(trials, name):
+    """Stack the arrays of the trials, which must have the same shape"""
+    trials = [np.asarray(trial) for trial in trials]
+    if len(set([trial.shape for trial in trials])) > 1:
+        raise ValueError("The trials of %s have different shapes" % name)
+    return np.stack(trials)
+
+
+def _write_arrays(fname, arrays, info):
+    """Write arrays after a manifest describing them
+
+    The file is written next to fname and then renamed, so that readers
+    never see a partially written file.
+    """
+    manifest = {'version': SIM_FILE_VERSION, 'info': info, 'arrays': {}}
+    offset = 0
+    for name, arr in arrays.items():
+        manifest['arrays'][name] = {'dtype': arr.dtype.str,
+                                    'shape': list(arr.shape),
+                                    'offset': offset}
+        offset += _pad(arr.nbytes)
+    header = json.dumps(manifest).encode()
+    header_len = len(_MAGIC) + 8 + len(header)
+
+    tmp_fname = '%s.%d.%d.tmp' % (fname, os.getpid(), get_ident())
+    try:
+        with open(tmp_fname, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            f.write(b'\x00' * (_pad(header_len) - header_len))
+            for arr in arrays.values():
+                f.write(np.ascontiguousarray(arr).tobytes())
+                f.write(b'\x00' * (_pad(arr.nbytes) - arr.nbytes))
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+
+
+def write_sim_file(fname, dpls, spikes, gid_ranges, raw_dpls=None,
+                   spec=None, vsoma=None, vsoma_times=None):
+    """Write the results of a simulation to a single binary file
+
+    Parameters
+    ----------
+    fname : str
+        The file to write
+    dpls : list of Dipole
+        The dipole of each trial
+    spikes : CellResponse
+        The spikes of all trials
+    gid_ranges : dict
+        The gids of each cell type
+    raw_dpls : list of Dipole | None
+        The dipole of each trial before smoothing and scaling
+    spec : list of dict | None
+        The spectral analysis of each trial, as returned by spec_dpl_kernel
+    vsoma : list of dict | None
+        The somatic voltages of each trial by gid
+    vsoma_times : array | None
+        The times of the somatic voltages. If None, the times of the dipoles
+        are used.
+    """
+    arrays = dict()
+    info = {'n_trials': len(dpls), 'layers': _DPL_LAYERS}
+
+    arrays['dpl_times'] = np.asarray(dpls[0].times, dtype=float)
+    for key, trials in [('dpls', dpls), ('raw_dpls', raw_dpls)]:
+        if trials is not None:
+            arrays[key] = _stack_trials(
+                [[dpl.data[layer] for layer in _DPL_LAYERS]
+                 for dpl in trials], key)
+
+    info['gid_ranges'] = dict()
+    for gid_type, gids in gid_ranges.items():
+        if len(gids) > 0:
+            info['gid_ranges'][gid_type] = [int(gids[0]), int(gids[-1]) + 1]
+        else:
+            info['gid_ranges'][gid_type] = []
+
+    spike_types = [list(types) for types in spikes.spike_types]
+    type_names = sorted(set([spike_type for types in spike_types
+                             for spike_type in types]))
+    type_idx = dict([(name, idx) for idx, name in enumerate(type_names)])
+    info['spike_types'] = type_names
+    info['n_spike_trials'] = len(spikes.spike_times)
+    arrays['spike_times'] = np.array(
+        [time for times in spikes.spike_times for time in times],
+        dtype=float)
+    arrays['spike_gids'] = np.array(
+        [gid for gids in spikes.spike_gids for gid in gids], dtype=np.int64)
+    arrays['spike_trials'] = np.repeat(
+        np.arange(len(spikes.spike_times), dtype=np.int32),
+        [len(times) for times in spikes.spike_times])
+    arrays['spike_types'] = np.array(
+        [type_idx[spike_type] for types in spike_types
+         for spike_type in types], dtype=np.int32)
+    if len(arrays['spike_types']) != len(arrays['spike_times']):
+        # legacy spike files have no types
+        del arrays['spike_types']
+
+    if spec is not None:
+        info['spec_keys'] = sorted(spec[0].keys())
+        info['n_spec_trials'] = len(spec)
+        for key in info['spec_keys']:
+            arrays['spec/' + key] = _stack_trials(
+                [spec_trial[key] for spec_trial in spec], 'spec/' + key)
+
+    if vsoma is not None:
+        gids = sorted([gid for gid in vsoma[0] if gid != 'vtime'])
+        info['vsoma_gids'] = [int(gid) for gid in gids]
+        arrays['vsoma'] = _stack_trials(
+            [[vsoma_trial[gid] for gid in gids] for vsoma_trial in vsoma],
+            'vsoma')
+        if vsoma_times is None:
+            vsoma_times = vsoma[0].get('vtime', arrays['dpl_times'])
+        arrays['vsoma_times'] = np.asarray(vsoma_times, dtype=float)
+
+    _write_arrays(fname, arrays, info)
+
+
+class SimFile(object):
+    """The SimFile class.
+
+    The results of a simulation written by write_sim_file, read one kind
+    at a time.
+
+    Parameters
+    ----------
+    fname : str
+        The file to read
+    mmap : bool
+        If True, the arrays are memory-mapped instead of read into memory.
+        Memory-mapped arrays are read-only.
+
+    Attributes
+    ----------
+    fname : str
+        The file to read
+    info : dict
+        The description of the results in the manifest
+    """
+
+    def __init__(self, fname, mmap=True):
+        self.fname = fname
+        self._mmap = mmap
+        with open(fname, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError("Not a simulation results file: %s" % fname)
+            header_len = int.from_bytes(f.read(8), 'little')
+            manifest = json.loads(f.read(header_len).decode())
+        if manifest['version'] > SIM_FILE_VERSION:
+            raise ValueError("Simulation results file %s has version %d,"
+                             " newer than %d" % (fname, manifest['version'],
+                                                 SIM_FILE_VERSION))
+        self.info = manifest['info']
+        self._arrays = manifest['arrays']
+        self._data_start = _pad(len(_MAGIC) + 8 + header_len)
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def get_array(self, name):
+        """Get an array by name"""
+        desc = self._arrays[name]
+        dtype = np.dtype(desc['dtype'])
+        shape = tuple(desc['shape'])
+        offset = self._data_start + desc['offset']
+        count = int(np.prod(shape))
+        if self._mmap and count > 0:
+            return np.memmap(self.fname, dtype=dtype, mode='r',
+                             offset=offset, shape=shape)
+        with open(self.fname, 'rb') as f:
+            f.seek(offset)
+            return np.fromfile(f, dtype=dtype, count=count).reshape(shape)
+
+    def read_dipoles(self, raw=False):
+        """Read the dipole of each trial
+
+        Parameters
+        ----------
+        raw : bool
+            If True, read the dipoles before smoothing and scaling
+
+        Returns
+        ----------
+        dpls : list of Dipole
+            The dipole of each trial
+        """
+        times = self.get_array('dpl_times')
+        data = self.get_array('raw_dpls' if raw else 'dpls')
+        return [Dipole(times, data[trial_idx].T)
+                for trial_idx in range(data.shape[0])]
+
+    def read_gid_ranges(self):
+        """Read the gids of each cell type, like read_gids_param"""
+        gid_ranges = dict()
+        for gid_type, gids in self.info['gid_ranges'].items():
+            if len(gids) == 2:
+                gid_ranges[gid_type] = np.arange(gids[0], gids[1])
+            else:
+                gid_ranges[gid_type] = np.array([])
+        return gid_ranges
+
+    def read_spikes(self):
+        """Read the spikes of all trials
+
+        Returns
+        ----------
+        spikes : CellResponse
+            The spikes of all trials
+        """
+        n_trials = self.info['n_spike_trials']
+        spike_trials = self.get_array('spike_trials')
+        bounds = np.searchsorted(spike_trials, np.arange(n_trials + 1))
+        columns = [self.get_array('spike_times'),
+                   self.get_array('spike_gids')]
+        if 'spike_types' in self:
+            names = np.array(self.info['spike_types'], dtype=str)
+            columns.append(names[self.get_array('spike_types')])
+        else:
+            columns.append(None)
+
+        spike_times, spike_gids, spike_types = list(), list(), list()
+        for trial_idx in range(n_trials):
+            start, end = bounds[trial_idx], bounds[trial_idx + 1]
+            spike_times.append(columns[0][start:end].tolist())
+            spike_gids.append(columns[1][start:end].tolist())
+            if columns[2] is None:
+                spike_types.append([])
+            else:
+                spike_types.append(columns[2][start:end].tolist())
+
+        return CellResponse(spike_times=spike_times, spike_gids=spike_gids,
+                            spike_types=spike_types)
+
+    def read_spec(self):
+        """Read the spectral analysis of each trial
+
+        Returns
+        ----------
+        spec : list of dict
+            The spectral analysis of each trial, as saved by save_spec_data
+        """
+        keys = self.info['spec_keys']
+        arrays = dict([(key, self.get_array('spec/' + key)) for key in keys])
+        return [dict([(key, arrays[key][trial_idx]) for key in keys])
+                for trial_idx in range(self.info['n_spec_trials'])]
+
+    def read_vsoma(self):
+        """Read the somatic voltages of each trial
+
+        Returns
+        ----------
+        vsoma : list of dict
+            The somatic voltages of each trial by gid, and their times as
+            'vtime', like the files written by SimData.save_vsoma
+        """
+        gids = self.info['vsoma_gids']
+        data = self.get_array('vsoma')
+        times = self.get_array('vsoma_times')
+        vsoma = list()
+        for trial_idx in range(data.shape[0]):
+            vsoma_trial = dict(zip(gids, data[trial_idx]))
+            vsoma_trial['vtime'] = times
+            vsoma.append(vsoma_trial)
+        return vsoma
+
+
+def _is_stale(sim_dir, fname):
+    """Whether files of the trials were written after the results file
+
+    This happens when an older version of HNN simulated again into the
+    same directory. The somatic voltages are not checked, because they are
+    saved after the results file.
+    """
+    mtime = os.path.getmtime(fname)
+    patterns = list()
+    for pattern, key in LEGACY_PATTERNS:
+        if key != 'vsoma':
+            patterns += [pattern, os.path.basename(get_fname(sim_dir, key))]
+    with os.scandir(sim_dir) as entries:
+        for entry in entries:
+            if any([fnmatch(entry.name, pattern) for pattern in patterns]) \
+                    and entry.stat().st_mtime > mtime:
+                return True
+    return False
+
+
+def open_sim_file(sim_dir, mmap=True):
+    """Open the simulation results file of a simulation data directory
+
+    The results file is not used if files of the trials are newer than it,
+    so that readers fall back to those files.
+
+    Parameters
+    ----------
+    sim_dir : str
+        Path of simulation data directory
+    mmap : bool
+        If True, the arrays are memory-mapped instead of read into memory
+
+    Returns
+    ----------
+    sim_file : SimFile | None
+        The results file, or None if there is none, it is older than the
+        files of the trials or it can't be read
+    """
+    fname = get_fname(sim_dir, 'simfile')
+    if not os.path.exists(fname):
+        return None
+    if _is_stale(sim_dir, fname):
+        print("Warning: not reading %s, which is older than the files of"
+              " the trials" % fname)
+        return None
+    try:
+        return SimFile(fname, mmap=mmap)
+    except (OSError, ValueError) as err:
+        print("Warning: could not read file: %s (%s)" % (fname, err))
+        return None
@@ -0,0 +1,256 @@
+"""Functions for running simulations and saving their results without Qt"""
+
+import os
+import multiprocessing
+from glob import glob
+from copy import deepcopy
+
+import numpy as np
+from psutil import cpu_count
+from hnn_core import simulate_dipole
+
+from .paramrw import (usingOngoingInputs, get_output_dir,
+                      write_gids_param, get_fname)
+from .specfn import spec_dpls, save_spec_data
+from .checkpoint import write_checkpoint
+from .simfile import write_sim_file, LEGACY_PATTERNS
+from .dplstats import DipoleEnsemble
+
+
+def get_defncore():
+    """get default number of cores """
+
+    try:
+        defncore = len(os.sched_getaffinity(0))
+    except AttributeError:
+        defncore = cpu_count(logical=False)
+
+    if defncore is None or defncore == 0:
+        # in case psutil is not supported (e.g. BSD)
+        defncore = multiprocessing.cpu_count()
+
+    return defncore
+
+
+def simulate(net):
+    """Start the simulation with hnn_core.simulate
+
+    Parameters
+    ----------
+    net : Network object
+        The constructed Network object from hnn-core
+    """
+
+    sim_data = {}
+    # run the simulation with MPIBackend for faster completion time
+    record_vsoma = bool(net.params['record_vsoma'])
+
+    numspikes_params = net.params['numspikes_*']
+    # optimization can feed in floats for numspikes
+    for param_name, spikes in numspikes_params.items():
+        net.params[param_name] = round(spikes)
+
+    sim_data['raw_dpls'] = simulate_dipole(net, net.params['N_trials'],
+                                           postproc=False,
+                                           record_vsoma=record_vsoma)
+
+    # hnn-core changes this to bool, change back to int
+    if isinstance(net.params['record_vsoma'], bool):
+        net.params['record_vsoma'] = int(record_vsoma)
+    sim_data['gid_ranges'] = net.gid_ranges
+    sim_data['spikes'] = net.cell_response
+    sim_data['vsoma'] = net.cell_response.vsoma
+
+    return sim_data
+
+
+def postproc_dipoles(sim_data, params):
+    """Smooth and scale the raw dipoles and average them over trials
+
+    Parameters
+    ----------
+    sim_data : dict
+        The dictionary returned by simulate(). Will be updated with 'dpls',
+        'avg_dpl' and 'dpl_stats' keys.
+    params : dict
+        Dictionary of params describing simulation config
+    """
+    sim_data['dpls'] = deepcopy(sim_data['raw_dpls'])
+    ntrial = len(sim_data['raw_dpls'])
+    dpl_stats = DipoleEnsemble()
+    for trial_idx in range(ntrial):
+        window_len = params['dipole_smooth_win']  # specified in ms
+        fctr = params['dipole_scalefctr']
+        if window_len > 0:  # param files set this to zero for no smoothing
+            sim_data['dpls'][trial_idx].smooth(window_len=window_len)
+        if fctr > 0:
+            sim_data['dpls'][trial_idx].scale(fctr)
+        dpl_stats.add(sim_data['dpls'][trial_idx])
+    sim_data['dpl_stats'] = dpl_stats
+
+    # save average dipole from individual trials in a single file
+    if ntrial > 1:
+        sim_data['avg_dpl'] = dpl_stats.get_avg_dpl()
+    elif ntrial == 1:
+        sim_data['avg_dpl'] = sim_data['dpls'][0]
+    else:
+        raise ValueError("No dipole(s) returned from simulation")
+
+
+def _append_dipole(dpl, fname, start_idx):
+    """Append the samples of a dipole from start_idx to a file written by
+    Dipole.write()"""
+    if not os.path.exists(fname):
+        dpl.write(fname)
+        return
+
+    X = np.r_[[dpl.times[start_idx:], dpl.data['agg'][start_idx:],
+               dpl.data['L2'][start_idx:], dpl.data['L5'][start_idx:]]].T
+    with open(fname, 'ab') as f:
+        np.savetxt(f, X, fmt=['%3.3f', '%5.4f', '%5.4f', '%5.4f'],
+                   delimiter='\t')
+
+
+def _append_spikes(spikes, fname, trial_idx, start_idx):
+    """Append the spikes of a trial from start_idx to a file written by
+    CellResponse.write()"""
+    spike_times = spikes._spike_times[trial_idx]
+    if not os.path.exists(fname):
+        start_idx = 0
+
+    with open(fname, 'a' if start_idx > 0 else 'w') as f:
+        for spike_idx in range(start_idx, len(spike_times)):
+            f.write('{:.3f}\t{}\t{}\n'.format(
+                spike_times[spike_idx],
+                int(spikes._spike_gids[trial_idx][spike_idx]),
+                spikes._spike_types[trial_idx][spike_idx]))
+
+
+def _write_legacy_files(sim_data, params, sim_dir, continued_from):
+    """Write a file for each trial of each kind of result"""
+    n_continued = 0
+    if continued_from is not None:
+        n_continued = continued_from['n_trials']
+        start_idx = continued_from['n_samples']
+
+    # save spikes by trial
+    spk_fname = os.path.join(sim_dir, 'spk_%d.txt')
+    if n_continued == 0:
+        sim_data['spikes'].write(spk_fname)
+    else:
+        for trial_idx in range(len(sim_data['dpls'])):
+            spike_start_idx = 0
+            if trial_idx < n_continued:
+                spike_start_idx = continued_from['n_spikes'][trial_idx]
+            _append_spikes(sim_data['spikes'], spk_fname % trial_idx,
+                           trial_idx, spike_start_idx)
+
+    # save dipole for each trial
+    for trial_idx, dpl in enumerate(sim_data['dpls']):
+        dipole_fn = get_fname(sim_dir, 'normdpl', trial_idx)
+        raw_dipole_fn = get_fname(sim_dir, 'rawdpl', trial_idx)
+        if trial_idx < n_continued:
+            # smoothing changes the samples before the continuation too
+            if params['dipole_smooth_win'] > 0:
+                dpl.write(dipole_fn)
+            else:
+                _append_dipole(dpl, dipole_fn, start_idx)
+            if params['save_dpl']:
+                _append_dipole(sim_data['raw_dpls'][trial_idx],
+                               raw_dipole_fn, start_idx)
+        else:
+            dpl.write(dipole_fn)
+            if params['save_dpl']:
+                sim_data['raw_dpls'][trial_idx].write(raw_dipole_fn)
+
+        if params['save_spec_data']:
+            spec_fn = get_fname(sim_dir, 'rawspec', trial_idx)
+            save_spec_data(spec_fn, sim_data['spec'][trial_idx])
+
+
+def _remove_legacy_files(sim_dir):
+    """Remove the files of the trials of an earlier simulation"""
+    for pattern, key in LEGACY_PATTERNS:
+        fnames = glob(os.path.join(sim_dir, pattern))
+        fnames.append(get_fname(sim_dir, key))
+        for fname in fnames:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+
+def write_sim_data(sim_data, params, spec_freqs=None,
+                   spec_dtype=np.float64, legacy_files=True):
+    """Save simulation results to the simulation data directory
+
+    Spectral analysis is also performed here when the results are needed.
+    All results are written to a single results file, which readers prefer
+    to the files of the trials. Unless legacy_files is False, a file is also
+    written for each trial of each kind of result, for older versions of
+    HNN. For trials continued from a checkpoint, only the new part of the
+    dipoles and spikes is appended to those files.
+
+    Parameters
+    ----------
+    sim_data : dict
+        The dictionary returned by simulate() after postproc_dipoles(). Will
+        be updated with the 'spec' key.
+    params : dict
+        Dictionary of params describing simulation config
+    spec_freqs : array | None
+        Frequencies of the spectral analysis, for example from
+        specfn.make_freqs. If None, every integer frequency up to
+        params['f_max_spec'] is used.
+    spec_dtype : dtype
+        float64, or float32 to compute and save the spectral analysis in
+        single precision
+    legacy_files : bool
+        If False, only the results file is written, and the files of the
+        trials of an earlier simulation in the directory are removed like
+        convert_sim_dir(remove_legacy=True) does
+
+    Returns
+    -------
+    sim_dir : str
+        Path of simulation data directory
+    """
+    sim_data['spec'] = []
+
+    # make sure the directory for saving data has been created
+    data_dir = os.path.join(get_output_dir(), 'data')
+    sim_dir = os.path.join(data_dir, params['sim_prefix'])
+    os.makedirs(sim_dir, exist_ok=True)
+
+    # TODO: Can below be removed if spk.txt is new hnn-core format with 3
+    # columns (including spike type)?
+    # Follow https://github.com/jonescompneurolab/hnn-core/issues/219
+    write_gids_param(get_fname(sim_dir, 'param'), sim_data['gid_ranges'])
+
+    # the checkpoint must match the results in sim_dir
+    write_checkpoint(sim_dir, sim_data.get('checkpoint'))
+
+    # spectral analysis of all trials at once
+    if params['save_spec_data'] or usingOngoingInputs(params):
+        sim_data['spec'] = spec_dpls(sim_data['dpls'], params['f_max_spec'],
+                                     params['dt'], params['tstop'],
+                                     freqs=spec_freqs, dtype=spec_dtype)
+
+    if legacy_files:
+        _write_legacy_files(sim_data, params, sim_dir,
+                            sim_data.get('continued_from'))
+    else:
+        _remove_legacy_files(sim_dir)
+
+    # all results in one file that is faster to read
+    raw_dpls = spec = vsoma = None
+    # continuing from the checkpoint reads the raw dipoles from this file
+    if params['save_dpl'] or sim_data.get('checkpoint') is not None:
+        raw_dpls = sim_data['raw_dpls']
+    if len(sim_data['spec']) > 0:
+        spec = sim_data['spec']
+    if params['record_vsoma'] and len(sim_data.get('vsoma', [])) > 0:
+        vsoma = sim_data['vsoma']
+    write_sim_file(get_fname(sim_dir, 'simfile'), sim_data['dpls'],
+                   sim_data['spikes'], sim_data['gid_ranges'],
+                   raw_dpls=raw_dpls, spec=spec, vsoma=vsoma)
+
+    return sim_dir
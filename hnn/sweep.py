@@ -0,0 +1,389 @@
+"""Parameter sweeps over a base param file
+
+A sweep is described by a JSON spec, for example:
+
+    {"design": "lhs", "n_samples": 50, "seed": 0,
+     "params": {"gbar_evprox_1_*": {"min": 0.0, "max": 0.1},
+                "t_evdist_1": {"values": [60.0, 63.53, 70.0]}}}
+
+"design" is one of 'grid' (every combination of the values of each param),
+'random' (uniformly distributed samples) or 'lhs' (Latin hypercube samples).
+For a grid, "n" gives the number of evenly spaced values between "min" and
+"max". Param names may contain wildcards like the keys of Params.
+
+Example: python hnn_sweep.py param/default.param sweep.json --data data.txt
+"""
+
+import os
+import csv
+import json
+import argparse
+import fnmatch
+from itertools import product
+
+import numpy as np
+
+from hnn_core import read_params
+
+from .paramrw import get_output_dir, write_legacy_paramf
+from .simdata import SimData
+from .expdata import read_exp_data
+from .batch import run_batch
+
+_DESIGNS = ['grid', 'random', 'lhs']
+
+
+def read_sweep_spec(spec_fn):
+    """Read and check a sweep spec from a JSON file
+
+    Parameters
+    ----------
+    spec_fn : str
+        Full path to the JSON sweep spec
+
+    Returns
+    -------
+    spec : dict
+        The sweep spec
+    """
+    with open(spec_fn, 'r') as fp:
+        spec = json.load(fp)
+
+    design = spec.setdefault('design', 'grid')
+    if design not in _DESIGNS:
+        raise ValueError("Unrecognized sweep design '%s'. Expected one of %s"
+                         % (design, ', '.join(_DESIGNS)))
+    if 'params' not in spec or len(spec['params']) == 0:
+        raise ValueError("Sweep spec %s has no params to sweep" % spec_fn)
+    if design != 'grid' and 'n_samples' not in spec:
+        raise ValueError("n_samples is required for a %s sweep" % design)
+
+    for param_name, param_range in spec['params'].items():
+        if 'values' in param_range:
+            if len(param_range['values']) == 0:
+                raise ValueError("No values given for %s" % param_name)
+        elif 'min' not in param_range or 'max' not in param_range:
+            raise ValueError("Either values or min and max are required"
+                             " for %s" % param_name)
+        elif design == 'grid' and 'n' not in param_range:
+            raise ValueError("n is required for %s in a grid sweep" %
+                             param_name)
+
+    return spec
+
+
+def _sample_range(param_range, unit_samples):
+    """Map samples in [0, 1) onto the values of a param"""
+    if 'values' in param_range:
+        values = param_range['values']
+        indices = np.floor(unit_samples * len(values)).astype(int)
+        return [values[idx] for idx in indices]
+
+    low, high = param_range['min'], param_range['max']
+    return (low + unit_samples * (high - low)).tolist()
+
+
+def expand_sweep(spec):
+    """Expand a sweep spec into the param values of each point
+
+    Parameters
+    ----------
+    spec : dict
+        The sweep spec returned by read_sweep_spec()
+
+    Returns
+    -------
+    points : list of dict
+        The values of the swept params for each point of the sweep
+    """
+    param_names = list(spec['params'].keys())
+    design = spec['design']
+
+    if design == 'grid':
+        grid_values = list()
+        for param_name in param_names:
+            param_range = spec['params'][param_name]
+            if 'values' in param_range:
+                grid_values.append(param_range['values'])
+            else:
+                grid_values.append(np.linspace(param_range['min'],
+                                               param_range['max'],
+                                               param_range['n']).tolist())
+        return [dict(zip(param_names, values))
+                for values in product(*grid_values)]
+
+    n_samples = spec['n_samples']
+    rng = np.random.RandomState(spec.get('seed', 0))
+    columns = list()
+    for param_name in param_names:
+        if design == 'random':
+            unit_samples = rng.uniform(size=n_samples)
+        else:
+            # one sample in each of n_samples strata, in random order
+            strata = rng.permutation(n_samples)
+            unit_samples = (strata + rng.uniform(size=n_samples)) / n_samples
+        columns.append(_sample_range(spec['params'][param_name],
+                                     unit_samples))
+
+    return [dict(zip(param_names, values)) for values in zip(*columns)]
+
+
+def _apply_point(base_params, point):
+    params = base_params.copy()
+    for param_name, value in point.items():
+        if len(fnmatch.filter(params.keys(), param_name)) == 0:
+            raise ValueError("%s does not match any parameter" % param_name)
+        # wildcards set all matching params
+        params[param_name] = value
+
+    return params
+
+
+class ParamSweep(object):
+    """The ParamSweep class.
+
+    Writes a param file for each point of a sweep and keeps an index of
+    the points in 'sweeps/<name>' in the output directory. Simulation results
+    are saved under 'data/<sim_prefix>' so they can be loaded in the GUI.
+
+    Parameters
+    ----------
+    base_paramfn : str
+        Full path to the .param file with values for all params not swept
+    spec : dict
+        The sweep spec returned by read_sweep_spec()
+    name : str
+        Name of the sweep, used for the sim_prefix of each point
+
+    Attributes
+    ----------
+    name : str
+        Name of the sweep
+    sweep_dir : str
+        Directory containing the index of the sweep
+    index_fn : str
+        The CSV file with one row per finished point of the sweep
+    points : list of dict
+        The values of the swept params for each point of the sweep
+    paramfns : list of str
+        The param file of each point of the sweep
+    """
+
+    def __init__(self, base_paramfn, spec, name):
+        self.name = name
+        self.spec = spec
+        self.base_params = read_params(base_paramfn)
+        self.sweep_dir = os.path.join(get_output_dir(), 'sweeps', name)
+        self.index_fn = os.path.join(self.sweep_dir, 'index.csv')
+        self.points = expand_sweep(spec)
+        self.param_names = list(spec['params'].keys())
+        self.paramfns = list()
+
+        param_dir = os.path.join(get_output_dir(), 'param')
+        for point_idx in range(len(self.points)):
+            sim_prefix = self.get_sim_prefix(point_idx)
+            self.paramfns.append(os.path.join(param_dir,
+                                              sim_prefix + '.param'))
+
+    def get_sim_prefix(self, point_idx):
+        return '%s_%04d' % (self.name, point_idx)
+
+    def write_param_files(self):
+        """Write the param file of every point and the sweep spec"""
+        spec_fn = os.path.join(self.sweep_dir, 'sweep.json')
+        if os.path.exists(spec_fn):
+            # the index of finished points is only valid for the same spec
+            with open(spec_fn, 'r') as fp:
+                if json.load(fp) != self.spec:
+                    raise ValueError("A different sweep named %s exists in"
+                                     " %s. Please choose another name" %
+                                     (self.name, self.sweep_dir))
+
+        os.makedirs(self.sweep_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(self.paramfns[0]), exist_ok=True)
+        with open(spec_fn, 'w') as fp:
+            json.dump(self.spec, fp, indent=2)
+
+        for point_idx, point in enumerate(self.points):
+            params = _apply_point(self.base_params, point)
+            params['sim_prefix'] = self.get_sim_prefix(point_idx)
+            params['expmt_groups'] = '{%s}' % params['sim_prefix']
+            write_legacy_paramf(self.paramfns[point_idx], params)
+
+    def read_index(self):
+        """Read the rows of the index of finished points
+
+        Returns
+        -------
+        rows : list of dict
+            One row per finished point with 'index', 'sim_prefix', 'status'
+            and the swept param values
+        """
+        if not os.path.exists(self.index_fn):
+            return list()
+        with open(self.index_fn, 'r', newline='') as fp:
+            return list(csv.DictReader(fp))
+
+    def _append_index(self, point_idx, status):
+        write_header = not os.path.exists(self.index_fn)
+        with open(self.index_fn, 'a', newline='') as fp:
+            writer = csv.writer(fp)
+            if write_header:
+                writer.writerow(['index', 'sim_prefix', 'status'] +
+                                self.param_names)
+            point = self.points[point_idx]
+            writer.writerow([point_idx, self.get_sim_prefix(point_idx),
+                             status] +
+                            [point[name] for name in self.param_names])
+
+    def run(self, ncore=None, ncore_per_sim=1, use_cache=True):
+        """Simulate all points of the sweep that haven't finished yet
+
+        Each result is added to the index as soon as it is finished, so an
+        interrupted sweep continues where it left off when run again.
+
+        Parameters
+        ----------
+        ncore : int | None
+            Total number of cores to use. If None, all available cores are
+            used
+        ncore_per_sim : int
+            Number of cores for each simulation
+        use_cache : bool
+            Whether to reuse the results of identical earlier simulations
+
+        Returns
+        -------
+        failed : list of str
+            The param files that could not be simulated
+        """
+        self.write_param_files()
+
+        done = set([int(row['index']) for row in self.read_index()
+                    if row['status'] == 'done'])
+        todo = [paramfn for point_idx, paramfn in enumerate(self.paramfns)
+                if point_idx not in done]
+        if len(todo) < len(self.paramfns):
+            print("Skipping %d points of sweep %s that already finished" %
+                  (len(self.paramfns) - len(todo), self.name))
+        if len(todo) == 0:
+            return list()
+
+        def _result_callback(paramfn, sim_dir):
+            status = 'failed' if sim_dir is None else 'done'
+            self._append_index(self.paramfns.index(paramfn), status)
+
+        return run_batch(todo, ncore=ncore, ncore_per_sim=ncore_per_sim,
+                         use_cache=use_cache,
+                         result_callback=_result_callback)
+
+    def calc_rmse_table(self, sim_data, tstart=0.0, tstop=None):
+        """Calculate the RMSE of each finished point against exp data
+
+        Parameters
+        ----------
+        sim_data : SimData object
+            Contains the experimental data to compare with. Points that are
+            not already in sim_data are read from disk and removed again
+            afterwards.
+        tstart : float
+            Time in ms defining the start of the region to calculate RMSE
+        tstop : float | None
+            Time in ms defining the end of the region to calculate RMSE. If
+            None, tstop of each simulation is used
+
+        Returns
+        -------
+        rows : list of dict
+            Rows of the index with an added 'rmse' (average over all
+            experimental data) and 'rmse_<n>' for each experimental trace,
+            sorted by RMSE. The table is also written to rmse.csv in the
+            sweep directory.
+        """
+        if sim_data.get_exp_data_size() == 0:
+            raise ValueError("No experimental data loaded to calculate RMSE")
+
+        rows = list()
+        for row in self.read_index():
+            if row['status'] != 'done':
+                continue
+
+            paramfn = self.paramfns[int(row['index'])]
+            params = read_params(paramfn)
+            loaded = sim_data.in_sim_data(paramfn)
+            if not loaded and \
+                    not sim_data.update_sim_data_from_disk(paramfn, params):
+                sim_data.remove_sim_by_fn(paramfn)
+                print("Warning: could not read results of %s" % paramfn)
+                continue
+
+            sim_tstop = params['tstop'] if tstop is None else tstop
+            lerr, errtot = sim_data.calcerr(paramfn, sim_tstop, tstart)
+            if not loaded:
+                sim_data.remove_sim_by_fn(paramfn)
+
+            row['rmse'] = errtot
+            for err_idx, err in enumerate(lerr):
+                row['rmse_%d' % err_idx] = err
+            rows.append(row)
+
+        rows.sort(key=lambda row: row['rmse'])
+        if len(rows) > 0:
+            with open(os.path.join(self.sweep_dir, 'rmse.csv'), 'w',
+                      newline='') as fp:
+                writer = csv.DictWriter(fp, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(rows)
+
+        return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Sweep params of an HNN param file without the GUI.'
+        ' Results are saved in %s' % get_output_dir())
+    parser.add_argument('base_param', help='base .param file')
+    parser.add_argument('spec', help='JSON sweep spec')
+    parser.add_argument('--name', default=None,
+                        help='name of the sweep (default: name of spec file)')
+    parser.add_argument('--ncore', type=int, default=None,
+                        help='total number of cores to use (default: all)')
+    parser.add_argument('--ncore-per-sim', type=int, default=1,
+                        help='number of cores (MPI processes) for each'
+                        ' simulation (default: 1)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always simulate, even if identical results'
+                        ' are cached')
+    parser.add_argument('--data', nargs='*', default=[],
+                        help='experimental dipole data files for the RMSE'
+                        ' table')
+    parser.add_argument('--tstart', type=float, default=0.0,
+                        help='start of the RMSE window in ms')
+    parser.add_argument('--tstop', type=float, default=None,
+                        help='end of the RMSE window in ms (default: tstop)')
+    args = parser.parse_args(argv)
+
+    name = args.name
+    if name is None:
+        name = os.path.splitext(os.path.basename(args.spec))[0]
+
+    sweep = ParamSweep(args.base_param, read_sweep_spec(args.spec), name)
+    print("Sweep %s has %d points" % (name, len(sweep.points)))
+    failed = sweep.run(ncore=args.ncore, ncore_per_sim=args.ncore_per_sim,
+                       use_cache=not args.no_cache)
+
+    if len(args.data) > 0:
+        sim_data = SimData()
+        for data_fn in args.data:
+            exp_data = read_exp_data(data_fn)
+            sim_data.update_exp_data(data_fn, exp_data)
+
+        rows = sweep.calc_rmse_table(sim_data, args.tstart, args.tstop)
+        print("%-24s %s" % ('RMSE', ' '.join(sweep.param_names)))
+        for row in rows:
+            print("%-24f %s" % (row['rmse'], ' '.join(
+                [str(row[name]) for name in sweep.param_names])))
+        print("Saved RMSE table in %s" %
+              os.path.join(sweep.sweep_dir, 'rmse.csv'))
+
+    return 1 if len(failed) > 0 else 0
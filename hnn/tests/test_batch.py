@@ -0,0 +1,94 @@
+import os.path as op
+import sys
+import shutil
+import subprocess
+
+import pytest
+
+import hnn
+import hnn.batch
+from hnn.batch import _check_sim_prefixes, expand_param_files, main
+
+default_paramfn = op.join(op.dirname(hnn.__file__), '..', 'param',
+                          'default.param')
+
+
+def _write_param_file(tmpdir, fname, sim_prefix):
+    paramfn = op.join(str(tmpdir), fname)
+    with open(default_paramfn, 'r') as f:
+        lines = f.readlines()
+    with open(paramfn, 'w') as f:
+        for line in lines:
+            if line.startswith('sim_prefix:'):
+                line = 'sim_prefix: %s\n' % sim_prefix
+            f.write(line)
+    return paramfn
+
+
+def test_check_sim_prefixes(tmpdir):
+    """Test that simulations can't overwrite each other's results"""
+    paramfns = [_write_param_file(tmpdir, 'a.param', 'first'),
+                _write_param_file(tmpdir, 'b.param', 'second')]
+    _check_sim_prefixes(paramfns)
+
+    paramfns.append(_write_param_file(tmpdir, 'c.param', 'first'))
+    with pytest.raises(ValueError, match="have sim_prefix 'first'"):
+        _check_sim_prefixes(paramfns)
+
+
+def test_batch_arguments(tmpdir, monkeypatch, capsys):
+    """Test the command line arguments of the batch runner"""
+    paramfns = [_write_param_file(tmpdir, 'a.param', 'first'),
+                _write_param_file(tmpdir, 'b.param', 'second')]
+    shutil.copyfile(paramfns[0], op.join(str(tmpdir), 'notes.txt'))
+    pattern = op.join(str(tmpdir), '*.param')
+    assert expand_param_files([pattern, paramfns[0]]) == sorted(paramfns)
+
+    calls = list()
+
+    def run_batch(paramfns, **kwargs):
+        calls.append((paramfns, kwargs))
+        return []
+
+    monkeypatch.setattr(hnn.batch, 'run_batch', run_batch)
+    assert main([pattern, '--ncore', '4', '--ncore-per-sim', '2',
+                 '--no-cache', '--no-legacy-files', '--spec-scale', 'log',
+                 '--spec-dtype', 'float32', '-v']) == 0
+    assert calls[-1] == (sorted(paramfns),
+                         {'ncore': 4, 'ncore_per_sim': 2,
+                          'use_cache': False, 'verbose': True,
+                          'settings': {'legacy_files': False,
+                                       'spec_scale': 'log',
+                                       'spec_dtype': 'float32'}})
+    assert main([paramfns[1]]) == 0
+    # the settings of the output directory decide
+    assert calls[-1] == ([paramfns[1]],
+                         {'ncore': None, 'ncore_per_sim': 1,
+                          'use_cache': True, 'verbose': False,
+                          'settings': {}})
+
+    # no param files
+    n_calls = len(calls)
+    assert main([op.join(str(tmpdir), '*.json')]) == 1
+    assert len(calls) == n_calls
+    assert 'Error: no parameter files' in capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        main(['--ncore', 'all', pattern])
+
+    # errors before simulating are printed instead of raised
+    monkeypatch.undo()
+    _write_param_file(tmpdir, 'c.param', 'first')
+    assert main([pattern]) == 1
+    assert "Error: " in capsys.readouterr().out
+    assert main([paramfns[0], '--ncore-per-sim', '0']) == 1
+    assert "ncore_per_sim must be at least 1" in capsys.readouterr().out
+    with pytest.raises(ValueError, match='Unknown setting'):
+        hnn.batch.run_batch(paramfns, settings={'not_a_setting': 1})
+
+
+def test_batch_without_qt():
+    """Test that the batch runner can be imported without Qt"""
+    code = ("import sys; sys.modules['PyQt5'] = None; "
+            "import hnn.batch, hnn.sweep")
+    subprocess.run([sys.executable, '-c', code], check=True,
+                   cwd=op.join(op.dirname(hnn.__file__), '..'))
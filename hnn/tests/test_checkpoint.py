@@ -0,0 +1,370 @@
+import os.path as op
+from types import SimpleNamespace
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import pytest
+import hnn_core
+from hnn_core import CellResponse, Network, read_params
+from hnn_core.dipole import Dipole
+
+import hnn
+import hnn.checkpoint
+import hnn.qt_thread
+from hnn.qt_thread import OptThread, SimThread
+from hnn.checkpoint import (get_checkpoint_time, plan_continuation,
+                            read_checkpoint, read_checkpoint_results,
+                            simulate_checkpoint, write_checkpoint,
+                            CHECKPOINT_FNAME, _describe_drives,
+                            _get_drive_events)
+from hnn.paramrw import get_fname, hnn_core_compat_params
+from hnn.savestate import check_save_state, run_trials
+from hnn.simfile import write_sim_file
+
+default_paramfn = op.join(op.dirname(hnn.__file__), '..', 'param',
+                          'default.param')
+
+
+@pytest.fixture
+def save_state_supported(monkeypatch):
+    """Plan continuations with any hnn-core, which they don't simulate"""
+    monkeypatch.setattr(hnn.checkpoint, 'check_save_state', lambda: None)
+
+
+class _SerialBackend(object):
+    """Simulates the trials in this process, like one MPI rank"""
+
+    def __init__(self, n_procs=1):
+        self.n_procs = n_procs
+
+    def simulate_trials(self, net, trial_indices, states=None,
+                        save_state=False):
+        return run_trials(net, trial_indices, states, save_state)
+
+
+class _FakeNet(object):
+    """The parts of a Network that plan_continuation reads
+
+    Each drive has a cell for each list of event times in drive_times and
+    connects to L5 pyramidal cells with the weight params['gbar_<name>'].
+    """
+
+    def __init__(self, params, drive_times):
+        self.params = params
+        self.gid_ranges = dict()
+        self.external_drives = dict()
+        first_gid = 10
+        for name, times in drive_times.items():
+            gids = range(first_gid, first_gid + len(times))
+            first_gid += len(times)
+            self.gid_ranges[name] = gids
+            # the same events in every trial
+            events = [[np.array(gid_times) for gid_times in times]
+                      for _ in range(params['N_trials'])]
+            self.external_drives[name] = {
+                'type': 'evoked', 'events': events,
+                'dynamics': {'mu': min(min(times)), 'sigma': 2.,
+                             'numspikes': 1, 'tstop': params['tstop']},
+                'conn': {'L5_pyramidal': {
+                    'location': 'proximal', 'src_gids': list(gids),
+                    'target_gids': [0, 1], 'nmda': {},
+                    'ampa': {'A_weight': params['gbar_' + name]}}}}
+
+
+_DRIVE_TIMES = {'evprox1': [[20.], [25.]], 'evdist1': [[63.], [65., 66.]]}
+
+
+def _make_params(tstop, n_trials=2, dt=0.025):
+    return {'tstop': tstop, 'dt': dt, 'N_trials': n_trials,
+            'record_vsoma': 0, 'gbar_evprox1': 0.1, 'gbar_evdist1': 0.2}
+
+
+def _make_results(tstop, n_spikes, n_trials=2):
+    """Results of trials simulated to tstop with n_spikes each"""
+    times = np.arange(0., tstop + 0.0125, 0.025)
+    dpls = [Dipole(times, np.c_[times, times, times])
+            for _ in range(n_trials)]
+    spike_times = [list(np.linspace(0., tstop, n_spikes))
+                   for _ in range(n_trials)]
+    spike_gids = [[0] * n_spikes for _ in range(n_trials)]
+    spike_types = [['L5_pyramidal'] * n_spikes for _ in range(n_trials)]
+    spikes = CellResponse(spike_times=spike_times, spike_gids=spike_gids,
+                          spike_types=spike_types)
+    return {'raw_dpls': dpls, 'spikes': spikes, 'vsoma': []}
+
+
+def _make_checkpoint(net, results, n_procs=1):
+    """A checkpoint like simulate_checkpoint saves, without states"""
+    n_trials = net.params['N_trials']
+    return {'params': dict(net.params), 'tstop': net.params['tstop'],
+            'n_procs': n_procs, 'states': ['state'] * n_trials,
+            'drive_events': [_get_drive_events(net, trial_idx)
+                             for trial_idx in range(n_trials)],
+            'drives': _describe_drives(net),
+            'n_samples': len(results['raw_dpls'][0].times),
+            'n_spikes': [len(spike_times) for spike_times in
+                         results['spikes']._spike_times]}
+
+
+def test_checkpoint_files(tmpdir):
+    """Test that checkpoints are saved without the results"""
+    sim_dir = str(tmpdir)
+    assert read_checkpoint(sim_dir) is None
+    assert read_checkpoint_results(sim_dir) is None
+
+    net = _FakeNet(_make_params(30.), _DRIVE_TIMES)
+    results = _make_results(30., 4)
+    checkpoint = _make_checkpoint(net, results)
+    write_checkpoint(sim_dir, checkpoint)
+    assert read_checkpoint(sim_dir).keys() == checkpoint.keys()
+    assert 'sim_data' not in read_checkpoint(sim_dir)
+
+    # the results are read from the results file, with the raw dipoles
+    fname = get_fname(sim_dir, 'simfile')
+    write_sim_file(fname, results['raw_dpls'], results['spikes'],
+                   net.gid_ranges)
+    assert read_checkpoint_results(sim_dir) is None
+    vsoma = [{5: np.ones(1201), 'vtime': results['raw_dpls'][0].times}
+             for _ in range(2)]
+    write_sim_file(fname, results['raw_dpls'], results['spikes'],
+                   net.gid_ranges, raw_dpls=results['raw_dpls'], vsoma=vsoma)
+    read_results = read_checkpoint_results(sim_dir)
+    assert_array_equal(read_results['raw_dpls'][1].data['agg'],
+                       results['raw_dpls'][1].data['agg'])
+    assert read_results['spikes']._spike_times == \
+        results['spikes']._spike_times
+    assert list(read_results['vsoma'][0].keys()) == [5]
+
+    write_checkpoint(sim_dir, None)
+    assert not op.exists(op.join(sim_dir, CHECKPOINT_FNAME))
+
+
+def test_check_save_state(monkeypatch):
+    """Test that only the hnn-core that simulate_trial mirrors is used"""
+    monkeypatch.setattr(hnn_core, '__version__', '0.3.dev0')
+    assert 'hnn-core 0.3.dev0 is not supported' in check_save_state()
+
+
+def test_continuation_gate(save_state_supported):
+    """Test that trials are only continued with matching results"""
+    net = _FakeNet(_make_params(30.), _DRIVE_TIMES)
+    results = _make_results(30., 4)
+    checkpoint = _make_checkpoint(net, results)
+    new_net = _FakeNet(_make_params(70.), _DRIVE_TIMES)
+    sim_params = dict(new_net.params)
+
+    n_continued, _ = plan_continuation(checkpoint, sim_params, new_net,
+                                       _SerialBackend(), results)
+    assert n_continued == 2
+
+    # states saved over several processes per trial are never restored
+    n_continued, drive_events = plan_continuation(
+        checkpoint, sim_params, new_net, _SerialBackend(n_procs=2), results)
+    assert n_continued == 0
+    assert_array_equal(drive_events[0][11], [25.])
+    assert_array_equal(drive_events[0][13], [65., 66.])
+    multi_checkpoint = _make_checkpoint(net, results, n_procs=2)
+    assert plan_continuation(multi_checkpoint, sim_params, new_net,
+                             _SerialBackend(n_procs=2), results)[0] == 0
+
+    # the results must be those the checkpoint was saved with
+    assert plan_continuation(checkpoint, sim_params, new_net,
+                             _SerialBackend(), None)[0] == 0
+    other_results = _make_results(30., 5)
+    assert plan_continuation(checkpoint, sim_params, new_net,
+                             _SerialBackend(), other_results)[0] == 0
+    other_results = _make_results(30., 4, n_trials=1)
+    assert plan_continuation(checkpoint, sim_params, new_net,
+                             _SerialBackend(), other_results)[0] == 0
+
+    # checkpoints of older versions had the results
+    old_checkpoint = {key: val for key, val in checkpoint.items()
+                      if key not in ('n_samples', 'n_spikes')}
+    assert plan_continuation(old_checkpoint, sim_params, new_net,
+                             _SerialBackend(), results)[0] == 0
+
+
+def test_checkpoint_time():
+    """Test rounding the start of optimization down to a multiple of dt"""
+    dt = 0.025
+    assert get_checkpoint_time(63.53, dt) == 63.525
+    assert get_checkpoint_time(70., dt) == 70.
+    # np.arange has an extra sample for 0.275 and 0.3 ms
+    assert get_checkpoint_time(0.3, dt) == 0.25
+    assert get_checkpoint_time(0.01, dt) == 0.
+    assert get_checkpoint_time(0., dt) == 0.
+    assert get_checkpoint_time(50.01, 0.05) == 50.
+
+    for t_max in np.linspace(0.1, 170., 97):
+        t_checkpoint = get_checkpoint_time(t_max, dt)
+        assert t_max - 3 * dt < t_checkpoint <= t_max + 1e-8
+        n_steps = int(round(t_checkpoint / dt))
+        assert np.isclose(n_steps * dt, t_checkpoint)
+        # the times of hnn-core end at the checkpoint
+        times = np.arange(0., t_checkpoint + dt, dt)
+        assert len(times) == n_steps + 1
+        assert np.isclose(times[-1], t_checkpoint)
+
+
+def test_pool_config(monkeypatch):
+    """Test simulating each trial on one core to save its state"""
+    thread = SimThread.__new__(SimThread)
+    thread.ncore = 8
+    thread.mainwin = SimpleNamespace(ntrialgroups=2)
+    monkeypatch.setattr(hnn.qt_thread, '_has_mpi4py', lambda: True)
+    assert thread._get_pool_config(5) == (8, 2)
+    assert thread._get_pool_config(1) == (8, 1)
+    assert thread._get_pool_config(5, one_proc_per_trial=True) == (5, 5)
+    assert thread._get_pool_config(20, one_proc_per_trial=True) == (8, 8)
+    monkeypatch.setattr(hnn.qt_thread, '_has_mpi4py', lambda: False)
+    assert thread._get_pool_config(5, one_proc_per_trial=True) == (1, 1)
+
+
+def test_plan_step_pools(monkeypatch):
+    """Test choosing one core per trial to continue optimization steps"""
+    thread = OptThread.__new__(OptThread)
+    thread.ncore = 8
+    thread.num_concurrent = 4
+    thread.mainwin = SimpleNamespace(ntrialgroups=1)
+    thread.params = {'N_trials': 1, 'dt': 0.025}
+    thread.opt_algorithm = 'de'
+    thread.step_sims = 48
+    thread.opt_start = 100.
+    thread.opt_end = 170.
+    monkeypatch.setattr(hnn.qt_thread, '_has_mpi4py', lambda: True)
+    monkeypatch.setattr(hnn.qt_thread, 'check_save_state', lambda: None)
+
+    # differential evolution: every core simulates a parameter set
+    assert thread._plan_step_pools() == (True, 8, None)
+    thread.step_sims = 4
+    one_proc_per_trial, step_concurrent, reason = thread._plan_step_pools()
+    assert not one_proc_per_trial and step_concurrent == 4
+    assert 'faster' in reason
+    thread.step_sims = 48
+    monkeypatch.setattr(hnn.qt_thread, '_has_mpi4py', lambda: False)
+    assert not thread._plan_step_pools()[0]
+    monkeypatch.setattr(hnn.qt_thread, '_has_mpi4py', lambda: True)
+
+    # COBYLA: one core per trial pays off with several trials
+    thread.opt_algorithm = 'cobyla'
+    thread.step_sims = 50
+    assert not thread._plan_step_pools()[0]
+    thread.params['N_trials'] = 8
+    assert thread._plan_step_pools() == (True, 4, None)
+
+    # nothing to continue from
+    thread.opt_start = 0.
+    assert thread._plan_step_pools() == (False, 4, None)
+    thread.opt_start = 100.
+    monkeypatch.setattr(hnn.qt_thread, 'check_save_state',
+                        lambda: 'not supported')
+    assert thread._plan_step_pools() == (False, 4, 'not supported')
+
+
+def test_plan_fork(save_state_supported):
+    """Test continuing optimization evaluations from a checkpoint"""
+    net = _FakeNet(_make_params(30.), _DRIVE_TIMES)
+    results = _make_results(30., 4)
+    checkpoint = _make_checkpoint(net, results)
+    backend = _SerialBackend()
+
+    def plan(params, drive_times=_DRIVE_TIMES, **kwargs):
+        new_net = _FakeNet(params, drive_times)
+        n_continued, drive_events = plan_continuation(
+            checkpoint, dict(params), new_net, backend, results, **kwargs)
+        return n_continued, drive_events, new_net
+
+    # a drive after the checkpoint changes: the continuation gets the same
+    # events as a simulation from 0 ms
+    params = dict(_make_params(70.), gbar_evdist1=0.5)
+    n_continued, drive_events, new_net = plan(
+        params, exclude_params=['gbar_evdist1'], exact=True)
+    assert n_continued == 2
+    for trial_idx in range(2):
+        new_events = _get_drive_events(new_net, trial_idx)
+        assert drive_events[trial_idx].keys() == new_events.keys()
+        for gid in new_events:
+            assert_array_equal(drive_events[trial_idx][gid],
+                               new_events[gid])
+    # the excluded params don't matter for continuing later
+    assert plan(params, exclude_params=['gbar_evdist1'])[0] == 2
+
+    # a changed param must be one of the params being optimized
+    assert plan(params, exact=True)[0] == 0
+    # a changed drive with events before the checkpoint starts over
+    params = dict(_make_params(70.), gbar_evprox1=0.5)
+    assert plan(params, exclude_params=['gbar_evprox1'], exact=True)[0] == 0
+    # so does a longer time step
+    params = _make_params(70., dt=0.05)
+    assert plan(params, exclude_params=['dt'], exact=True)[0] == 0
+
+    # events before the checkpoint that it didn't simulate
+    params = _make_params(70.)
+    drive_times = dict(_DRIVE_TIMES, evprox1=[[20.], [25., 29.]])
+    assert plan(params, drive_times, exact=True)[0] == 0
+    n_continued, drive_events, _ = plan(params, drive_times)
+    assert n_continued == 2
+    # only the events that were simulated
+    assert_array_equal(drive_events[0][11], [25.])
+
+    # more trials than the checkpoint has
+    params = _make_params(70., n_trials=3)
+    n_continued, drive_events, _ = plan(params, exact=True)
+    assert n_continued == 2
+    assert len(drive_events) == 3
+
+    # different connections of the drives
+    params = dict(_make_params(70.), gbar_evnew=0.1)
+    drive_times = dict(_DRIVE_TIMES, evnew=[[80.]])
+    assert plan(params, drive_times, exclude_params=['gbar_evnew'])[0] == 0
+    # the checkpoint is later than tstop
+    assert plan(_make_params(20.))[0] == 0
+
+
+def _simulate(params, tstop, **kwargs):
+    params = params.copy()
+    params['tstop'] = tstop
+    net = Network(params, add_drives_from_params=True)
+    return simulate_checkpoint(net, _SerialBackend(), **kwargs)
+
+
+def test_continue_simulation():
+    """Test that a continued simulation equals one from 0 ms"""
+    reason = check_save_state()
+    if reason is not None:
+        pytest.skip(reason)
+    params = hnn_core_compat_params(read_params(default_paramfn))
+    params['N_trials'] = 1
+
+    full = _simulate(params, 70., save_state=False)
+    assert 'checkpoint' not in full
+
+    first = _simulate(params, 30.)
+    checkpoint = first['checkpoint']
+    assert checkpoint['n_samples'] == len(first['raw_dpls'][0].times)
+    assert 'sim_data' not in checkpoint
+    continued = _simulate(params, 70., checkpoint=checkpoint, results=first,
+                          exact=True)
+    assert continued['continued_from']['tstop'] == 30.
+
+    assert_allclose(continued['raw_dpls'][0].times,
+                    full['raw_dpls'][0].times)
+    for layer in ('agg', 'L2', 'L5'):
+        assert_allclose(continued['raw_dpls'][0].data[layer],
+                        full['raw_dpls'][0].data[layer], atol=1e-8)
+    assert_allclose(continued['spikes']._spike_times[0],
+                    full['spikes']._spike_times[0], atol=1e-8)
+    assert continued['spikes']._spike_gids[0] == \
+        full['spikes']._spike_gids[0]
+
+    # an optimization evaluation that changes a drive after 30 ms
+    fork_params = dict(params, gbar_evdist_1_L5Pyr_ampa=0.5)
+    full = _simulate(fork_params, 70., save_state=False)
+    forked = _simulate(fork_params, 70., checkpoint=checkpoint,
+                       results=first, exact=True, save_state=False,
+                       exclude_params=['gbar_evdist_1_L5Pyr_ampa'])
+    assert forked['continued_from']['tstop'] == 30.
+    assert_allclose(forked['raw_dpls'][0].data['agg'],
+                    full['raw_dpls'][0].data['agg'], atol=1e-8)
+    assert_allclose(forked['spikes']._spike_times[0],
+                    full['spikes']._spike_times[0], atol=1e-8)
@@ -0,0 +1,134 @@
+import sys
+import pickle
+import base64
+from subprocess import Popen, PIPE
+
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+from hnn.mpi_pool import MPIPoolBackend, TrialGroupBackend, _ChildDataReader
+
+# writes output and a result framed like MPIPoolWorker._write_data_stderr,
+# then waits for stdin to close like the ranks waiting for the next job
+_FAKE_CHILD = """
+import sys, pickle, base64
+import numpy as np
+sys.stdout.write('simulating\\n')
+sys.stdout.flush()
+sys.stderr.write('warning from a rank\\n')
+result = ('data', np.arange(200000.))
+pickled_bytes = base64.b64encode(pickle.dumps(result))
+sys.stderr.write('@start_of_data@')
+sys.stderr.write(pickled_bytes.decode())
+sys.stderr.write('@end_of_data:%d@' % len(pickled_bytes))
+sys.stderr.write('after the data\\n')
+sys.stderr.flush()
+sys.stdin.readline()
+"""
+
+
+def _frame(result):
+    pickled_bytes = base64.b64encode(pickle.dumps(result))
+    return pickled_bytes, (b'@start_of_data@' + pickled_bytes +
+                           b'@end_of_data:%d@' % len(pickled_bytes))
+
+
+def test_child_data_reader():
+    """Test separating a result from the output of the ranks"""
+    pickled_bytes, framed = _frame(('data', list(range(1000))))
+    stream = b'output @ with an at sign\n' + framed + b'trailing'
+
+    # markers split over every possible chunk boundary
+    for chunk_size in [1, 2, 7, 15, 64, len(stream)]:
+        reader = _ChildDataReader()
+        output = b''
+        for idx in range(0, len(stream), chunk_size):
+            if reader.data_bytes is None:
+                output += reader.feed(stream[idx:idx + chunk_size])
+            else:
+                # as in _wait_for_data
+                output += stream[idx:idx + chunk_size]
+        assert reader.data_bytes == pickled_bytes
+        assert reader.data_len == len(pickled_bytes)
+        assert output == b'output @ with an at sign\ntrailing'
+
+    reader = _ChildDataReader()
+    # the end could be the beginning of a start signal
+    assert reader.feed(b'no data yet, but output') == b'no data y'
+    assert reader.data_bytes is None
+
+
+def test_wait_for_data(capfd):
+    """Test receiving a large result from a fake MPI process"""
+    proc = Popen([sys.executable, '-c', _FAKE_CHILD], stdin=PIPE,
+                 stdout=PIPE, stderr=PIPE)
+    try:
+        # the pipes are read without starting MPI ranks
+        backend = MPIPoolBackend.__new__(MPIPoolBackend)
+        data_bytes, data_len = backend._wait_for_data(proc)
+    finally:
+        proc.stdin.close()
+        proc.wait()
+
+    assert len(data_bytes) == data_len
+    status, result = pickle.loads(base64.b64decode(data_bytes))
+    assert status == 'data'
+    assert_array_equal(result, np.arange(200000.))
+    out = capfd.readouterr().out
+    assert 'simulating' in out and 'warning from a rank' in out
+    assert '@' not in out
+
+
+class _StubPool(object):
+    """Simulates trials like an MPIPoolBackend, recording its jobs"""
+
+    def __init__(self, fail=False):
+        self.jobs = list()
+        self.fail = fail
+        self.terminated = False
+
+    def simulate_trials(self, net, trial_indices, states=None,
+                        save_state=False):
+        self.jobs.append((trial_indices, states, save_state))
+        if self.fail:
+            raise RuntimeError("MPI simulation failed")
+        return [('dpl_%d' % trial_idx, 'spikes_%d' % trial_idx)
+                for trial_idx in trial_indices]
+
+    def terminate(self):
+        self.terminated = True
+
+
+def _make_group_backend(pools):
+    # the groups are simulated without starting MPI ranks
+    backend = TrialGroupBackend.__new__(TrialGroupBackend)
+    backend.pools = pools
+    return backend
+
+
+def test_trial_groups():
+    """Test that trials simulated in groups are merged in trial order"""
+    pools = [_StubPool() for _ in range(3)]
+    backend = _make_group_backend(pools)
+
+    # 7 trials over 3 groups
+    sim_data = backend.simulate_trials('net', list(range(7)))
+    assert sim_data == [('dpl_%d' % idx, 'spikes_%d' % idx)
+                        for idx in range(7)]
+    assert [pool.jobs[0][0] for pool in pools] == [[0, 1, 2], [3, 4], [5, 6]]
+
+    # a subset of the trials, continued from their states
+    sim_data = backend.simulate_trials('net', [4, 9], states=['s4', 's9'],
+                                       save_state=True)
+    assert [dpl for dpl, _ in sim_data] == ['dpl_4', 'dpl_9']
+    # fewer trials than groups leaves the last group idle
+    assert [pool.jobs[1:] for pool in pools] == \
+        [[([4], ['s4'], True)], [([9], ['s9'], True)], []]
+
+    # a failed group stops the others
+    pools = [_StubPool(), _StubPool(fail=True)]
+    backend = _make_group_backend(pools)
+    with pytest.raises(RuntimeError, match='MPI simulation failed'):
+        backend.simulate_trials('net', list(range(4)))
+    assert all([pool.terminated for pool in pools])
@@ -0,0 +1,205 @@
+import os.path as op
+import sys
+from types import SimpleNamespace
+
+import nlopt
+import numpy as np
+from numpy.testing import assert_allclose
+import pytest
+from hnn_core.dipole import Dipole
+
+from hnn.optfn import (DifferentialEvolution, EvalMemo, GPSurrogate,
+                       SurrogateOptimizer, expected_improvement, get_batches,
+                       quantize, read_opt_state, write_opt_state)
+from hnn.qt_thread import OptThread
+
+
+def _minimize(de, func, num_evals):
+    while de.n_evals < num_evals:
+        candidates = de.ask()[:num_evals - de.n_evals]
+        de.tell(candidates, [func(x) for x in candidates])
+
+
+def test_differential_evolution():
+    """Test differential evolution finds the minimum within the bounds"""
+    lb, ub = [-5., 0.], [5., 10.]
+
+    def func(x):
+        return (x[0] - 1.) ** 2 + (x[1] - 3.) ** 2
+
+    de = DifferentialEvolution(lb, ub, x0=[4., 9.], batch_size=3, seed=0)
+    assert de.popsize == 9
+    de = DifferentialEvolution(lb, ub, x0=[4., 9.], popsize=10, seed=0)
+    first = de.ask()
+    # x0 is evaluated first
+    assert_allclose(first[0], [4., 9.])
+    assert np.all(first >= lb) and np.all(first <= ub)
+    de.tell(first, [func(x) for x in first])
+
+    _minimize(de, func, 500)
+    assert de.n_evals == 500
+    assert np.all(de.population >= lb) and np.all(de.population <= ub)
+    assert_allclose(de.best_x, [1., 3.], atol=0.05)
+    assert de.best_err == np.min(de.errors)
+
+    # same seed, same candidates
+    de2 = DifferentialEvolution(lb, ub, x0=[4., 9.], popsize=10, seed=0)
+    assert_allclose(de2.ask(), first)
+
+    # budget ending during a generation
+    de = DifferentialEvolution(lb, ub, x0=[4., 9.], popsize=8, seed=1)
+    _minimize(de, func, 13)
+    assert de.n_evals == 13
+    assert de.best_err <= func([4., 9.])
+
+    with pytest.raises(ValueError, match='popsize'):
+        DifferentialEvolution(lb, ub, x0=[0., 0.], popsize=3)
+    with pytest.raises(ValueError, match='same length'):
+        DifferentialEvolution(lb, ub, x0=[0.])
+    # steps whose ranges all have zero width have no parameters
+    with pytest.raises(ValueError, match='At least one parameter'):
+        DifferentialEvolution([], [], x0=[])
+
+
+def test_get_batches():
+    """Test splitting candidates into concurrent batches"""
+    assert [list(batch) for batch in get_batches(5, 2)] == \
+        [[0, 1], [2, 3], [4]]
+    assert get_batches(0, 2) == []
+
+
+def test_gp_surrogate():
+    """Test the Gaussian process interpolates evaluated errors"""
+    rng = np.random.RandomState(0)
+    X = rng.uniform(size=(15, 2))
+    y = np.sin(3 * X[:, 0]) + X[:, 1] ** 2
+
+    gp = GPSurrogate()
+    gp.fit(X, y)
+    mean, std = gp.predict(X)
+    assert_allclose(mean, y, atol=1e-3)
+    assert np.all(std < 1e-2)
+    # less certain away from the evaluations
+    _, std_far = gp.predict(np.array([[3., 3.]]))
+    assert std_far[0] > 10 * np.max(std)
+
+    ei = expected_improvement(np.array([0., 1., 1.]), np.array([0., 0., 1.]),
+                              best_err=0.5)
+    assert_allclose(ei[:2], [0.5, 0.])
+    assert ei[2] > 0
+
+
+def test_surrogate_optimizer(tmpdir):
+    """Test surrogate optimization and resuming it from a saved state"""
+    lb, ub = [-5., 0.], [5., 10.]
+
+    def func(x):
+        return (x[0] - 1.) ** 2 + (x[1] - 3.) ** 2
+
+    so = SurrogateOptimizer(lb, ub, x0=[4., 9.], n_init=4, seed=0)
+    first = so.ask(2)
+    assert_allclose(first[0], [4., 9.])
+    so.tell(first, [func(x) for x in first])
+    state_fname = op.join(str(tmpdir), 'opt_step_1.json')
+    write_opt_state(state_fname, 'key', so.get_state())
+
+    while so.n_evals < 20:
+        candidates = so.ask(2)
+        if so.converged:
+            break
+        assert np.all(candidates >= lb) and np.all(candidates <= ub)
+        so.tell(candidates, [func(x) for x in candidates])
+    assert so.best_err < 0.1
+
+    # resume from the first evaluations
+    assert read_opt_state(state_fname, 'other key') is None
+    resumed = SurrogateOptimizer(lb, ub, x0=[4., 9.], n_init=4, seed=0)
+    resumed.set_state(read_opt_state(state_fname, 'key'))
+    assert resumed.n_evals == 2
+    assert_allclose(resumed.ask(2), so.initial_design[2:4])
+
+    with pytest.raises(ValueError, match='At least one parameter'):
+        SurrogateOptimizer([], [], x0=[])
+
+
+def test_eval_memo():
+    """Test remembering evaluations of nearly identical parameters"""
+    assert quantize(0.0123456, 1e-4) == 0.012346
+    assert quantize(0.01234561, 1e-4) == quantize(0.0123456, 1e-4)
+    assert quantize(-250.1, 1e-2) == -250.
+    assert quantize(0.0123456, 0) == 0.0123456
+
+    times = np.arange(0., 170. + 0.025, 0.025)
+    avg_dpl = Dipole(times, np.zeros((len(times), 3)))
+    dpl_bytes = 4 * times.nbytes
+
+    memo = EvalMemo(max_entries=2)
+    assert memo.get('a') is None
+    memo.put('a', avg_dpl)
+    assert memo.get('a') is avg_dpl
+    assert memo.nbytes == dpl_bytes
+    assert memo.get_error('a', 'step 1') is None
+    memo.put_error('a', 'step 1', 1.5)
+    assert memo.get_error('a', 'step 1') == 1.5
+    assert memo.get_error('a', 'step 2') is None
+    assert (memo.hits, memo.misses) == (1, 1)
+    assert '1 hits, 1 misses' in memo.status()
+
+    # the least recently used is forgotten
+    memo.put('b', Dipole(times, np.ones((len(times), 3))))
+    memo.get('a')
+    memo.put('c', Dipole(times, np.ones((len(times), 3))))
+    assert len(memo) == 2
+    assert memo.get('b') is None
+    assert memo.get('a') is avg_dpl
+    assert memo.nbytes == 2 * dpl_bytes
+    memo.clear()
+    assert len(memo) == 0
+    assert memo.nbytes == 0
+
+    # and when the dipoles take more memory than allowed
+    memo = EvalMemo(max_bytes=int(2.5 * dpl_bytes))
+    for key in ['a', 'b', 'c', 'b']:
+        memo.put(key, avg_dpl)
+    assert len(memo) == 2
+    assert memo.get('a') is None
+    assert memo.nbytes == 2 * dpl_bytes
+    # the latest evaluation is kept even if it is larger
+    memo.max_bytes = 1
+    memo.put('d', avg_dpl)
+    assert len(memo) == 1
+    assert memo.get('d') is avg_dpl
+
+
+def test_cobyla_fixed_params():
+    """Test COBYLA only optimizes parameters with a range"""
+    step_ranges = {'a': {'initial': 0.2, 'minval': 0., 'maxval': 1.},
+                   'b': {'initial': 5., 'minval': 5., 'maxval': 5.},
+                   'c': {'initial': 0.2, 'minval': 0., 'maxval': 1.}}
+    thread = OptThread.__new__(OptThread)
+    thread.step_ranges = step_ranges
+    thread.cur_step = thread.cur_itr = 0
+    thread._updatewaitsimwin = lambda txt: None
+
+    # values are mapped to the parameters with a range
+    shown = list()
+
+    def update_gui_params(opt_params):
+        shown.append(opt_params)
+        raise StopIteration
+
+    thread.baseparamwin = SimpleNamespace(update_gui_params=update_gui_params)
+    thread.opt_param_names = ['a', 'c']
+    with pytest.raises(StopIteration):
+        thread._opt_sim(np.array([0.5, 0.7]))
+    assert shown == [{'a': 0.5, 'c': 0.7}]
+    assert thread._opt_sim(np.array([0.5, 2.])) == sys.float_info.max
+
+    def opt_sim(x, grad=0):
+        return (x[0] - 0.3) ** 2 + (x[1] - 0.6) ** 2
+
+    thread._opt_sim = opt_sim
+    results = thread._run_opt_step(step_ranges, 100, nlopt.LN_COBYLA)
+    assert thread.opt_param_names == ['a', 'c']
+    assert thread.opt.get_dimension() == 2
+    assert_allclose(results, [0.3, 5., 0.6], atol=1e-3)
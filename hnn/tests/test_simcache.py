@@ -0,0 +1,74 @@
+import os
+import os.path as op
+
+import numpy as np
+import hnn_core
+
+from hnn.simcache import SimResultCache, get_cache_key
+
+
+def test_get_cache_key(monkeypatch):
+    """Test the normalization of the parameters of cache keys"""
+    params = {'tstop': 170., 'dt': 0.025, 'N_trials': 2,
+              'numspikes_evprox_1': 1., 'sync_evinput': True,
+              'gbar_L2Pyr_L2Pyr_ampa': 0.3}
+    key = get_cache_key(params)
+    assert key == get_cache_key(dict(reversed(list(params.items()))))
+
+    # output-only params don't change the simulation
+    assert key == get_cache_key(dict(params, sim_prefix='other',
+                                     f_max_spec=100., save_figs=True,
+                                     dipole_scalefctr=1.))
+
+    # values are compared regardless of type and float rounding errors
+    assert key == get_cache_key(dict(params, tstop=170, sync_evinput=1,
+                                     numspikes_evprox_1=1.2,
+                                     N_trials=np.int64(2)))
+    assert key == get_cache_key(dict(params,
+                                     gbar_L2Pyr_L2Pyr_ampa=0.1 + 0.2))
+    assert key != get_cache_key(dict(params, gbar_L2Pyr_L2Pyr_ampa=0.31))
+    assert key != get_cache_key(dict(params, numspikes_evprox_1=2.))
+
+    assert get_cache_key(params, sim_length=50.) == \
+        get_cache_key(params, sim_length=50. + 1e-12)
+    assert key != get_cache_key(params, sim_length=50.)
+
+    # results of another simulator version can't be reused
+    monkeypatch.setattr(hnn_core, '__version__', 'other')
+    assert key != get_cache_key(params)
+
+
+def test_sim_result_cache(tmpdir):
+    """Test storing results and evicting the least recently used"""
+    cache_dir = op.join(str(tmpdir), 'cache')
+    sim_data = {'dpls': np.zeros(1000)}
+    cache = SimResultCache(cache_dir=cache_dir)
+    assert cache.get('a') is None
+    cache.put('a', sim_data)
+    entry_bytes = op.getsize(op.join(cache_dir, 'a.pkl'))
+    np.testing.assert_array_equal(cache.get('a')['dpls'], sim_data['dpls'])
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # room for three entries
+    cache = SimResultCache(cache_dir=cache_dir, max_bytes=3 * entry_bytes)
+    for key in ['b', 'c']:
+        cache.put(key, sim_data)
+    for age, key in enumerate(['c', 'a', 'b']):
+        mtime = 1e9 - 100 * age
+        os.utime(op.join(cache_dir, key + '.pkl'), (mtime, mtime))
+    # reading makes 'b' the most recently used, so 'a' is the oldest
+    assert cache.get('b') is not None
+
+    cache.put('d', sim_data)
+    assert sorted(os.listdir(cache_dir)) == ['b.pkl', 'c.pkl', 'd.pkl']
+    cache.put('e', sim_data)
+    assert sorted(os.listdir(cache_dir)) == ['b.pkl', 'd.pkl', 'e.pkl']
+
+    # unreadable entries are removed
+    with open(op.join(cache_dir, 'b.pkl'), 'wb') as f:
+        f.write(b'corrupt')
+    assert cache.get('b') is None
+    assert not op.exists(op.join(cache_dir, 'b.pkl'))
+
+    cache.clear()
+    assert os.listdir(cache_dir) == []
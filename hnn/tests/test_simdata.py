@@ -0,0 +1,455 @@
+import os
+import os.path as op
+from pickle import dump
+from threading import Event
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+from scipy import signal
+
+from hnn_core import read_params, CellResponse
+from hnn_core.dipole import Dipole, average_dipoles
+
+import hnn.simdata
+from hnn.simdata import SimData, SimStore, calc_dipole_err, _get_err_plan
+from hnn.simfn import postproc_dipoles, write_sim_data
+from hnn.paramrw import (write_gids_param, read_output_settings,
+                         write_output_settings)
+from hnn.convert import convert_sim_dir
+from hnn.simfile import open_sim_file
+from hnn.dplstats import DipoleEnsemble
+from hnn.expdata import read_exp_data
+
+
+def _calc_err_loop(exp_data, avg_dpl, tstop, tstart, weights):
+    """Calculate the errors one column at a time"""
+    lerr = []
+    for dat in exp_data.values():
+        exp_times = dat[:, 0]
+        sim_times = avg_dpl.times
+        for tseries in [exp_times, sim_times]:
+            tstart = max(tstart, tseries[0])
+            tstop = min(tstop, tseries[-1])
+
+        exp_start = np.abs(exp_times - tstart).argmin()
+        exp_end = np.abs(exp_times - tstop).argmin()
+        sim_start = np.abs(sim_times - tstart).argmin()
+        sim_end = np.abs(sim_times - tstop).argmin()
+
+        for c in range(1, dat.shape[1]):
+            dpl1 = avg_dpl.data['agg'][sim_start:sim_end]
+            dpl2 = dat[exp_start:exp_end, c]
+            weight = None
+            if weights is not None:
+                weight = weights[sim_start:sim_end]
+            if len(dpl1) > len(dpl2):
+                dpl1 = signal.resample(dpl1, len(dpl2))
+                if weight is not None:
+                    weight = signal.resample(weight, len(dpl2))
+                    weight[weight < 1e-4] = 0
+            elif len(dpl1) < len(dpl2):
+                dpl2 = signal.resample(dpl2, len(dpl1))
+
+            if weight is not None:
+                lerr.append(np.sqrt((weight * (dpl1 - dpl2) ** 2).sum() /
+                                    weight.sum()))
+            else:
+                lerr.append(np.sqrt(((dpl1 - dpl2) ** 2).mean()))
+    return lerr
+
+
+def test_calc_dipole_err():
+    """Test the RMSE of all experimental columns and files together"""
+    hnn_root = op.join(op.dirname(__file__), '..', '..')
+    dat = np.loadtxt(op.join(hnn_root, 'data', 'MEG_detection_data',
+                             'S1_SupraT.txt'))
+    rng = np.random.RandomState(0)
+    # a second column, and a file sampled more finely than the simulation
+    exp_times = np.arange(0., 170., 0.02)
+    exp_data = {'S1_SupraT.txt': np.c_[dat, -dat[:, 1]],
+                'fine.txt': np.c_[exp_times, np.sin(exp_times / 10.)]}
+
+    times = np.arange(0., 170. + 0.025, 0.025)
+    agg = 20 * np.sin(times / 15.) + rng.normal(size=len(times))
+    avg_dpl = Dipole(times, np.c_[agg, agg / 2., agg / 2.])
+    weights = rng.uniform(size=len(times))
+
+    for tstart, tstop, w in [(0., 170., None), (20., 120., weights),
+                             (-5., 500., weights)]:
+        lerr, errtot = calc_dipole_err(exp_data, avg_dpl, tstop, tstart, w)
+        expected = _calc_err_loop(exp_data, avg_dpl, tstop, tstart, w)
+        assert len(lerr) == 3
+        assert_allclose(lerr, expected, rtol=1e-10)
+        assert_allclose(errtot, np.mean(expected), rtol=1e-10)
+        # the cached plan gives the errors of a different dipole
+        neg_dpl = Dipole(times, -np.c_[agg, agg / 2., agg / 2.])
+        lerr, _ = calc_dipole_err(exp_data, neg_dpl, tstop, tstart, w)
+        assert_allclose(lerr, _calc_err_loop(exp_data, neg_dpl, tstop,
+                                             tstart, w), rtol=1e-10)
+
+    assert calc_dipole_err(dict(), avg_dpl, 170.) == ([], 0.0)
+
+
+def test_err_plan_identity(monkeypatch):
+    """Test that error plans identify experimental data by its array"""
+    times = np.arange(0., 170. + 0.025, 0.025)
+    exp_data = {'exp.txt': np.c_[times, np.sin(times / 10.)]}
+    plan = _get_err_plan(exp_data, times, 0., 170., None)
+
+    # the experimental data isn't hashed again on each evaluation
+    def get_array_key(arr):
+        raise AssertionError('Experimental data was hashed')
+
+    monkeypatch.setattr(hnn.simdata, '_get_array_key', get_array_key)
+    assert _get_err_plan(exp_data, times, 0., 170., None) is plan
+
+    # new data of the same file gets a new plan
+    new_data = {'exp.txt': np.c_[times, np.cos(times / 10.)]}
+    assert _get_err_plan(new_data, times, 0., 170., None) is not plan
+
+
+def _make_sim_result(params, seed=0):
+    """A post-processed simulation result of random dipoles"""
+    rng = np.random.RandomState(seed)
+    times = np.arange(0., 170. + 0.025, 0.025)
+    raw_dpls = [Dipole(times, rng.normal(size=(len(times), 3)))
+                for _ in range(params['N_trials'])]
+    sim_data = {'raw_dpls': raw_dpls, 'spikes': None, 'gid_ranges': None,
+                'vsoma': None}
+    postproc_dipoles(sim_data, params)
+    return sim_data
+
+
+def test_opt_err_in_worker():
+    """Test the optimization error calculated outside of the GUI thread"""
+    hnn_root = op.join(op.dirname(__file__), '..', '..')
+    paramfn = op.join(hnn_root, 'param', 'default.param')
+    params = read_params(paramfn)
+    params['N_trials'] = 2
+    sim_result = _make_sim_result(params)
+
+    sim_data = SimData()
+    exp_times = np.arange(0., 170., 0.1)
+    sim_data.update_exp_data('exp.txt', np.c_[exp_times,
+                                              np.sin(exp_times / 10.)])
+    opt_start, opt_end = 20., 120.
+    weights = np.ones(len(sim_result['avg_dpl'].times))
+    weights[:1000] = 0.5
+
+    # the optimization thread uses a snapshot of the experimental data
+    exp_data = sim_data.get_exp_data()
+    _, werr = calc_dipole_err(exp_data, sim_result['avg_dpl'], opt_end,
+                              opt_start, weights)
+
+    # the GUI thread calculated it from the results in sim_data
+    sim_data.update_sim_data(paramfn, params, sim_result['dpls'],
+                             sim_result['avg_dpl'], None, None)
+    assert werr == sim_data.get_werr(paramfn, weights, opt_end, opt_start)
+    expected = _calc_err_loop(exp_data, sim_result['avg_dpl'], opt_end,
+                              opt_start, weights)
+    assert_allclose(werr, np.mean(expected), rtol=1e-10)
+
+    # data loaded during the optimization doesn't change its errors
+    sim_data.clear_exp_data()
+    assert calc_dipole_err(exp_data, sim_result['avg_dpl'], opt_end,
+                           opt_start, weights)[1] == werr
+
+
+def test_share_opt_data():
+    """Test that sim_data and opt_data share read-only results"""
+    hnn_root = op.join(op.dirname(__file__), '..', '..')
+    paramfn = op.join(hnn_root, 'param', 'default.param')
+    params = read_params(paramfn)
+    params['N_trials'] = 2
+    sim_result = _make_sim_result(params)
+    expected_agg = sim_result['avg_dpl'].data['agg'].copy()
+
+    sim_data = SimData()
+    sim_data.update_sim_data(paramfn, params, sim_result['dpls'],
+                             sim_result['avg_dpl'], None, None)
+    event = Event()
+    sim_data.update_opt_data_from_sim_data(event, paramfn)
+    assert event.is_set()
+    data = sim_data._sim_data[paramfn]['data']
+    opt_data = sim_data._opt_data['data']
+    assert opt_data['avg_dpl'] is data['avg_dpl']
+    assert opt_data['dpls'] is not data['dpls']
+
+    # the shared results can't be changed through opt_data
+    for dpl in [opt_data['avg_dpl']] + opt_data['dpls']:
+        assert not dpl.data['agg'].flags.writeable
+        assert not dpl.times.flags.writeable
+    with pytest.raises(ValueError, match='read-only'):
+        opt_data['avg_dpl'].data['agg'][0] = 1.
+    with pytest.raises(ValueError, match='read-only'):
+        opt_data['dpls'][0].data['agg'] *= 2
+    opt_data['dpls'].pop()
+    sim_data._opt_data['params']['N_trials'] = 1
+    assert len(data['dpls']) == 2
+    assert sim_data._sim_data[paramfn]['params']['N_trials'] == 2
+    assert_allclose(data['avg_dpl'].data['agg'], expected_agg)
+
+    # and back, e.g. when the optimization is done
+    sim_data.update_sim_data_from_opt_data(Event(), 'best.param')
+    best = sim_data._sim_data['best.param']['data']
+    assert best['avg_dpl'] is data['avg_dpl']
+    assert best['dpls'] is not opt_data['dpls']
+
+    # the best result of an optimization is frozen without copying
+    result = _make_sim_result(params, seed=1)
+    sim_data.update_opt_data_from_result(
+        SimpleNamespace(data=result, params=params))
+    opt_data = sim_data._opt_data['data']
+    assert opt_data['avg_dpl'] is result['avg_dpl']
+    assert not result['avg_dpl'].data['agg'].flags.writeable
+    assert not result['dpls'][1].data['L5'].flags.writeable
+    assert sim_data._opt_data['paramfn'].endswith(
+        params['sim_prefix'] + '.param')
+
+
+def test_dipole_ensemble():
+    """Test the statistics of trial dipoles updated one trial at a time"""
+    rng = np.random.RandomState(0)
+    times = np.arange(0., 50., 0.5)
+    dpls = [Dipole(times, rng.randn(len(times), 3)) for _ in range(200)]
+    dpl_stats = DipoleEnsemble().add_trials(dpls)
+
+    avg_dpl = average_dipoles(dpls)
+    assert dpl_stats.get_avg_dpl().nave == 200
+    for layer in ['agg', 'L2', 'L5']:
+        data = np.array([dpl.data[layer] for dpl in dpls])
+        assert_allclose(dpl_stats.get_mean(layer), avg_dpl.data[layer])
+        assert_allclose(dpl_stats.get_avg_dpl().data[layer],
+                        avg_dpl.data[layer])
+        assert_allclose(dpl_stats.get_var(layer, ddof=1),
+                        data.var(axis=0, ddof=1))
+        # the percentiles are estimated
+        lower, upper = dpl_stats.get_band(layer)
+        assert_allclose(lower, np.percentile(data, 5, axis=0), atol=0.5)
+        assert_allclose(upper, np.percentile(data, 95, axis=0), atol=0.5)
+        assert np.all(lower < dpl_stats.get_mean(layer))
+
+    # the percentiles of a few trials are exact
+    dpl_stats = DipoleEnsemble(percentiles=(25., 75.)).add_trials(dpls[:4])
+    data = np.array([dpl.data['L2'] for dpl in dpls[:4]])
+    assert_allclose(dpl_stats.get_percentile(75., 'L2'),
+                    np.percentile(data, 75, axis=0))
+
+
+def test_read_exp_data(tmpdir):
+    """Test reading experimental data files through binary sidecars"""
+    cache_dir = str(tmpdir.join('cache'))
+    rng = np.random.RandomState(0)
+    data = np.c_[np.arange(0., 10., 0.5), rng.randn(20, 3)]
+    for delimiter in [' ', ',', ', ']:
+        data_fn = str(tmpdir.join('data.txt'))
+        np.savetxt(data_fn, data, delimiter=delimiter)
+        exp_data = read_exp_data(data_fn, cache_dir)
+        assert_allclose(exp_data, data)
+        assert not exp_data.flags.writeable
+
+        # later reads memory-map the sidecar of the unchanged file
+        assert isinstance(read_exp_data(data_fn, cache_dir), np.memmap)
+        assert len(tmpdir.join('cache').listdir()) == 1
+
+    # comments are parsed by np.loadtxt
+    data_fn = tmpdir.join('comments.txt')
+    data_fn.write('# times\tagg\n0.0\t1.0\n0.5\t2.0\n')
+    assert_allclose(read_exp_data(str(data_fn), cache_dir),
+                    [[0., 1.], [0.5, 2.]])
+
+    data_fn = tmpdir.join('invalid.txt')
+    data_fn.write('0.0\tone\n')
+    with pytest.raises(ValueError):
+        read_exp_data(str(data_fn), cache_dir)
+
+
+def test_sim_store(tmpdir):
+    """Test spilling the least recently used simulations to disk"""
+    def _make_sim(value):
+        dpl = np.full(1000, value)
+        return {'params': {'N_trials': 1},
+                'data': {'avg_dpl': dpl, 'vsoma': [{1: [value] * 10}]}}
+
+    spill_dir = str(tmpdir)
+    store = SimStore(max_bytes=20000, spill_dir=spill_dir)
+    store['a.param'] = _make_sim(1.)
+    store['b.param'] = _make_sim(2.)
+    assert store.n_spilled == 0
+    store['a.param']  # now b is the least recently used
+    store['c.param'] = _make_sim(3.)
+    assert store.n_spilled == 1
+    assert len(tmpdir.listdir()) == 1
+    assert 0 < store.mem_bytes <= 20000
+
+    # keys keep their order and are found without loading
+    assert list(store) == ['a.param', 'b.param', 'c.param']
+    assert 'b.param' in store
+    assert store.n_spilled == 1
+
+    # loaded again read-only, spilling the least recently used
+    sim = store['b.param']
+    assert_allclose(sim['data']['avg_dpl'], 2.)
+    assert not sim['data']['avg_dpl'].flags.writeable
+    assert sim['data']['vsoma'][0][1] == [2.] * 10
+    assert store.n_spilled == 1
+    assert_allclose(store['a.param']['data']['avg_dpl'], 1.)
+
+    # a simulation larger than the budget is kept while it's used
+    store.max_bytes = 1
+    store.evict(keep='a.param')
+    assert store.n_spilled == 2
+    del store['b.param']
+    store.clear()
+    assert len(store) == 0
+    assert len(tmpdir.listdir()) == 0
+
+
+def _write_trial_files(tmpdir):
+    """Write the results of a simulation of 2 trials like older HNN"""
+    hnn_root = op.join(op.dirname(__file__), '..', '..')
+    paramfn = op.join(hnn_root, 'param', 'default.param')
+    params = read_params(paramfn)
+    params['N_trials'] = 2
+    params['record_vsoma'] = False
+    params['save_spec_data'] = False
+
+    sim_dir = tmpdir.mkdir(params['sim_prefix'])
+    times = np.arange(0., 10., 0.5)
+    for trial_idx in range(2):
+        dpl = Dipole(times, np.full((len(times), 3), trial_idx + 1.))
+        dpl.write(str(sim_dir.join('dpl_%d.txt' % trial_idx)))
+        sim_dir.join('spk_%d.txt' % trial_idx).write(
+            '1.0\t0\tL2_basket\n2.0\t1\tL2_basket\n')
+        with open(str(sim_dir.join('vsoma_%d.pkl' % trial_idx)), 'wb') as f:
+            dump({0: [-65.] * len(times), 1: [-70.] * len(times),
+                  'vtime': times}, f)
+    write_gids_param(str(sim_dir.join('param.txt')), {'L2_basket': [0, 1]})
+    return paramfn, params, sim_dir
+
+
+def test_lazy_sim_data(tmpdir):
+    """Test reading the results of a simulation from disk when accessed"""
+    paramfn, params, sim_dir = _write_trial_files(tmpdir)
+
+    sim_data = SimData()
+    sim_data._data_dir = str(tmpdir)
+    assert sim_data.update_sim_data_from_disk(paramfn, params)
+    data = sim_data._sim_data[paramfn]['data']
+    assert list(data.get_loaded()) == ['gid_ranges']
+
+    # only what is accessed is read
+    assert_allclose(data['avg_dpl'].data['agg'], 1.5)
+    assert not data['avg_dpl'].data['agg'].flags.writeable
+    assert sorted(data.get_loaded()) == ['avg_dpl', 'dpl_stats',
+                                         'gid_ranges']
+    assert data['dpl_stats'].n_trials == 2
+    # the trials are read concurrently but keep their order
+    assert_allclose(data['dpls'][1].data['agg'], 2.)
+    assert data['spec'] is None
+    assert data['spikes'].spike_times == [[1.0, 2.0]] * 2
+    assert 'vsoma' in data and 'vsoma' not in data.get_loaded()
+
+    # copies share what has been read
+    opt_data = sim_data._sim_data[paramfn]['data'].copy()
+    assert opt_data['avg_dpl'] is data['avg_dpl']
+    assert opt_data['dpls'] is not data['dpls']
+
+    # missing results are reported without reading
+    sim_dir.join('param.txt').remove()
+    assert not sim_data.update_sim_data_from_disk(paramfn, params)
+
+
+def test_sim_file(tmpdir):
+    """Test converting the files of the trials to a results file"""
+    paramfn, params, sim_dir = _write_trial_files(tmpdir)
+    params['record_vsoma'] = True
+
+    assert convert_sim_dir(str(sim_dir), remove_legacy=True)
+    assert not convert_sim_dir(str(sim_dir))
+    assert sorted([path.basename for path in sim_dir.listdir()]) == \
+        ['param.txt', 'results.hnn']
+
+    # the arrays are memory-mapped
+    sim_file = open_sim_file(str(sim_dir))
+    assert sim_file.get_array('dpls').shape == (2, 3, 20)
+    assert isinstance(sim_file.get_array('dpls'), np.memmap)
+
+    sim_data = SimData()
+    sim_data._data_dir = str(tmpdir)
+    assert sim_data.update_sim_data_from_disk(paramfn, params)
+    data = sim_data._sim_data[paramfn]['data']
+    assert_allclose(data['dpls'][1].data['L5'], 2.)
+    assert_allclose(data['avg_dpl'].data['agg'], 1.5)
+    assert data['spikes'].spike_times == [[1.0, 2.0]] * 2
+    assert data['spikes'].spike_gids == [[0, 1]] * 2
+    assert data['spikes'].spike_types == [['L2_basket'] * 2] * 2
+    assert_allclose(data['gid_ranges']['L2_basket'], [0, 1])
+    assert len(data['vsoma']) == 2
+    assert_allclose(data['vsoma'][1][1], -70.)
+    assert_allclose(data['vsoma'][0]['vtime'], data['dpls'][0].times)
+
+
+def test_stale_sim_file(tmpdir):
+    """Test that files of the trials newer than the results file are read"""
+    paramfn, params, sim_dir = _write_trial_files(tmpdir)
+    assert convert_sim_dir(str(sim_dir))
+    assert open_sim_file(str(sim_dir)) is not None
+
+    # the voltages are saved after the results file
+    mtime = op.getmtime(str(sim_dir.join('results.hnn'))) + 10
+    os.utime(str(sim_dir.join('vsoma_0.pkl')), (mtime, mtime))
+    assert open_sim_file(str(sim_dir)) is not None
+
+    # simulated again by an older version of HNN
+    times = np.arange(0., 10., 0.5)
+    dpl_fname = str(sim_dir.join('dpl_0.txt'))
+    Dipole(times, np.full((len(times), 3), 5.)).write(dpl_fname)
+    os.utime(dpl_fname, (mtime, mtime))
+    assert open_sim_file(str(sim_dir)) is None
+
+    sim_data = SimData()
+    sim_data._data_dir = str(tmpdir)
+    assert sim_data.update_sim_data_from_disk(paramfn, params)
+    data = sim_data._sim_data[paramfn]['data']
+    assert_allclose(data['dpls'][0].data['agg'], 5.)
+
+
+def test_write_legacy_files(tmpdir, monkeypatch):
+    """Test saving results without the files of the trials"""
+    monkeypatch.setenv('SYSTEM_USER_DIR', str(tmpdir))
+    hnn_root = op.join(op.dirname(__file__), '..', '..')
+    params = read_params(op.join(hnn_root, 'param', 'default.param'))
+    params['N_trials'] = 2
+    params['record_vsoma'] = False
+    params['save_spec_data'] = False
+    sim_result = _make_sim_result(params)
+    sim_result['spikes'] = CellResponse(spike_times=[[1.], [2.]],
+                                        spike_gids=[[0], [1]],
+                                        spike_types=[['L2_basket']] * 2)
+    sim_result['gid_ranges'] = {'L2_basket': range(0, 2)}
+
+    sim_dir = write_sim_data(sim_result, params)
+    assert sorted(os.listdir(sim_dir)) == \
+        ['dpl_0.txt', 'dpl_1.txt', 'param.txt', 'results.hnn', 'spk_0.txt',
+         'spk_1.txt']
+
+    # the files of the earlier simulation are removed
+    assert read_output_settings()['legacy_files']
+    write_output_settings({'legacy_files': False})
+    assert not read_output_settings()['legacy_files']
+    with pytest.raises(ValueError, match='Unknown setting'):
+        write_output_settings({'not_a_setting': 1})
+    assert write_sim_data(sim_result, params, legacy_files=False) == sim_dir
+    assert sorted(os.listdir(sim_dir)) == ['param.txt', 'results.hnn']
+
+    sim_data = SimData()
+    sim_data._data_dir = op.dirname(sim_dir)
+    paramfn = op.join(str(tmpdir), 'default.param')
+    assert sim_data.update_sim_data_from_disk(paramfn, params)
+    data = sim_data._sim_data[paramfn]['data']
+    assert_allclose(data['avg_dpl'].data['agg'],
+                    sim_result['avg_dpl'].data['agg'])
+    assert data['spikes'].spike_times == [[1.], [2.]]
@@ -0,0 +1,238 @@
+import numpy as np
+import pytest
+import matplotlib.pyplot as plt
+from numpy.testing import assert_allclose
+import scipy.signal as sps
+from hnn_core.dipole import Dipole
+
+from hnn.specfn import (average_spec, MorletSpec, WaveletCache, wavelet_cache,
+                        spec_dpls, psd_dpls, make_freqs, freq_spacing,
+                        plot_spec, get_spec_options)
+from hnn.paramrw import read_output_settings, write_output_settings
+from hnn.simdata import get_avg_spec
+
+
+def test_average_spec():
+    """Test averaging spectral analyses of trials in one pass"""
+    rng = np.random.RandomState(0)
+    freqs = np.arange(1., 41.)
+    specs = [{'TFR': rng.rand(40, 100), 'TFR_L2': rng.rand(40, 100),
+              'TFR_L5': rng.rand(40, 100), 'freq': freqs}
+             for _ in range(5)]
+
+    avg_spec = average_spec(specs)
+    for key in ['TFR', 'TFR_L2', 'TFR_L5']:
+        tfrs = np.array([spec[key] for spec in specs])
+        assert_allclose(avg_spec[key], tfrs.mean(axis=0))
+        assert_allclose(avg_spec[key + '_std'], tfrs.std(axis=0))
+    assert avg_spec['freq'] is freqs
+    assert avg_spec['n_trials'] == 5
+
+    avg_spec = average_spec(specs, ntrial=2)
+    assert_allclose(avg_spec['TFR'], (specs[0]['TFR'] + specs[1]['TFR']) / 2)
+
+    # the average is calculated once for a simulation
+    data = {'spec': specs}
+    avg_spec = get_avg_spec(data)
+    assert get_avg_spec(data) is avg_spec
+    assert not avg_spec['TFR'].flags.writeable
+    assert get_avg_spec(data, 3)['n_trials'] == 3
+
+
+def test_morlet_spec():
+    """Test the batched Morlet transform against one frequency at a time"""
+    rng = np.random.RandomState(0)
+    dt, tstop, tmin = 0.5, 300., 50.
+    times = np.arange(0., tstop + dt / 2, dt)
+    signal = np.cumsum(rng.randn(len(times)))
+    spec = MorletSpec(times, signal, 40, dt, tstop, tmin=tmin)
+
+    fs = 1000. / dt
+    s = sps.detrend(signal[times >= tmin])
+    assert_allclose(spec.t, 1000. * np.arange(1, len(s) + 1) / fs + tmin - dt)
+    assert_allclose(spec.f, np.arange(1., 41.))
+    assert spec.TFR.shape == (len(spec.f), len(s))
+    for f_idx, f in enumerate(spec.f):
+        st = 1. / (2. * np.pi * f / 7.)
+        t = np.arange(-3.5 * st, 3.5 * st, 1. / fs)
+        m = np.exp(-t ** 2 / (2 * st ** 2)) * np.exp(2j * np.pi * f * t) / \
+            (st * np.sqrt(2. * np.pi))
+        y = (2. * np.abs(sps.fftconvolve(s, m)) / fs) ** 2
+        y = y[int(np.ceil(len(m) / 2.)):int(len(y) - len(m) // 2 + 1)]
+        assert_allclose(spec.TFR[f_idx], y, rtol=1e-7, atol=1e-12 * y.max())
+
+
+def test_wavelet_cache():
+    """Test sharing the wavelets of spectrograms of the same length"""
+    times = np.arange(0., 200.5, 0.5)
+    signal = np.random.RandomState(0).randn(len(times))
+    wavelet_cache.clear()
+    hits, misses = wavelet_cache.hits, wavelet_cache.misses
+    spec = MorletSpec(times, signal, 20, 0.5, 200.)
+    assert wavelet_cache.misses - misses == 20
+    # another layer or trial uses the same wavelets
+    assert_allclose(MorletSpec(times, signal, 30, 0.5, 200.).TFR[:20],
+                    spec.TFR)
+    assert wavelet_cache.hits - hits == 20
+    assert wavelet_cache.misses - misses == 30
+    assert len(wavelet_cache) == 30
+
+    cache = WaveletCache()
+    kernels, _ = cache.get_kernels(np.arange(1., 11.), 7., 2000., 300)
+    cache.set_max_bytes(kernels[0].nbytes * 4)
+    assert len(cache) == 4
+    assert cache.nbytes <= cache.max_bytes
+    # the most recently used are kept
+    cache.get_kernels([10.], 7., 2000., 300)
+    assert cache.hits == 1
+
+
+def test_spec_dpls():
+    """Test the spectral analysis of all trials and layers at once"""
+    rng = np.random.RandomState(0)
+    dt, tstop = 0.5, 200.
+    times = np.arange(0., tstop + dt / 2, dt)
+    dpls = [Dipole(times, np.cumsum(rng.randn(len(times), 3), axis=0))
+            for _ in range(5)]
+
+    for n_jobs in [1, 2]:
+        specs = spec_dpls(dpls, 30, dt, tstop, n_jobs=n_jobs)
+        assert len(specs) == 5
+        for dpl, spec in zip(dpls, specs):
+            for layer, key in [('agg', 'TFR'), ('L2', 'TFR_L2'),
+                               ('L5', 'TFR_L5')]:
+                layer_spec = MorletSpec(times, dpl.data[layer], 30, dt, tstop)
+                assert_allclose(spec[key], layer_spec.TFR, rtol=1e-10)
+            assert_allclose(spec['time'], layer_spec.t)
+            assert_allclose(spec['f_L5'], layer_spec.f)
+            pgram_f, pgram_p = sps.welch(dpl.data['agg'], 1000. / dt,
+                                         window='hann', nperseg=len(times),
+                                         scaling='spectrum')
+            assert_allclose(spec['pgram_f'], pgram_f)
+            assert_allclose(spec['pgram_p'], pgram_p)
+
+
+def test_psd_dpls():
+    """Test calculating PSDs without the TFRs"""
+    rng = np.random.RandomState(0)
+    dt, tstop = 0.05, 150.
+    times = np.arange(0., tstop + dt / 2, dt)
+    dpls = [Dipole(times, np.cumsum(rng.randn(len(times), 3), axis=0))
+            for _ in range(4)]
+
+    specs = spec_dpls(dpls, 40, dt, tstop)
+    avg_spec = average_spec(specs)
+    psds, avg_psd = psd_dpls(dpls, 40, dt, tstop, decimate=False)
+    for psd, spec in zip(psds + [avg_psd], specs + [avg_spec]):
+        for key in ['', '_L2', '_L5']:
+            tfr = spec['TFR' + key]
+            assert_allclose(psd['PSD' + key], tfr.mean(axis=1), rtol=1e-10)
+            assert_allclose(psd['PSD' + key + '_err'],
+                            tfr.std(axis=1) / np.sqrt(tfr.shape[1]),
+                            rtol=1e-10)
+        assert_allclose(psd['freq'], spec['freq'])
+
+    # decimating changes the PSDs little
+    psds_dec, avg_psd_dec = psd_dpls(dpls, 40, dt, tstop)
+    assert_allclose(avg_psd_dec['PSD_L5'], avg_psd['PSD_L5'],
+                    atol=0.01 * avg_psd['PSD_L5'].max())
+    assert_allclose(psds_dec[2]['PSD'], psds[2]['PSD'],
+                    atol=0.01 * psds[2]['PSD'].max())
+
+    # Welch's method with one segment is the periodogram
+    psds, _ = psd_dpls(dpls, 40, dt, tstop, method='welch', decimate=False)
+    signal = sps.detrend(dpls[1].data['L2'][times >= 50.])
+    nfft = int(round(1000. / dt))
+    pgram_f, pgram_p = sps.welch(signal, 1000. / dt, window='hann',
+                                 nperseg=len(signal), nfft=nfft,
+                                 detrend=False)
+    assert_allclose(psds[1]['PSD_L2'], pgram_p[1:41], rtol=1e-8)
+
+    psds, avg_psd = psd_dpls(dpls, 40, dt, tstop, method='multitaper')
+    assert np.all(avg_psd['PSD'] > 0) and np.all(psds[0]['PSD_err'] > 0)
+    with pytest.raises(ValueError, match='Unknown PSD method'):
+        psd_dpls(dpls, 40, dt, tstop, method='fft')
+
+
+def test_freqs_and_precision():
+    """Test frequency grids and single precision spectral analysis"""
+    assert_allclose(make_freqs(40), np.arange(1., 41.))
+    assert_allclose(make_freqs(200, 5., 5.), np.arange(5., 201., 5.))
+    log_freqs = make_freqs(200, 2., scale='log')
+    assert_allclose(log_freqs[[0, -1]], [2., 200.])
+    assert len(log_freqs) == 55
+    assert len(make_freqs(200, scale='log', n_freqs=30)) == 30
+    assert freq_spacing(make_freqs(200, 5., 5.)) == 'linear'
+    assert freq_spacing(log_freqs) == 'log'
+    assert freq_spacing([4., 8., 10., 30.]) == 'custom'
+    with pytest.raises(ValueError, match='f_min'):
+        make_freqs(40, 0.)
+    with pytest.raises(ValueError, match='Unknown frequency scale'):
+        make_freqs(40, scale='mel')
+
+    rng = np.random.RandomState(0)
+    dt, tstop = 0.1, 150.
+    times = np.arange(0., tstop + dt / 2, dt)
+    dpls = [Dipole(times, np.cumsum(rng.randn(len(times), 3), axis=0))
+            for _ in range(2)]
+
+    # the TFRs of a custom grid are the rows of the integer grid
+    freqs = [4., 8., 13., 30.]
+    specs = spec_dpls(dpls, 30, dt, tstop)
+    specs_custom = spec_dpls(dpls, 30, dt, tstop, freqs=freqs)
+    rows = np.array(freqs, dtype=int) - 1
+    assert_allclose(specs_custom[1]['freq'], freqs)
+    assert_allclose(specs_custom[1]['TFR_L2'], specs[1]['TFR_L2'][rows],
+                    rtol=1e-10)
+    spec = MorletSpec(times, dpls[0].data['agg'], 30, dt, tstop, freqs=freqs)
+    assert_allclose(spec.TFR, specs_custom[0]['TFR'], rtol=1e-10)
+    with pytest.raises(ValueError, match='increasing'):
+        spec_dpls(dpls, 30, dt, tstop, freqs=[8., 4.])
+
+    # single precision is computed and stored in half the memory
+    specs_single = spec_dpls(dpls, 30, dt, tstop, dtype=np.float32)
+    for key in ['TFR', 'TFR_L2', 'TFR_L5', 'pgram_p']:
+        assert specs_single[0][key].dtype == np.float32
+        assert_allclose(specs_single[0][key], specs[0][key],
+                        atol=1e-4 * specs[0][key].max())
+    avg_spec = average_spec(specs_single)
+    assert avg_spec['TFR'].dtype == np.float32
+    psds, avg_psd = psd_dpls(dpls, 30, dt, tstop, dtype=np.float32)
+    psds_double, _ = psd_dpls(dpls, 30, dt, tstop)
+    assert avg_psd['PSD'].dtype == np.float32
+    assert_allclose(psds[0]['PSD'], psds_double[0]['PSD'],
+                    atol=1e-4 * psds_double[0]['PSD'].max())
+    with pytest.raises(ValueError, match='float32 or float64'):
+        psd_dpls(dpls, 30, dt, tstop, dtype=np.int32)
+
+    # log-spaced PSDs and spectrograms
+    log_freqs = make_freqs(30, 2., scale='log')
+    psds, _ = psd_dpls(dpls, 30, dt, tstop, freqs=log_freqs)
+    assert len(psds[0]['freq']) == len(psds[0]['PSD']) == 33
+    specs_log = spec_dpls(dpls, 30, dt, tstop, freqs=log_freqs)
+    fig, ax = plt.subplots()
+    plot_spec(ax, specs_log, 2, 'jet', (50., tstop))
+    assert ax.get_yscale() == 'log'
+    assert ax.get_ylim() == (30., 2.)
+    plt.close(fig)
+
+
+def test_spec_options(tmpdir, monkeypatch):
+    """Test the spectral analysis settings of the output directory"""
+    monkeypatch.setenv('SYSTEM_USER_DIR', str(tmpdir))
+    settings = read_output_settings()
+    freqs, dtype = get_spec_options(settings, 40)
+    assert_allclose(freqs, make_freqs(40))
+    assert dtype == np.float64
+
+    write_output_settings({'spec_scale': 'log', 'spec_f_min': 2.,
+                           'spec_dtype': 'float32'})
+    freqs, dtype = get_spec_options(read_output_settings(), 30)
+    assert_allclose(freqs, make_freqs(30, 2., scale='log'))
+    assert dtype == np.float32
+
+    # a custom grid replaces the scale
+    freqs, _ = get_spec_options(dict(settings, spec_freqs=[4., 8., 13.]), 30)
+    assert_allclose(freqs, [4., 8., 13.])
+    with pytest.raises(ValueError, match='float32 or float64'):
+        get_spec_options(dict(settings, spec_dtype='int32'), 30)
@@ -0,0 +1,141 @@
+import os.path as op
+
+import numpy as np
+from numpy.testing import assert_allclose
+import pytest
+from hnn_core import read_params
+from hnn_core.dipole import Dipole
+
+import hnn
+import hnn.sweep
+from hnn.simdata import SimData
+from hnn.sweep import ParamSweep, expand_sweep, _apply_point
+
+default_paramfn = op.join(op.dirname(hnn.__file__), '..', 'param',
+                          'default.param')
+
+
+def test_expand_grid():
+    """Test the points of a grid sweep"""
+    spec = {'design': 'grid',
+            'params': {'a': {'values': [1., 2.]},
+                       'b': {'min': 0., 'max': 1., 'n': 3}}}
+    points = expand_sweep(spec)
+    assert len(points) == 6
+    # the last param changes fastest
+    assert points == [{'a': 1., 'b': 0.}, {'a': 1., 'b': 0.5},
+                      {'a': 1., 'b': 1.}, {'a': 2., 'b': 0.},
+                      {'a': 2., 'b': 0.5}, {'a': 2., 'b': 1.}]
+
+
+@pytest.mark.parametrize('design', ['random', 'lhs'])
+def test_expand_samples(design):
+    """Test the points of random and Latin hypercube sweeps"""
+    n_samples = 20
+    spec = {'design': design, 'n_samples': n_samples, 'seed': 1,
+            'params': {'a': {'min': -1., 'max': 3.},
+                       'b': {'values': [10., 20., 30.]}}}
+    points = expand_sweep(spec)
+    assert len(points) == n_samples
+    a = np.array([point['a'] for point in points])
+    assert np.all(a >= -1.) and np.all(a < 3.)
+    assert set([point['b'] for point in points]) <= set([10., 20., 30.])
+
+    # reproducible with the same seed only
+    assert expand_sweep(spec) == points
+    assert expand_sweep(dict(spec, seed=2)) != points
+
+    if design == 'lhs':
+        # one sample in each stratum of each param
+        strata = np.floor((a + 1.) / 4. * n_samples).astype(int)
+        assert sorted(strata) == list(range(n_samples))
+        # the strata cover every value
+        assert set([point['b'] for point in points]) == set([10., 20., 30.])
+
+
+def test_apply_point():
+    """Test setting the values of a point on the base params"""
+    base_params = read_params(default_paramfn)
+    params = _apply_point(base_params, {'gbar_evprox_1_L2Pyr_*': 0.5,
+                                        't_evdist_1': 70.})
+    assert params['gbar_evprox_1_L2Pyr_ampa'] == 0.5
+    assert params['gbar_evprox_1_L2Pyr_nmda'] == 0.5
+    assert params['t_evdist_1'] == 70.
+    # the base params are unchanged
+    assert base_params['t_evdist_1'] == 63.53
+    with pytest.raises(ValueError, match='does not match any parameter'):
+        _apply_point(base_params, {'not_a_param': 1.})
+
+
+def _make_sweep(tmpdir, monkeypatch):
+    monkeypatch.setenv('SYSTEM_USER_DIR', str(tmpdir))
+    spec = {'design': 'grid',
+            'params': {'t_evdist_1': {'min': 60., 'max': 70., 'n': 3}}}
+    return ParamSweep(default_paramfn, spec, 'test_sweep')
+
+
+def test_sweep_resume(tmpdir, monkeypatch):
+    """Test that a sweep continues from the points in its index"""
+    sweep = _make_sweep(tmpdir, monkeypatch)
+    sweep.write_param_files()
+    assert read_params(sweep.paramfns[2])['t_evdist_1'] == 70.
+    assert read_params(sweep.paramfns[2])['sim_prefix'] == 'test_sweep_0002'
+    sweep._append_index(0, 'done')
+    sweep._append_index(1, 'failed')
+
+    batches = list()
+
+    def run_batch(paramfns, result_callback=None, **kwargs):
+        batches.append(paramfns)
+        for paramfn in paramfns:
+            result_callback(paramfn, 'sim_dir')
+        return []
+
+    monkeypatch.setattr(hnn.sweep, 'run_batch', run_batch)
+    assert sweep.run() == []
+    # failed points are simulated again
+    assert batches == [sweep.paramfns[1:]]
+    rows = sweep.read_index()
+    assert [(row['index'], row['status']) for row in rows] == \
+        [('0', 'done'), ('1', 'failed'), ('1', 'done'), ('2', 'done')]
+    assert float(rows[-1]['t_evdist_1']) == 70.
+
+    # nothing left to do
+    assert sweep.run() == []
+    assert len(batches) == 1
+
+    # the index only belongs to the same spec
+    sweep.spec = dict(sweep.spec, design='random', n_samples=3)
+    with pytest.raises(ValueError, match='A different sweep'):
+        sweep.write_param_files()
+
+
+def test_rmse_table(tmpdir, monkeypatch):
+    """Test the RMSE of sweep points against known dipoles"""
+    sweep = _make_sweep(tmpdir, monkeypatch)
+    sweep.write_param_files()
+    for point_idx, status in enumerate(['done', 'done', 'failed']):
+        sweep._append_index(point_idx, status)
+
+    times = np.arange(0., 170. + 0.0125, 0.025)
+    exp_dpl = np.sin(times / 10.)
+    sim_data = SimData()
+    with pytest.raises(ValueError, match='No experimental data'):
+        sweep.calc_rmse_table(sim_data)
+    sim_data.update_exp_data('exp.txt', np.c_[times, exp_dpl, exp_dpl])
+
+    # dipoles with known errors
+    for point_idx, offset in [(0, 2.), (1, -0.5)]:
+        paramfn = sweep.paramfns[point_idx]
+        agg = exp_dpl + offset
+        dpl = Dipole(times, np.c_[agg, agg, agg])
+        sim_data.update_sim_data(paramfn, read_params(paramfn), [dpl], dpl,
+                                 None, None)
+
+    rows = sweep.calc_rmse_table(sim_data)
+    assert [row['index'] for row in rows] == ['1', '0']
+    assert_allclose([row['rmse'] for row in rows], [0.5, 2.])
+    assert_allclose([row['rmse_1'] for row in rows], [0.5, 2.])
+    assert op.exists(op.join(sweep.sweep_dir, 'rmse.csv'))
+    # the points that were already in sim_data are kept
+    assert sim_data.in_sim_data(sweep.paramfns[0])
@@ -0,0 +1,9 @@
+"""Run HNN simulations of many parameter files without the GUI"""
+
+import sys
+
+from hnn.batch import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
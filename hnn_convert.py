@@ -0,0 +1,9 @@
+"""Convert saved simulations to single results files without the GUI"""
+
+import sys
+
+from hnn.convert import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
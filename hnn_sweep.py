@@ -0,0 +1,9 @@
+"""Sweep params of an HNN param file without the GUI"""
+
+import sys
+
+from hnn.sweep import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())